@@ -0,0 +1,26 @@
+"""source http validators
+
+Revision ID: 3a1f5b7c9d20
+Revises: fe83b1ff945
+Create Date: 2026-10-18 09:12:40.118230
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a1f5b7c9d20'
+down_revision = 'fe83b1ff945'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('sources', sa.Column('etag', sa.Unicode(1000)))
+    op.add_column('sources', sa.Column('last_modified', sa.Unicode(1000)))
+    op.add_column('sources', sa.Column('content_hash', sa.String(40)))
+
+
+def downgrade():
+    op.drop_column('sources', 'content_hash')
+    op.drop_column('sources', 'last_modified')
+    op.drop_column('sources', 'etag')
@@ -0,0 +1,40 @@
+"""event access path indexes
+
+Revision ID: b7e2c4d91a36
+Revises: 3a1f5b7c9d20
+Create Date: 2026-10-18 10:41:05.503114
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2c4d91a36'
+down_revision = '3a1f5b7c9d20'
+
+from alembic import op
+
+
+INDEXES = [
+    ('ix_events_start_time_end_time', 'events', ['start_time', 'end_time']),
+    ('ix_events_end_time', 'events', ['end_time']),
+    ('ix_events_provider_id_start_time', 'events',
+     ['provider_id', 'start_time']),
+    ('ix_tag_association_event_id_tag_id', 'tag_association',
+     ['event_id', 'tag_id']),
+    ('ix_tag_association_tag_id', 'tag_association', ['tag_id']),
+    ('ix_category_association_event_id_tag_id', 'category_association',
+     ['event_id', 'tag_id']),
+    ('ix_category_association_tag_id', 'category_association', ['tag_id']),
+    ('ix_media_event_id', 'media', ['event_id']),
+    ('ix_locations_event_id', 'locations', ['event_id']),
+    ('ix_sources_provider_id', 'sources', ['provider_id']),
+]
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table)
@@ -0,0 +1,32 @@
+"""event harvest fingerprints and tombstones
+
+Revision ID: d5a9c3e7f214
+Revises: b7e2c4d91a36
+Create Date: 2026-10-18 21:04:12.530871
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd5a9c3e7f214'
+down_revision = 'b7e2c4d91a36'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('events', sa.Column(
+        'harvest_source_id', sa.Integer(),
+        sa.ForeignKey('sources.id', ondelete='SET NULL')))
+    op.add_column('events', sa.Column('fingerprint', sa.String(40)))
+    op.add_column('events', sa.Column(
+        'deleted', sa.Boolean(), nullable=False, server_default=sa.false()))
+    op.create_index('ix_events_harvest_source_id', 'events',
+                    ['harvest_source_id'])
+
+
+def downgrade():
+    op.drop_index('ix_events_harvest_source_id', 'events')
+    op.drop_column('events', 'deleted')
+    op.drop_column('events', 'fingerprint')
+    op.drop_column('events', 'harvest_source_id')
@@ -0,0 +1,29 @@
+"""source harvest schedule
+
+Revision ID: e8b1f6a2c905
+Revises: d5a9c3e7f214
+Create Date: 2026-10-18 21:47:30.214967
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e8b1f6a2c905'
+down_revision = 'd5a9c3e7f214'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('sources', sa.Column('harvest_interval', sa.Integer()))
+    op.add_column('sources', sa.Column('next_run', sa.DateTime()))
+    op.add_column('sources', sa.Column(
+        'failure_count', sa.Integer(), nullable=False, server_default='0'))
+    op.create_index('ix_sources_next_run', 'sources', ['next_run'])
+
+
+def downgrade():
+    op.drop_index('ix_sources_next_run', 'sources')
+    op.drop_column('sources', 'failure_count')
+    op.drop_column('sources', 'next_run')
+    op.drop_column('sources', 'harvest_interval')
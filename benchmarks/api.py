@@ -0,0 +1,215 @@
+"""
+Load test of the REST API: latency percentiles, throughput and SQL
+statements per request of event reads, bulk writes and harvests.
+
+Usage: python benchmarks/api.py [--events N] [--requests N] [--url URL]
+                                [--output FILE]
+
+The database given by --url is populated with synthetic events, use a
+throwaway database. Requests go through WebTest, without a network round
+trip, and each one is committed like pyramid_tm does in deployments.
+Results are printed and saved as JSON to compare runs. ode must be
+importable, eg. from a development install (make develop).
+"""
+from collections import OrderedDict
+import datetime
+import json
+import optparse
+import platform
+import random
+import time
+from timeit import default_timer
+
+import transaction
+from webtest import TestApp
+
+from ode import main as make_app
+from ode.harvesting import harvest_cstruct
+from ode.models import (DBSession, Base, Event, Image, Location, Sound,
+                        Source, Tag, Video)
+from ode.resources.base import COLLECTION_JSON_MIMETYPE
+from ode.tests.support import QueryCounter
+
+
+START = datetime.datetime(2014, 1, 1)
+TAGS = 50
+WRITE_HEADERS = {'X-ODE-Provider-Id': '123',
+                 'Content-Type': COLLECTION_JSON_MIMETYPE}
+
+
+def seed(event_count):
+    tags = [Tag(name=u'tag%s' % i) for i in range(TAGS)]
+    for i in range(event_count):
+        start_time = START + datetime.timedelta(
+            hours=random.randint(0, 365 * 24))
+        event = Event(id=u'%s@example.com' % i, title=u'Event %s' % i,
+                      description=u'Description of event %s' % i,
+                      url=u'http://example.com/%s' % i,
+                      provider_id=u'123',
+                      start_time=start_time,
+                      end_time=start_time + datetime.timedelta(hours=3))
+        event.location = Location(name=u'Location %s' % (i % 100),
+                                  town=u'Town', country=u'France')
+        event.tags = random.sample(tags, 3)
+        event.categories = random.sample(tags, 1)
+        event.images = [Image(url=u'http://example.com/%s.png' % i,
+                              license=u'CC BY')]
+        event.videos = [Video(url=u'http://example.com/%s.mp4' % i,
+                              license=u'CC BY')]
+        event.sounds = [Sound(url=u'http://example.com/%s.mp3' % i,
+                              license=u'CC BY')]
+        DBSession.add(event)
+        if i % 1000 == 999:
+            DBSession.flush()
+            DBSession.expunge_all()
+            tags = [DBSession.merge(tag) for tag in tags]
+    transaction.commit()
+
+
+def event_data(uid):
+    start_time = START + datetime.timedelta(hours=random.randint(0, 24))
+    return [
+        {'name': 'id', 'value': uid},
+        {'name': 'title', 'value': u'Posted event %s' % uid},
+        {'name': 'start_time', 'value': start_time.isoformat()},
+        {'name': 'end_time',
+         'value': (start_time + datetime.timedelta(hours=2)).isoformat()},
+        {'name': 'location_name', 'value': u'Location'},
+        {'name': 'tags', 'value': [u'tag1', u'tag2']},
+        {'name': 'images',
+         'value': [{'url': u'http://example.com/img.png',
+                    'license': u'CC BY'}]},
+    ]
+
+
+def read_scenarios(app):
+    window_start = START + datetime.timedelta(days=100)
+    window = {
+        'start_time': window_start.isoformat(),
+        'end_time': (window_start + datetime.timedelta(days=7)).isoformat(),
+    }
+    json_headers = {'Accept': COLLECTION_JSON_MIMETYPE}
+    reads = [
+        ('GET json', {}, json_headers),
+        ('GET json limit=100', {'limit': 100}, json_headers),
+        ('GET json sort_by=title desc',
+         {'limit': 100, 'sort_by': 'title', 'sort_direction': 'desc'},
+         json_headers),
+        ('GET json time window', window, json_headers),
+        ('GET csv limit=100', {'limit': 100}, {'Accept': 'text/csv'}),
+        ('GET csv stream', {'stream': 'true'}, {'Accept': 'text/csv'}),
+        ('GET ical limit=100', {'limit': 100},
+         {'Accept': 'text/calendar'}),
+        ('GET ical stream', {'stream': 'true'},
+         {'Accept': 'text/calendar'}),
+    ]
+    for name, params, headers in reads:
+        def read(params=params, headers=headers):
+            app.get('/v1/events', params=params, headers=headers)
+        yield name, read
+
+
+def write_scenarios(app, bulk_size):
+    counter = iter(range(10 ** 9))
+
+    def post_bulk():
+        items = [{'data': event_data(u'bulk%s@example.com' % next(counter))}
+                 for _ in range(bulk_size)]
+        app.post_json('/v1/events', {'collection': {'items': items}},
+                      headers=WRITE_HEADERS)
+    yield 'POST json %s events' % bulk_size, post_bulk
+
+    source = Source(url=u'http://example.com/feed', provider_id=u'123')
+    DBSession.add(source)
+    DBSession.flush()
+    source_id = source.id
+    transaction.commit()
+
+    def harvest():
+        source = DBSession.query(Source).get(source_id)
+        items = [{'data': dict((field['name'], field['value'])
+                               for field in event_data(
+                                   u'harvest%s@example.com' % next(counter)))}
+                 for _ in range(bulk_size)]
+        harvest_cstruct({'items': items}, source)
+    yield 'harvest_cstruct %s events' % bulk_size, harvest
+
+
+def percentile(values, rank):
+    values = sorted(values)
+    index = int(round(rank / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def measure(name, run, requests, queries):
+    # Warm up caches of the serializers, renderers and SQLAlchemy
+    run()
+    transaction.commit()
+    latencies = []
+    query_count = queries.count
+    for _ in range(requests):
+        start = default_timer()
+        run()
+        transaction.commit()
+        latencies.append(default_timer() - start)
+        DBSession.remove()
+    total = sum(latencies)
+    return OrderedDict([
+        ('scenario', name),
+        ('requests', requests),
+        ('p50_ms', round(percentile(latencies, 50) * 1000, 3)),
+        ('p95_ms', round(percentile(latencies, 95) * 1000, 3)),
+        ('requests_per_second', round(requests / total, 2)),
+        ('queries_per_request',
+         round(float(queries.count - query_count) / requests, 2)),
+    ])
+
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option('--events', type='int', default=10000)
+    parser.add_option('--requests', type='int', default=50)
+    parser.add_option('--bulk-size', type='int', default=50)
+    parser.add_option('--url', default='sqlite://')
+    parser.add_option('--output', default='api-benchmark.json')
+    options, args = parser.parse_args()
+
+    random.seed(0)
+    app = TestApp(make_app({}, **{
+        'sqlalchemy.url': options.url,
+        'domain': 'example.com',
+    }))
+    engine = DBSession.get_bind()
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    seed(options.events)
+
+    print('%-32s  %8s  %8s  %8s  %8s' % (
+        'scenario', 'p50 (ms)', 'p95 (ms)', 'req/s', 'queries'))
+    results = []
+    scenarios = list(read_scenarios(app)) + \
+        list(write_scenarios(app, options.bulk_size))
+    with QueryCounter() as queries:
+        for name, run in scenarios:
+            result = measure(name, run, options.requests, queries)
+            results.append(result)
+            print('%-32s  %8.2f  %8.2f  %8.1f  %8.1f' % (
+                name, result['p50_ms'], result['p95_ms'],
+                result['requests_per_second'],
+                result['queries_per_request']))
+
+    report = OrderedDict([
+        ('date', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', platform.python_version()),
+        ('database', engine.name),
+        ('events', options.events),
+        ('bulk_size', options.bulk_size),
+        ('results', results),
+    ])
+    with open(options.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print('Results saved to %s' % options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+Harvest synthetic iCalendar and Collection+JSON feeds served by a local
+HTTP server, and break the time of ode.harvesting.harvest() down by stage:
+fetch, parse, validate and persist.
+
+Usage: python benchmarks/harvest.py [--sizes 1000,10000,100000]
+                                    [--formats ical,json] [--url URL]
+                                    [--output FILE]
+
+For each feed, the scenarios are:
+
+- first run: all events are inserted;
+- updated feed: all events changed and are updated;
+- unchanged events: the feed is parsed again but all events are skipped;
+- unchanged feed: the feed is fetched but not parsed.
+
+The database given by --url is dropped and created again for each feed, use
+a throwaway database. ode must be importable, eg. from a development install
+(make develop).
+"""
+from collections import OrderedDict
+import datetime
+import json
+import optparse
+import platform
+import threading
+import time
+from timeit import default_timer
+
+from six.moves import BaseHTTPServer
+from sqlalchemy import create_engine
+import transaction
+
+from ode.harvesting import harvest
+from ode.models import DBSession, Base, Source
+from ode.resources.base import COLLECTION_JSON_MIMETYPE
+
+
+START = datetime.datetime(2014, 1, 1)
+
+CONTENT_TYPES = {
+    'ical': 'text/calendar; charset=utf-8',
+    'json': COLLECTION_JSON_MIMETYPE,
+}
+
+
+def event_values(index, version):
+    start_time = START + datetime.timedelta(hours=index)
+    return {
+        'id': u'%s@example.com' % index,
+        'title': u'Event %s, version %s' % (index, version),
+        'description': u'Description of event %s' % index,
+        'url': u'http://example.com/events/%s' % index,
+        'start_time': start_time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'end_time': (start_time + datetime.timedelta(hours=2)).strftime(
+            '%Y-%m-%dT%H:%M:%S'),
+        'location_name': u'Location %s' % (index % 100),
+    }
+
+
+def icalendar_feed(size, version):
+    lines = [u'BEGIN:VCALENDAR', u'VERSION:2.0',
+             u'PRODID:-//ODE//Harvest benchmark//EN']
+    for index in range(size):
+        values = event_values(index, version)
+        lines.extend([
+            u'BEGIN:VEVENT',
+            u'UID:%s' % values['id'],
+            u'DTSTART:%s' % values['start_time'].replace('-', '')
+            .replace(':', ''),
+            u'DTEND:%s' % values['end_time'].replace('-', '')
+            .replace(':', ''),
+            u'SUMMARY:%s' % values['title'].replace(u',', u'\\,'),
+            u'DESCRIPTION:%s' % values['description'],
+            u'LOCATION:%s' % values['location_name'],
+            u'URL:%s' % values['url'],
+            u'END:VEVENT',
+        ])
+    lines.append(u'END:VCALENDAR')
+    return u'\r\n'.join(lines) + u'\r\n'
+
+
+def json_feed(size, version):
+    items = [
+        {'data': [{'name': name, 'value': value}
+                  for name, value in sorted(event_values(index,
+                                                         version).items())]}
+        for index in range(size)
+    ]
+    return json.dumps({'collection': {'version': '1.0', 'items': items}})
+
+
+FEED_BUILDERS = {
+    'ical': icalendar_feed,
+    'json': json_feed,
+}
+
+
+class FeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Path to (content type, body)
+    feeds = {}
+
+    def do_GET(self):
+        content_type, body = self.feeds[self.path]
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server():
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FeedHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def publish(path, feed_format, size, version):
+    text = FEED_BUILDERS[feed_format](size, version)
+    FeedHandler.feeds[path] = (CONTENT_TYPES[feed_format],
+                               text.encode('utf-8'))
+
+
+def run_scenario(name, feed_format, size):
+    start = default_timer()
+    with transaction.manager:
+        stats, = harvest()
+    seconds = default_timer() - start
+    DBSession.remove()
+    data = stats.as_dict()
+    result = OrderedDict([
+        ('scenario', name),
+        ('format', feed_format),
+        ('events', size),
+        ('status', stats.status),
+        ('seconds', round(seconds, 3)),
+        ('events_per_second', round(size / seconds, 1)),
+        ('seconds_by_stage', data['seconds']),
+    ])
+    for counter in stats.COUNTERS:
+        result[counter] = data[counter]
+    return result
+
+
+def benchmark_feed(engine, server, feed_format, size):
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    path = '/%s-%s' % (size, feed_format)
+    url = u'http://127.0.0.1:%s%s' % (server.server_port, path)
+    with transaction.manager:
+        DBSession.add(Source(url=url, provider_id=u'1'))
+
+    publish(path, feed_format, size, version=1)
+    yield run_scenario('first run', feed_format, size)
+    publish(path, feed_format, size, version=2)
+    yield run_scenario('updated feed', feed_format, size)
+    with transaction.manager:
+        DBSession.query(Source).one().reset_validators()
+    yield run_scenario('unchanged events', feed_format, size)
+    yield run_scenario('unchanged feed', feed_format, size)
+    del FeedHandler.feeds[path]
+
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option('--sizes', default='1000,10000,100000')
+    parser.add_option('--formats', default='ical,json')
+    parser.add_option('--url', default='sqlite://')
+    parser.add_option('--output', default='harvest-benchmark.json')
+    options, args = parser.parse_args()
+
+    engine = create_engine(options.url)
+    DBSession.configure(bind=engine)
+    server = start_server()
+
+    columns = ('seconds', 'fetch', 'parse', 'validate', 'persist')
+    print('%-6s  %7s  %-16s  %8s  %8s  %8s  %8s  %8s  %8s  %8s  %8s' % (
+        (('format', 'events', 'scenario') + columns +
+         ('inserted', 'updated', 'skipped'))))
+    results = []
+    for size in [int(size) for size in options.sizes.split(',')]:
+        for feed_format in options.formats.split(','):
+            for result in benchmark_feed(engine, server, feed_format, size):
+                results.append(result)
+                timings = [result['seconds']] + [
+                    result['seconds_by_stage'][stage]
+                    for stage in columns[1:]]
+                print('%-6s  %7d  %-16s  %8.2f  %8.2f  %8.2f  %8.2f  %8.2f  '
+                      '%8d  %8d  %8d' % tuple(
+                          [feed_format, size, result['scenario']] + timings +
+                          [result['inserted'], result['updated'],
+                           result['skipped']]))
+    server.shutdown()
+
+    report = OrderedDict([
+        ('date', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', platform.python_version()),
+        ('database', engine.name),
+        ('results', results),
+    ])
+    with open(options.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print('Results saved to %s' % options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Compare query plans and timings of the main event access paths with and
+without the indexes declared in ode.models.
+
+Usage: python benchmarks/query_plans.py [--events N] [--url URL]
+
+The database given by --url is populated with synthetic data, use a
+throwaway database. SQLite and PostgreSQL are supported. ode must be
+importable, eg. from a development install (make develop).
+"""
+import datetime
+import optparse
+import random
+import timeit
+
+from sqlalchemy import create_engine
+
+from ode.models import (DBSession, Base, Event, Location, Media, Tag,
+                        tag_association, category_association)
+
+
+PROVIDERS = 20
+TAGS = 200
+START = datetime.datetime(2010, 1, 1)
+
+
+def seed(engine, event_count):
+    rows = []
+    for i in range(event_count):
+        start_time = START + datetime.timedelta(
+            hours=random.randint(0, 10 * 365 * 24))
+        rows.append({
+            'id': u'%s@example.com' % i,
+            'title': u'Event %s' % i,
+            'provider_id': u'%s' % (i % PROVIDERS),
+            'start_time': start_time,
+            'end_time': start_time + datetime.timedelta(hours=3),
+        })
+    engine.execute(Event.__table__.insert(), rows)
+    engine.execute(Tag.__table__.insert(),
+                   [{'id': i, 'name': u'tag%s' % i} for i in range(TAGS)])
+    for table in (tag_association, category_association):
+        engine.execute(table.insert(), [
+            {'event_id': row['id'], 'tag_id': random.randrange(TAGS)}
+            for row in rows for _ in range(3)
+        ])
+    engine.execute(Location.__table__.insert(), [
+        {'event_id': row['id'], 'name': u'Location'} for row in rows
+    ])
+    engine.execute(Media.__table__.insert(), [
+        {'event_id': row['id'], 'url': u'http://example.com', 'type': kind}
+        for row in rows for kind in ('image', 'video', 'sound')
+    ])
+
+
+def access_paths():
+    window_start = START + datetime.timedelta(days=365)
+    window_end = window_start + datetime.timedelta(days=7)
+    ids = [u'%s@example.com' % i for i in range(0, 1000, 10)]
+    yield 'time window', DBSession.query(Event).filter(
+        Event.end_time > window_start, Event.start_time < window_end)
+    yield 'provider', DBSession.query(Event).filter_by(
+        provider_id=u'7').order_by(Event.start_time).limit(100)
+    yield 'sort by start_time', DBSession.query(Event).order_by(
+        Event.start_time, Event.id).limit(100)
+    yield 'event tags', DBSession.query(Tag).join(
+        tag_association).filter(tag_association.c.event_id.in_(ids))
+    yield 'event media', DBSession.query(Media).filter(
+        Media.event_id.in_(ids))
+    yield 'event locations', DBSession.query(Location).filter(
+        Location.event_id.in_(ids))
+
+
+def explain(engine, query):
+    statement = query.statement.compile(
+        engine, compile_kwargs={'literal_binds': True})
+    prefix = 'EXPLAIN QUERY PLAN ' if engine.name == 'sqlite' else 'EXPLAIN '
+    rows = engine.execute(prefix + str(statement)).fetchall()
+    return [u' '.join(str(value) for value in row) for row in rows]
+
+
+def run(engine, label, repeat):
+    print('=== %s ===' % label)
+    for name, query in access_paths():
+        duration = min(timeit.repeat(query.all, number=1, repeat=repeat))
+        print('%-20s %8.2f ms' % (name, duration * 1000))
+        for line in explain(engine, query):
+            print('    ' + line)
+
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option('--events', type='int', default=50000)
+    parser.add_option('--url', default='sqlite://')
+    parser.add_option('--repeat', type='int', default=5)
+    options, args = parser.parse_args()
+
+    connect_args = {}
+    if options.url.startswith('sqlite'):
+        # Cached EXPLAIN statements would survive dropping the indexes
+        connect_args['cached_statements'] = 0
+    engine = create_engine(options.url, connect_args=connect_args)
+    DBSession.configure(bind=engine)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    seed(engine, options.events)
+
+    run(engine, 'with indexes', options.repeat)
+    DBSession.remove()
+    indexes = [index for table in Base.metadata.sorted_tables
+               for index in table.indexes]
+    for index in indexes:
+        index.drop(engine)
+    run(engine, 'without indexes', options.repeat)
+    DBSession.remove()
+    for index in indexes:
+        index.create(engine)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Compare the precompiled event serializer with the previous
+Event.to_data_list implementation, which looked up mapper columns and
+location fields on every call. The serializer builds dictionaries, the
+legacy lists are converted with data_list_to_dict to check both agree.
+
+Usage: python benchmarks/serializer.py [--repeat N] [--sizes 100,1000,10000]
+
+Events are loaded from an in-memory SQLite database, like the events
+collection does. ode must be importable, eg. from a development install
+(make develop).
+"""
+import datetime
+import optparse
+import timeit
+
+from sqlalchemy import create_engine
+
+from ode.deserializers import data_list_to_dict
+from ode.models import DBSession, Base, Event, Image, Location, Tag
+
+
+def legacy_to_data_list(self):
+    result = []
+
+    for column in self.__class__.__mapper__.columns:
+        value = getattr(self, column.name)
+        if value:
+            result.append({'name': column.name, 'value': value})
+
+    if getattr(self, 'location', None):
+        location_fields = ('name', 'address', 'post_code', 'capacity',
+                           'town', 'country')
+        for name in location_fields:
+            value = getattr(self.location, name)
+            if value:
+                result.append({'name': 'location_' + name,
+                               'value': getattr(self.location, name)})
+
+    for attrname in ('tags', 'categories'):
+        objects = getattr(self, attrname, None)
+        if objects:
+            values = [obj.name for obj in objects]
+            result.append({'name': attrname, 'value': values})
+
+    for attrname in ('images', 'videos', 'sounds'):
+        objects = getattr(self, attrname, None)
+        if objects:
+            values = [{'url': obj.url, 'license': obj.license}
+                      for obj in objects]
+            result.append({'name': attrname, 'value': values})
+    return result
+
+
+def make_events(count):
+    tags = [Tag(name=u'tag%s' % i) for i in range(10)]
+    events = []
+    for i in range(count):
+        start_time = datetime.datetime(2014, 1, 1) + datetime.timedelta(i)
+        event = Event(id=u'%s@example.com' % i, title=u'Event %s' % i,
+                      description=u'Description of event %s' % i,
+                      url=u'http://example.com/%s' % i,
+                      start_time=start_time,
+                      end_time=start_time + datetime.timedelta(hours=3))
+        event.location = Location(name=u'Location', town=u'Town')
+        event.tags = tags[i % 10:i % 10 + 3]
+        event.images = [Image(url=u'http://example.com/%s.png' % i,
+                              license=u'CC BY')]
+        events.append(event)
+    DBSession.add_all(events)
+    DBSession.flush()
+    DBSession.expunge_all()
+    events = DBSession.query(Event).options(
+        *Event.eager_loading_options()).all()
+    Event.load_media(events)
+    return events
+
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option('--repeat', type='int', default=5)
+    parser.add_option('--sizes', default='100,1000,10000')
+    options, args = parser.parse_args()
+
+    engine = create_engine('sqlite://')
+    DBSession.configure(bind=engine)
+    Base.metadata.create_all(engine)
+
+    print('%8s  %12s  %12s  %8s' % (
+        'events', 'legacy (ms)', 'compiled (ms)', 'speedup'))
+    for size in [int(size) for size in options.sizes.split(',')]:
+        events = make_events(size)
+        serializer = Event.data_serializer()
+        expected = [data_list_to_dict(legacy_to_data_list(event))
+                    for event in events]
+        assert expected == [serializer(event) for event in events]
+        legacy = min(timeit.repeat(
+            lambda: [legacy_to_data_list(event) for event in events],
+            number=1, repeat=options.repeat))
+        compiled = min(timeit.repeat(
+            lambda: [serializer(event) for event in events],
+            number=1, repeat=options.repeat))
+        print('%8d  %12.2f  %12.2f  %7.2fx' % (
+            size, legacy * 1000, compiled * 1000, legacy / compiled))
+        DBSession.rollback()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ from ode.models import DBSession, Base
 from ode.deserializers import icalendar_extractor, json_extractor
 from ode.deserializers import csv_extractor
 from ode.resources.base import COLLECTION_JSON_MIMETYPE
+from ode.validation import parallel
 
 
 def main(global_config, **settings):
@@ -14,6 +15,7 @@ def main(global_config, **settings):
     engine = engine_from_config(settings, 'sqlalchemy.')
     DBSession.configure(bind=engine)
     Base.metadata.bind = engine
+    parallel.configure(settings)
     config = Configurator(settings=settings)
     config.include('cornice')
     config.add_static_view('static', 'static', cache_max_age=3600)
@@ -22,6 +24,8 @@ def main(global_config, **settings):
     config.add_renderer('csv', 'ode.renderers.CsvRenderer')
     config.add_renderer('ical', 'ode.renderers.IcalRenderer')
     config.add_renderer('no_content', 'ode.renderers.NoContentRenderer')
+    config.add_tween('ode.cache.response_cache_tween_factory')
+    config.include('ode.profiling')
     config.add_cornice_deserializer('text/calendar', icalendar_extractor)
     config.add_cornice_deserializer(COLLECTION_JSON_MIMETYPE, json_extractor)
     config.add_cornice_deserializer('text/csv', csv_extractor)
@@ -0,0 +1,170 @@
+"""
+In-process cache of event read responses.
+
+Responses are cached by path, normalized query string and Accept header,
+in a bounded LRU mapping. The whole cache is dropped when the database is
+written to by this process; writes from other processes, like the harvest
+script, are caught up with when entries expire.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+from pyramid.response import Response
+from sqlalchemy.event import listens_for
+from six.moves.urllib.parse import urlencode
+
+from ode.models import DBSession
+
+
+CACHED_PATHS = ('/v1/events',)
+DEFAULT_MAX_AGE = 60
+
+_generation = [0]
+
+
+def generation():
+    return _generation[0]
+
+
+def invalidate():
+    """Drop all cached responses"""
+    _generation[0] += 1
+
+
+@listens_for(DBSession, 'after_flush')
+def invalidate_after_flush(session, flush_context):
+    session.info['response_cache_dirty'] = True
+    invalidate()
+
+
+@listens_for(DBSession, 'after_bulk_update')
+@listens_for(DBSession, 'after_bulk_delete')
+def invalidate_after_bulk_write(update_context):
+    update_context.session.info['response_cache_dirty'] = True
+    invalidate()
+
+
+@listens_for(DBSession, 'after_commit')
+def invalidate_after_commit(session):
+    # Readers may have cached data from before the commit since the flush
+    if session.info.pop('response_cache_dirty', False):
+        invalidate()
+
+
+@listens_for(DBSession, 'after_rollback')
+def forget_flushes(session):
+    session.info.pop('response_cache_dirty', None)
+
+
+class ResponseCache(object):
+    """
+    Thread safe LRU mapping of cache keys to responses, emptied whenever
+    the generation changes.
+    """
+
+    def __init__(self, max_entries, max_age=DEFAULT_MAX_AGE):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.generation = generation()
+        self.lock = threading.Lock()
+
+    def _check_generation(self):
+        current = generation()
+        if current != self.generation:
+            self.entries.clear()
+            self.generation = current
+
+    def get(self, key):
+        with self.lock:
+            self._check_generation()
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, response = entry
+            if self.max_age and expires < time.time():
+                del self.entries[key]
+                return None
+            # Move the entry to the most recently used end
+            del self.entries[key]
+            self.entries[key] = entry
+            return response
+
+    def set(self, key, response, entry_generation):
+        with self.lock:
+            self._check_generation()
+            if entry_generation != self.generation:
+                # The database changed while the response was built
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.max_age, response)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+def is_cached_path(path):
+    return any(path == prefix or path.startswith(prefix + '/')
+               for prefix in CACHED_PATHS)
+
+
+def cache_key(request):
+    query = urlencode(sorted(request.GET.items()))
+    return (
+        request.host_url,
+        request.headers.get('X-ODE-API-Mount-Point'),
+        request.path,
+        query,
+        request.headers.get('Accept', '').replace(' ', ''),
+    )
+
+
+def freeze(response):
+    return (response.status, list(response.headerlist), response.body)
+
+
+def thaw(frozen):
+    status, headerlist, body = frozen
+    response = Response(body=body, status=status, headerlist=list(headerlist))
+    response.conditional_response = True
+    return response
+
+
+def response_cache_tween_factory(handler, registry):
+    """
+    Serve event reads from the cache, with strong ETags validated by
+    If-None-Match.
+
+    Settings: ode.cache.max_entries (0, the default, only adds ETags) and
+    ode.cache.max_age in seconds.
+    """
+    settings = registry.settings
+    max_entries = int(settings.get('ode.cache.max_entries', 0))
+    max_age = int(settings.get('ode.cache.max_age', DEFAULT_MAX_AGE))
+    cache = ResponseCache(max_entries, max_age) if max_entries else None
+
+    def response_cache_tween(request):
+        if request.method != 'GET' or not is_cached_path(request.path):
+            return handler(request)
+        key = cache_key(request)
+        if cache is not None:
+            frozen = cache.get(key)
+            if frozen is not None:
+                return thaw(frozen)
+        entry_generation = generation()
+        response = handler(request)
+        # Streamed bodies are neither hashed nor cached
+        if response.status_code != 200 or \
+                not isinstance(response.app_iter, list):
+            return response
+        response.md5_etag()
+        response.conditional_response = True
+        if cache is not None:
+            # Cache the response once filters of the services have been
+            # applied by their own response callbacks
+            def store(request, response):
+                cache.set(key, freeze(response), entry_generation)
+            request.add_response_callback(store)
+        return response
+
+    return response_cache_tween
@@ -1,11 +1,16 @@
+from collections import deque
 import csv
+import itertools
 import json
 import re
 import six
 from six import StringIO
 
-from ics import Calendar
-from ics.parse import ParseError
+from dateutil.tz import gettz
+from ics import Event
+from ics.icalendar import timezone as parse_timezones
+from ics.parse import ParseError, ContentLine, lines_to_container
+from ics.parse import unfold_lines
 
 
 def default_extractor(attribute):
@@ -50,17 +55,165 @@ def icalendar_to_cstruct(icalendar_event):
     return result
 
 
-def icalendar_extractor(request):
-    items = []
+def iter_text_lines(body):
+    """
+    Yield lines from a string, a file-like object or an iterable of text
+    chunks, without holding more than one line in memory.
+    """
+    if isinstance(body, six.string_types):
+        body = StringIO(body)
+    buffer = u''
+    for chunk in body:
+        buffer += chunk
+        lines = buffer.split(u'\n')
+        buffer = lines.pop()
+        for line in lines:
+            yield line.rstrip(u'\r')
+    if buffer:
+        yield buffer.rstrip(u'\r')
+
+
+def iter_icalendar_blocks(lines):
+    """
+    Yield (name, lines) for each component nested in the calendar, such as
+    VEVENT or VTIMEZONE, one component at a time, and (None, []) at the end
+    of each calendar.
+    """
+    block_name = None
+    block_lines = []
+    depth = 0
+    for line in unfold_lines(lines):
+        content_line = ContentLine.parse(line)
+        if content_line.name == 'BEGIN':
+            depth += 1
+            if depth == 2:
+                block_name = content_line.value.upper()
+        if depth >= 2:
+            block_lines.append(line)
+        if content_line.name == 'END':
+            depth -= 1
+            if depth == 1:
+                yield block_name, block_lines
+                block_name = None
+                block_lines = []
+            elif depth == 0:
+                yield None, []
+            elif depth < 0:
+                raise ParseError("Unexpected line '{}'".format(line))
+    if depth != 0:
+        raise ParseError("Unexpected end of calendar")
+
+
+# Events waiting for their VTIMEZONE, beyond which the oldest is parsed
+# without it
+MAX_PENDING_EVENTS = 1000
+
+
+class TimezoneRegistry(object):
+    """
+    Timezones defined by the VTIMEZONE components of a calendar, with the
+    same interface as ics.Calendar for ics timezone parser.
+    """
+
+    def __init__(self):
+        self._timezones = {}
+
+    def undefined(self, container):
+        """
+        Return the TZIDs used by a component that are neither defined so
+        far nor well known timezone names.
+        """
+        tzids = set()
+        for line in container:
+            if isinstance(line, ContentLine):
+                tzids.update(line.params.get('TZID', []))
+        return set(tzid for tzid in tzids
+                   if tzid not in self._timezones and not gettz(tzid))
+
+
+def icalendar_event_to_item(container, timezones, index, request):
     try:
-        text = request.text
-        calendar = Calendar(text)
-        for icalendar_event in calendar.events:
-            cstruct = icalendar_to_cstruct(icalendar_event)
-            items.append({'data': cstruct})
+        icalendar_event = Event._from_container(container,
+                                                tz=timezones._timezones)
+        return {'data': icalendar_to_cstruct(icalendar_event)}
+    # ics raises a variety of exception types on bogus values
+    except Exception as exc:
+        request.errors.add('body', 'items.%s' % index,
+                           "Invalid iCalendar event: %s" % exc)
+
+
+def iter_icalendar_items(body, request):
+    """
+    Parse an iCalendar body event by event. Invalid events are reported in
+    request.errors and skipped.
+
+    Events using a VTIMEZONE defined further in the body are held back
+    until it is parsed, and yielded after the events that follow them.
+    Timezones not defined by the end of the calendar, or by the time
+    MAX_PENDING_EVENTS are held back, fall back to UTC as with ics.Calendar.
+    """
+    timezones = TimezoneRegistry()
+    # (index, container, undefined TZIDs) of the events held back
+    pending = deque()
+    index = 0
+    try:
+        for name, block_lines in iter_icalendar_blocks(iter_text_lines(body)):
+            if name is None:
+                while pending:
+                    event_index, container, _ = pending.popleft()
+                    item = icalendar_event_to_item(container, timezones,
+                                                   event_index, request)
+                    if item is not None:
+                        yield item
+            elif name == 'VTIMEZONE':
+                try:
+                    parse_timezones(timezones,
+                                    lines_to_container(block_lines))
+                except Exception as exc:
+                    request.errors.add('body', None,
+                                       "Invalid iCalendar timezone: %s" % exc)
+                held_back = deque()
+                for event_index, container, tzids in pending:
+                    tzids = tzids.difference(timezones._timezones)
+                    if tzids:
+                        held_back.append((event_index, container, tzids))
+                        continue
+                    item = icalendar_event_to_item(container, timezones,
+                                                   event_index, request)
+                    if item is not None:
+                        yield item
+                pending = held_back
+            elif name == 'VEVENT':
+                try:
+                    container = lines_to_container(block_lines)[0]
+                except Exception as exc:
+                    request.errors.add(
+                        'body', 'items.%s' % index,
+                        "Invalid iCalendar event: %s" % exc)
+                else:
+                    tzids = timezones.undefined(container)
+                    if tzids:
+                        pending.append((index, container, tzids))
+                        if len(pending) > MAX_PENDING_EVENTS:
+                            event_index, container, _ = pending.popleft()
+                            item = icalendar_event_to_item(
+                                container, timezones, event_index, request)
+                            if item is not None:
+                                yield item
+                    else:
+                        item = icalendar_event_to_item(container, timezones,
+                                                       index, request)
+                        if item is not None:
+                            yield item
+                index += 1
     except ParseError as exc:
+        # Events still held back belong to the invalid calendar
         request.errors.add('body', None,
                            "Invalid iCalendar request body: %s " % exc)
+
+
+def icalendar_extractor(request):
+    items = list(iter_icalendar_items(request.text, request))
     cstruct = {'items': items}
     return cstruct
 
@@ -81,29 +234,191 @@ def data_list_to_dict(data_list):
     return result
 
 
-def json_extractor(request):
-    items = []
-    if request.text:
-        try:
-            json_data = json.loads(request.text)
-        except ValueError as e:
-            request.errors.add(
-                'body', None,
-                "Invalid JSON request body: %s" % e)
+TEXT_CHUNK_SIZE = 64 * 1024
+LEADING_CHARACTER = re.compile(u'[\\s\ufeff]*(\\S)')
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def iter_text_chunks(body, size=TEXT_CHUNK_SIZE):
+    if isinstance(body, six.string_types):
+        return (body[i:i + size] for i in range(0, len(body), size))
+    if hasattr(body, 'read'):
+        # Read text files by size rather than by possibly huge lines
+        return iter(lambda: body.read(size), u'')
+    return body
+
+
+def guess_format(content_type, text):
+    """
+    Guess whether a harvested body is 'json' or 'icalendar', from its
+    Content-Type header or from its first significant character.
+    """
+    if content_type:
+        mimetype = content_type.split(';')[0].strip().lower()
+        if mimetype.endswith('json'):
+            return 'json'
+        if mimetype == 'text/calendar':
+            return 'icalendar'
+    match = LEADING_CHARACTER.match(text)
+    if match and match.group(1) in u'{[':
+        return 'json'
+    return 'icalendar'
+
+
+class JsonStream(object):
+    """
+    Minimal pull parser reading JSON from an iterable of text chunks. Only
+    containers walked through iter_object_keys() and iter_array() are
+    parsed incrementally, other values are decoded as a whole.
+    """
+
+    decoder = json.JSONDecoder()
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = u''
+        self.pos = 0
+
+    def read_chunk(self):
+        for chunk in self.chunks:
+            self.buffer = self.buffer[self.pos:] + chunk
+            self.pos = 0
+            return True
+        return False
+
+    def peek(self):
+        """Return the next significant character, or None at the end"""
+        while True:
+            self.pos = JSON_WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_chunk():
+                return None
+
+    def expect(self, characters):
+        character = self.peek()
+        if character is None or character not in characters:
+            raise ValueError("Expecting one of '{}', got {!r}".format(
+                characters, character))
+        self.pos += 1
+        return character
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self.read_chunk():
+                    raise
+                continue
+            # A number may continue in the next chunk
+            if end == len(self.buffer) and self.read_chunk():
+                continue
+            self.pos = end
+            return value
+
+    def iter_object_keys(self):
+        """
+        Yield the keys of an object. The caller must consume the value of
+        each key before asking for the next one.
+        """
+        self.expect(u'{')
+        if self.peek() == u'}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, six.string_types):
+                raise ValueError("Expecting an object key, got %r" % key)
+            self.expect(u':')
+            yield key
+            if self.expect(u',}') == u'}':
+                return
+
+    def iter_array(self):
+        self.expect(u'[')
+        if self.peek() == u']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(u',]') == u']':
+                return
+
+    def end(self):
+        if self.peek() is not None:
+            raise ValueError("Extra data after JSON document")
+
+
+def collection_item_to_cstruct(item):
+    if not isinstance(item, dict) or not isinstance(item.get('data'), list):
+        raise ValueError("Invalid Collection+JSON item")
+    return {'data': data_list_to_dict(item['data'])}
+
+
+def iter_collection_json(body):
+    """
+    Yield ('template', value) or ('item', value) tuples from a
+    Collection+JSON body, reading collection items one at a time. A
+    ('collection', None) tuple comes first for collections, which may be
+    empty.
+    """
+    stream = JsonStream(iter_text_chunks(body))
+    for key in stream.iter_object_keys():
+        if key == 'template':
+            yield 'template', stream.value()
+        elif key == 'collection':
+            yield 'collection', None
+            for key in stream.iter_object_keys():
+                if key == 'items':
+                    for item in stream.iter_array():
+                        yield 'item', item
+                else:
+                    stream.value()
         else:
-            if 'template' in json_data:
+            stream.value()
+    stream.end()
+
+
+def iter_collection_items(body, request):
+    """
+    Parse a harvested Collection+JSON body item by item. Errors are
+    reported in request.errors.
+    """
+    found = False
+    index = 0
+    try:
+        for kind, value in iter_collection_json(body):
+            found = True
+            if kind == 'collection':
+                continue
+            if kind == 'template':
                 # POST or PUT requests
-                data_dict = data_list_to_dict(json_data['template']['data'])
-                items = [{'data': data_dict}]
-            elif 'collection' in json_data.keys():
-                # harvesting
-                items = []
-                for item in json_data['collection']['items']:
-                    data_dict = data_list_to_dict(item['data'])
-                    items.append({'data': data_dict})
+                try:
+                    yield collection_item_to_cstruct(value)
+                except ValueError:
+                    request.errors.add('body', None,
+                                       "Invalid Collection+JSON input")
+                continue
+            try:
+                cstruct = collection_item_to_cstruct(value)
+            except ValueError as exc:
+                request.errors.add('body', 'items.%s' % index, str(exc))
             else:
-                request.errors.add('body', None,
-                                   "Invalid Collection+JSON input")
+                yield cstruct
+            index += 1
+    except ValueError as exc:
+        request.errors.add('body', None, "Invalid JSON request body: %s" % exc)
+    else:
+        if not found:
+            request.errors.add('body', None, "Invalid Collection+JSON input")
+
+
+def json_extractor(request):
+    items = []
+    if request.text:
+        items = list(iter_collection_items(request.text, request))
     else:
         request.errors.add('body', None, "Empty JSON request body")
     return {'items': items}
@@ -139,20 +454,33 @@ def csv_text(text):
         return text
 
 
-def csv_extractor(request):
-    items = []
-    if request.text:
-        reader = csv.DictReader(StringIO(csv_text(request.text)))
-        for row in reader:
-            data_dict = {
-                key: value.decode('utf-8') if six.PY2 else value
-                for key, value in row.items()
-            }
-            data_dict = csv_format_data_dict(data_dict)
-            items.append({'data': data_dict})
-        if not items:
-            request.errors.add('body', None, "Invalid CSV request body")
-    else:
+def iter_csv_items(body, request):
+    """
+    Parse a CSV body row by row, from a string or an iterable of text
+    lines such as a text file.
+    """
+    if isinstance(body, six.string_types):
+        body = StringIO(body)
+    lines = iter(body)
+    first_line = next(lines, None)
+    if not first_line:
         request.errors.add('body', None, "Empty CSV request body")
+        return
+    reader = csv.DictReader(
+        csv_text(line) for line in itertools.chain([first_line], lines))
+    found = False
+    for row in reader:
+        data_dict = {
+            key: value.decode('utf-8') if six.PY2 else value
+            for key, value in row.items()
+        }
+        found = True
+        yield {'data': csv_format_data_dict(data_dict)}
+    if not found:
+        request.errors.add('body', None, "Invalid CSV request body")
+
+
+def csv_extractor(request):
+    items = list(iter_csv_items(request.text or u'', request))
     cstruct = {'items': items}
     return cstruct
@@ -1,5 +1,19 @@
+import codecs
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+import datetime
+import hashlib
+import itertools
 import json
+import sys
+import tempfile
+import threading
+import time
+from timeit import default_timer
 import requests
+import transaction
+import six
+from six.moves import queue
 from six.moves.urllib.parse import urlparse
 import logging
 
@@ -7,27 +21,35 @@ log = logging.getLogger(__name__)
 
 from colander import Invalid
 from cornice.errors import Errors
+from sqlalchemy import func, or_
 
-from ode.models import DBSession, Source, Event
+from ode.models import DBSession, Source, Event, Location, Media
+from ode.models import DEFAULT_HARVEST_INTERVAL
+from ode.validation.parallel import shared_validator
 from ode.validation.schema import EventSchema
-from ode.deserializers import icalendar_extractor, json_extractor
+from ode.deserializers import iter_icalendar_items, iter_collection_items
+from ode.deserializers import guess_format
+from ode.metrics import write_metrics_file
 
 
 class HarvestRequest(object):
 
-    def __init__(self, text):
+    def __init__(self, text=None):
         self.text = text
         self.errors = Errors()
 
 
+HARVEST_CHUNK_SIZE = 500
+
+
 class EventCstruct(object):
 
     def __init__(self, cstruct):
         self.cstruct = cstruct
 
-    def exists_in_database(self):
-        uid = self.cstruct['data']['id']
-        return DBSession.query(Event).filter_by(id=uid).count() > 0
+    @property
+    def uid(self):
+        return self.cstruct['data'].get('id')
 
     def validate(self):
         schema = EventSchema()
@@ -43,60 +65,619 @@ class EventCstruct(object):
     def append_domain_name_to_uid(self, source):
         self.cstruct['data']['id'] += '@' + urlparse(source.url).hostname
 
-    def update_database(self):
-        event = Event.get_by_id(self.cstruct['data']['id'])
-        appstruct = self.validate()
+    def fingerprint(self):
+        """
+        Hash of the harvested data. The validated appstruct only depends on
+        it, so equal fingerprints mean the stored event is up to date.
+        """
+        data = json.dumps(self.cstruct['data'], sort_keys=True,
+                          default=six.text_type)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def update_database(self, event, appstruct):
         event.update_from_appstruct(appstruct)
-        DBSession.merge(event)
+        return event
 
-    def insert_into_database(self):
-        model_kwargs = self.validate()
-        event = Event(**model_kwargs)
+    def insert_into_database(self, appstruct):
+        event = Event(**appstruct)
         DBSession.add(event)
+        return event
+
+
+class HarvestStats(object):
+    """
+    Outcome of the harvest of a source: event counters and seconds spent in
+    each stage.
+    """
+
+    FAILED = u'failed'
+    NOT_MODIFIED = u'not modified'
+    UNCHANGED = u'unchanged'
+    HARVESTED = u'harvested'
+
+    COUNTERS = ('bytes', 'parsed', 'inserted', 'updated', 'skipped',
+                'invalid', 'deleted')
+    STAGES = ('fetch', 'parse', 'validate', 'persist')
+
+    def __init__(self, source_id=None, url=None):
+        self.source_id = source_id
+        self.url = url
+        self.status = None
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.timings = OrderedDict((stage, 0.0) for stage in self.STAGES)
+        self.seen_uids = set()
+        # Unix time at which the harvest of the source ended
+        self.finished = None
+
+    def __str__(self):
+        return (u"Source {url}: {status}, {inserted} inserted, {updated} "
+                u"updated, {skipped} skipped, {invalid} invalid, {deleted} "
+                u"deleted").format(**self.__dict__)
+
+    @contextmanager
+    def timing(self, stage):
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.timings[stage] += default_timer() - start
+
+    def finish(self):
+        self.finished = time.time()
+
+    def parsed_items(self, items):
+        """
+        Yield items, counting them and timing their parsing
+        """
+        items = iter(items)
+        while True:
+            with self.timing('parse'):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            self.parsed += 1
+            yield item
+
+    def as_dict(self):
+        result = OrderedDict([
+            ('source_id', self.source_id),
+            ('url', self.url),
+            ('status', self.status),
+        ])
+        for name in self.COUNTERS:
+            result[name] = getattr(self, name)
+        result['seconds'] = OrderedDict(
+            (stage, round(seconds, 6))
+            for stage, seconds in self.timings.items())
+        return result
+
+    def to_json(self):
+        return json.dumps(self.as_dict())
+
+
+def expunge_harvested_events():
+    """
+    Detach flushed events and their related objects from the session, so
+    that memory does not grow with the size of the feeds. Sources and
+    tags, reused by the next chunks, are kept.
+    """
+    for obj in list(DBSession.identity_map.values()):
+        if isinstance(obj, (Event, Location, Media)):
+            DBSession.expunge(obj)
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def harvest_cstruct(cstruct, source, chunk_size=HARVEST_CHUNK_SIZE,
+                    stats=None):
+    """
+    Insert or update harvested events, chunk by chunk, and return the
+    HarvestStats of the source, with the uids found in the feed.
 
+    Events whose fingerprint did not change since the previous harvest of
+    the source are skipped without being validated. Existing events and
+    tags of a chunk are loaded with a single query each and the resulting
+    inserts and updates are sent in one flush per chunk, after which the
+    events are expunged from the session.
+    """
+    if stats is None:
+        stats = HarvestStats(source.id, source.url)
+    with stats.timing('persist'):
+        fingerprints = Event.harvested_fingerprints(source.id)
+    seen_uids = stats.seen_uids
+    items = stats.parsed_items(cstruct['items'])
+    for chunk in chunked(items, chunk_size):
+        with stats.timing('validate'):
+            validated = validate_chunk(chunk, source, fingerprints,
+                                       seen_uids, stats)
+        with stats.timing('persist'):
+            persist_chunk(validated, stats)
+    return stats
 
-def harvest_cstruct(cstruct, source):
-    for item_cstruct in cstruct['items']:
+
+def validate_chunk(chunk, source, fingerprints, seen_uids, stats):
+    """
+    Return (event_cstruct, appstruct) pairs of the changed and valid events
+    of a chunk.
+    """
+    event_cstructs = []
+    for item_cstruct in chunk:
         item_cstruct['data']['provider_id'] = source.provider_id
         event_cstruct = EventCstruct(item_cstruct)
         if event_cstruct.has_uid_without_domain_name():
             event_cstruct.append_domain_name_to_uid(source)
-        if event_cstruct.exists_in_database():
-            event_cstruct.update_database()
-        else:
-            try:
-                event_cstruct.insert_into_database()
-            except Invalid:
+        fingerprint = event_cstruct.fingerprint()
+        uid = event_cstruct.uid
+        if uid:
+            seen_uids.add(uid)
+            if fingerprints.get(uid) == fingerprint:
+                stats.skipped += 1
                 continue
+        event_cstructs.append((event_cstruct, fingerprint))
+    validated = []
+    # Feeds larger than the parallel threshold are validated in worker
+    # processes from the chunk reaching it on
+    appstructs = validate_events(
+        [event_cstruct for event_cstruct, _ in event_cstructs],
+        shared_validator(stats.parsed))
+    for (event_cstruct, fingerprint), appstruct in zip(event_cstructs,
+                                                       appstructs):
+        if appstruct is None:
+            stats.invalid += 1
+            continue
+        appstruct.update(harvest_source_id=source.id,
+                         fingerprint=fingerprint, deleted=False)
+        validated.append((event_cstruct, appstruct))
+    return validated
 
 
-def harvest():
-    query = DBSession.query(Source)
-    for source in query:
-        error_message = u"Failed to harvest source {id} with URL {url}".format(
-            id=source.id,
-            url=source.url,
-        )
+def validate_events(event_cstructs, validator=None):
+    """
+    Yield the appstruct of each event cstruct, None for invalid ones.
+    """
+    if validator is not None:
+        cstructs = [event_cstruct.cstruct['data']
+                    for event_cstruct in event_cstructs]
+        for _, appstruct, _ in validator.validate(cstructs, EventSchema):
+            yield appstruct
+        return
+    for event_cstruct in event_cstructs:
         try:
-            response = requests.get(source.url)
-            if response.status_code != 200:
-                continue
-            content = response.text
-            try:
-                json.loads(content)
-                is_json = True
-            except ValueError:
-                is_json = False
-            request = HarvestRequest(content)
-            if is_json:
-                cstruct = json_extractor(request)
+            yield event_cstruct.validate()
+        except Invalid:
+            yield None
+
+
+def persist_chunk(validated, stats):
+    Event.preload_related([appstruct for _, appstruct in validated])
+    events = Event.get_by_ids(
+        [event_cstruct.uid for event_cstruct, _ in validated
+         if event_cstruct.uid], Event.eager_loading_options())
+    Event.load_media(list(events.values()))
+    for event_cstruct, appstruct in validated:
+        event = events.get(event_cstruct.uid)
+        if event is None:
+            event = event_cstruct.insert_into_database(appstruct)
+            events[event.id] = event
+            stats.inserted += 1
+        else:
+            event_cstruct.update_database(event, appstruct)
+            stats.updated += 1
+    DBSession.flush()
+    expunge_harvested_events()
+
+
+def delete_missing_events(source, seen_uids):
+    """
+    Mark the events harvested from a source that are not in its feed
+    anymore as deleted, and return their count.
+    """
+    missing = set(Event.harvested_fingerprints(source.id)) - seen_uids
+    for uids in chunked(sorted(missing), HARVEST_CHUNK_SIZE):
+        DBSession.query(Event).filter(Event.id.in_(uids)).update(
+            {Event.deleted: True}, synchronize_session=False)
+    return len(missing)
+
+
+FETCH_TIMEOUT = 60
+MAX_WORKERS = 8
+MAX_PER_HOST = 2
+
+
+FETCH_CHUNK_SIZE = 64 * 1024
+# Larger feed bodies are spooled to disk
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+class FeedBody(object):
+    """
+    Body of a fetched feed, spooled to a temporary file and hashed as it is
+    downloaded, then read back as text chunk by chunk for parsing.
+    """
+
+    def __init__(self, response):
+        self.file = tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE)
+        self.encoding = response.encoding or 'utf-8'
+        try:
+            codecs.lookup(self.encoding)
+        except LookupError:
+            self.encoding = 'utf-8'
+        self.size = 0
+        sha1 = hashlib.sha1()
+        for chunk in response.iter_content(FETCH_CHUNK_SIZE):
+            sha1.update(chunk)
+            self.file.write(chunk)
+            self.size += len(chunk)
+        self.hash = sha1.hexdigest()
+
+    def iter_text(self):
+        self.file.seek(0)
+        decoder = codecs.getincrementaldecoder(self.encoding)('replace')
+        while True:
+            chunk = self.file.read(FETCH_CHUNK_SIZE)
+            text = decoder.decode(chunk, final=not chunk)
+            if text:
+                yield text
+            if not chunk:
+                return
+
+    def close(self):
+        self.file.close()
+
+
+def fetch(url, headers=None):
+    """
+    Fetch a source URL. The body of a successful response is downloaded to
+    response.body, a FeedBody, and the connection released.
+    """
+    response = requests.get(url, headers=headers, timeout=FETCH_TIMEOUT,
+                            stream=True)
+    try:
+        if response.status_code == 200:
+            response.body = FeedBody(response)
+    finally:
+        response.close()
+    return response
+
+
+def interleave_by_host(sources):
+    """
+    Order sources round-robin across hosts, so that workers waiting for a
+    busy host do not starve the other ones.
+    """
+    by_host = {}
+    hosts = []
+    for source in sources:
+        host = urlparse(source.url).hostname
+        if host not in by_host:
+            by_host[host] = []
+            hosts.append(host)
+        by_host[host].append(source)
+    result = []
+    while hosts:
+        for host in list(hosts):
+            result.append(by_host[host].pop(0))
+            if not by_host[host]:
+                hosts.remove(host)
+    return result
+
+
+class SourceFetcher(object):
+    """
+    Fetch source URLs from a bounded pool of worker threads.
+
+    Workers only perform HTTP requests: results are handed back to the
+    calling thread, which keeps ownership of the database session. At most
+    max_workers responses are fetched ahead of the calling thread, so that
+    feeds do not pile up in memory when harvesting is slower than fetching.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS, max_per_host=MAX_PER_HOST):
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+
+    def fetch_all(self, sources):
+        """
+        Yield (source, response, exc_info, seconds) tuples in completion
+        order, seconds being the time spent fetching the source.
+
+        When the caller stops early, eg. on an exception, remaining fetches
+        are cancelled and the bodies of responses not yielded are closed.
+        """
+        jobs = queue.Queue()
+        results = queue.Queue()
+        # Released each time the calling thread takes a result
+        pending = threading.Semaphore(self.max_workers)
+        # Guards results against workers putting them once cancelled
+        lock = threading.Lock()
+        cancelled = threading.Event()
+        host_slots = {}
+        for source in interleave_by_host(sources):
+            host = urlparse(source.url).hostname
+            if host not in host_slots:
+                host_slots[host] = threading.BoundedSemaphore(
+                    self.max_per_host)
+            jobs.put((source, source.url, source.conditional_headers(),
+                      host_slots[host]))
+        job_count = jobs.qsize()
+
+        def worker():
+            while True:
+                try:
+                    source, url, headers, host_slot = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                pending.acquire()
+                if cancelled.is_set():
+                    return
+                with host_slot:
+                    start = default_timer()
+                    try:
+                        response = fetch(url, headers)
+                    except Exception:
+                        result = (source, None, sys.exc_info(),
+                                  default_timer() - start)
+                    else:
+                        result = (source, response, None,
+                                  default_timer() - start)
+                with lock:
+                    if cancelled.is_set():
+                        close_response(result[1])
+                        return
+                    results.put(result)
+
+        worker_count = min(self.max_workers, job_count)
+        for _ in range(worker_count):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+        try:
+            for _ in range(job_count):
+                result = results.get()
+                pending.release()
+                yield result
+        finally:
+            with lock:
+                cancelled.set()
+                while not results.empty():
+                    close_response(results.get_nowait()[1])
+            # Wake up workers waiting for a slot, so that they exit
+            for _ in range(worker_count):
+                pending.release()
+
+
+def close_response(response):
+    body = getattr(response, 'body', None)
+    if body is not None:
+        body.close()
+
+
+def harvest_response(source, response, chunk_size=HARVEST_CHUNK_SIZE,
+                     stats=None):
+    request = HarvestRequest()
+    chunks = response.body.iter_text()
+    first_chunk = next(chunks, u'')
+    content = itertools.chain([first_chunk], chunks)
+    content_type = response.headers.get('Content-Type')
+    if guess_format(content_type, first_chunk) == 'json':
+        items = iter_collection_items(content, request)
+    else:
+        items = iter_icalendar_items(content, request)
+    stats = harvest_cstruct({'items': items}, source, chunk_size, stats)
+    stats.invalid += len([error for error in request.errors
+                          if (error['name'] or '').startswith('items.')])
+    if not request.errors:
+        # Events of a feed that could not be fully read are not missing
+        with stats.timing('persist'):
+            stats.deleted = delete_missing_events(source, stats.seen_uids)
+    return request.errors
+
+
+def error_message(source):
+    return u"Failed to harvest source {id} with URL {url}".format(
+        id=source.id,
+        url=source.url,
+    )
+
+
+def harvest_source(source, response, stats=None,
+                   chunk_size=HARVEST_CHUNK_SIZE):
+    """
+    Harvest the response fetched for a source, recording the outcome in
+    stats. Return False when the source could not be harvested.
+    """
+    if stats is None:
+        stats = HarvestStats(source.id, source.url)
+    if response.status_code == 304:
+        log.info(u"Source {} not modified".format(source.url))
+        stats.status = HarvestStats.NOT_MODIFIED
+        return True
+    if response.status_code != 200:
+        stats.status = HarvestStats.FAILED
+        return False
+    try:
+        stats.bytes = response.body.size
+        new_hash = response.body.hash
+        if source.content_hash == new_hash:
+            log.info(u"Source {} content unchanged".format(source.url))
+            stats.status = HarvestStats.UNCHANGED
+            # Still worth a 304 next time, eg. when the server renewed them
+            source.update_validators(response.headers)
+            return True
+        errors = harvest_response(source, response, chunk_size, stats)
+    finally:
+        response.body.close()
+    source.update_validators(response.headers)
+    source.content_hash = new_hash
+    stats.status = HarvestStats.HARVESTED
+    if errors:
+        log.warning(error_message(source), exc_info=True)
+        for error in errors:
+            log.warning(error['description'])
+    return True
+
+
+def harvest(max_workers=MAX_WORKERS, max_per_host=MAX_PER_HOST,
+            chunk_size=HARVEST_CHUNK_SIZE):
+    """
+    Harvest all sources in the current transaction, each one within a
+    savepoint so that a failing source is rolled back alone. Return the
+    HarvestStats of the sources.
+    """
+    sources = DBSession.query(Source).all()
+    fetcher = SourceFetcher(max_workers, max_per_host)
+    all_stats = []
+    with closing(fetcher.fetch_all(sources)) as fetched:
+        for source, response, exc_info, seconds in fetched:
+            stats = HarvestStats(source.id, source.url)
+            stats.timings['fetch'] = seconds
+            all_stats.append(stats)
+            if exc_info is not None:
+                log.warning(error_message(source), exc_info=exc_info)
+                stats.status = HarvestStats.FAILED
             else:
-                cstruct = icalendar_extractor(request)
-            harvest_cstruct(cstruct, source)
-            if request.errors:
-                log.warning(error_message, exc_info=True)
-                for error in request.errors:
-                    log.warning(error['description'])
-        except Exception:
-            log.warning(error_message, exc_info=True)
+                savepoint = DBSession.begin_nested()
+                try:
+                    harvest_source(source, response, stats, chunk_size)
+                    savepoint.commit()
+                except Exception:
+                    savepoint.rollback()
+                    log.warning(error_message(source), exc_info=True)
+                    stats.status = HarvestStats.FAILED
+            stats.finish()
+            log.info(stats.to_json())
     DBSession.flush()
+    return all_stats
+
+
+POLL_INTERVAL = 60
+
+
+class HarvestScheduler(object):
+    """
+    Harvest each source when it is due, in a transaction of its own.
+
+    Due sources are fetched from a pool of worker threads and harvested
+    one by one as their responses arrive. Failing sources are retried
+    with an exponential backoff, without affecting the other ones.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS, max_per_host=MAX_PER_HOST,
+                 default_interval=DEFAULT_HARVEST_INTERVAL,
+                 poll_interval=POLL_INTERVAL, chunk_size=HARVEST_CHUNK_SIZE,
+                 metrics_file=None):
+        self.fetcher = SourceFetcher(max_workers, max_per_host)
+        self.chunk_size = chunk_size
+        self.default_interval = default_interval
+        self.poll_interval = poll_interval
+        self.metrics_file = metrics_file
+        self.latest_stats = OrderedDict()
+
+    @staticmethod
+    def now():
+        return datetime.datetime.utcnow()
+
+    def due_sources(self, now):
+        """
+        Return the sources to harvest, detached from the session so that
+        they can be read from once the transaction is over.
+        """
+        with transaction.manager:
+            sources = DBSession.query(Source).filter(or_(
+                Source.next_run.is_(None), Source.next_run <= now)).all()
+            DBSession.expunge_all()
+        return sources
+
+    def harvest_due_sources(self):
+        """
+        Harvest all due sources once and return their HarvestStats.
+        """
+        sources = self.due_sources(self.now())
+        all_stats = []
+        with closing(self.fetcher.fetch_all(sources)) as fetched:
+            for source, response, exc_info, seconds in fetched:
+                stats = HarvestStats(source.id, source.url)
+                stats.timings['fetch'] = seconds
+                all_stats.append(stats)
+                self.latest_stats[source.id] = stats
+                if exc_info is None:
+                    try:
+                        with transaction.manager:
+                            self.harvest_source(source.id, response, stats)
+                        stats.finish()
+                        log.info(stats.to_json())
+                        continue
+                    except Exception:
+                        exc_info = sys.exc_info()
+                log.warning(error_message(source), exc_info=exc_info)
+                stats.status = HarvestStats.FAILED
+                stats.finish()
+                log.info(stats.to_json())
+                with transaction.manager:
+                    self.record_failure(source.id)
+        return all_stats
+
+    def harvest_source(self, source_id, response, stats):
+        source = DBSession.query(Source).get(source_id)
+        if source is None:
+            # Deleted while being fetched
+            close_response(response)
+            return
+        if harvest_source(source, response, stats, self.chunk_size):
+            source.schedule_success(self.now(), self.default_interval)
+        else:
+            source.schedule_failure(self.now(), self.default_interval)
+
+    def record_failure(self, source_id):
+        source = DBSession.query(Source).get(source_id)
+        if source is not None:
+            source.schedule_failure(self.now(), self.default_interval)
+
+    def forget_deleted_sources(self):
+        with transaction.manager:
+            source_ids = set(
+                source_id for source_id, in DBSession.query(Source.id))
+        for source_id in list(self.latest_stats):
+            if source_id not in source_ids:
+                del self.latest_stats[source_id]
+
+    def seconds_until_next_run(self):
+        # New sources, without a next run, are picked up by the next poll
+        with transaction.manager:
+            next_run = DBSession.query(func.min(Source.next_run)).scalar()
+        if next_run is None:
+            return self.poll_interval
+        delay = (next_run - self.now()).total_seconds()
+        return max(0, min(delay, self.poll_interval))
+
+    def run_once(self):
+        """
+        Harvest due sources and return the number of seconds to wait
+        before the next round.
+        """
+        if self.harvest_due_sources() and self.metrics_file:
+            # Sources not due in this round keep their latest metrics
+            self.forget_deleted_sources()
+            write_metrics_file(self.latest_stats.values(), self.metrics_file)
+        return self.seconds_until_next_run()
+
+    def run(self):
+        while True:
+            try:
+                delay = self.run_once()
+            except Exception:
+                # Eg. the database being unreachable for a while
+                log.error(u"Harvest round failed", exc_info=True)
+                delay = self.poll_interval
+            time.sleep(delay)
@@ -0,0 +1,170 @@
+"""
+Import of event files into the database, without going through the web API.
+"""
+import io
+import itertools
+import logging
+import os
+from timeit import default_timer
+
+import transaction
+
+from ode.deserializers import iter_csv_items, iter_collection_items
+from ode.deserializers import iter_icalendar_items
+from ode.harvesting import HarvestRequest
+from ode.models import DBSession, Event
+from ode.validation.parallel import ParallelValidator, format_messages
+from ode.validation.schema import EventSchema
+
+log = logging.getLogger(__name__)
+
+
+IMPORT_BATCH_SIZE = 1000
+
+
+ITEM_READERS = {
+    '.csv': iter_csv_items,
+    '.ics': iter_icalendar_items,
+    '.ical': iter_icalendar_items,
+    '.json': iter_collection_items,
+}
+
+
+def iter_files(paths):
+    """
+    Yield the importable files of the given paths, walking directories in
+    name order so that offsets stay valid across runs.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for directory, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if os.path.splitext(filename)[1].lower() in ITEM_READERS:
+                    yield os.path.join(directory, filename)
+
+
+def iter_file_items(path):
+    """
+    Yield the event cstructs of a file. Unreadable events are logged and
+    skipped.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in ITEM_READERS:
+        log.warning(u"Skipping {}: unknown file type".format(path))
+        return
+    request = HarvestRequest()
+    # Parsed as it is read, files may not fit in memory
+    with io.open(path, encoding='utf-8') as import_file:
+        for item in ITEM_READERS[extension](import_file, request):
+            yield item['data']
+    for error in request.errors:
+        log.warning(u"{}: {}".format(path, error['description']))
+
+
+class ImportStats(object):
+    """
+    Progress of an import. position is the offset to resume from.
+    """
+
+    def __init__(self, position=0):
+        self.position = position
+        self.inserted = 0
+        self.updated = 0
+        self.invalid = 0
+        self.rejected = 0
+        self.start = default_timer()
+
+    def __str__(self):
+        elapsed = default_timer() - self.start
+        written = self.inserted + self.updated
+        return (u"Offset {position}: {inserted} inserted, {updated} "
+                u"updated, {invalid} invalid, {rejected} rejected, "
+                u"{rate:.0f} events/s").format(
+                    rate=written / elapsed if elapsed else 0, **self.__dict__)
+
+
+def write_batch(appstructs, provider_id, stats):
+    """
+    Insert or update validated events in a single flush. Events belonging
+    to another provider are left untouched.
+    """
+    Event.preload_related(appstructs)
+    events = Event.get_by_ids([appstruct['id'] for appstruct in appstructs
+                               if 'id' in appstruct],
+                              Event.eager_loading_options())
+    Event.load_media(list(events.values()))
+    for appstruct in appstructs:
+        event = events.get(appstruct.get('id'))
+        if event is None:
+            event = Event(**appstruct)
+            DBSession.add(event)
+            events[event.id] = event
+            stats.inserted += 1
+        elif event.provider_id != provider_id:
+            log.warning(u"Event {} belongs to another provider".format(
+                event.id))
+            stats.rejected += 1
+        else:
+            event.update_from_appstruct(appstruct)
+            stats.updated += 1
+    DBSession.flush()
+
+
+class EventImporter(object):
+    """
+    Import events of files for a provider, validated in worker processes
+    and written batch_size events per transaction.
+
+    Events are numbered across files in the order they are read. Importing
+    from an offset skips the events before it, eg. to resume an import
+    from the offset reported after its last committed batch.
+    """
+
+    def __init__(self, provider_id, processes=None,
+                 batch_size=IMPORT_BATCH_SIZE, offset=0, progress=None):
+        self.provider_id = provider_id
+        self.processes = processes
+        self.batch_size = batch_size
+        self.offset = offset
+        self.progress = progress
+
+    def iter_cstructs(self, paths):
+        cstructs = itertools.chain.from_iterable(
+            iter_file_items(path) for path in iter_files(paths))
+        for cstruct in itertools.islice(cstructs, self.offset, None):
+            cstruct['provider_id'] = self.provider_id
+            yield cstruct
+
+    def commit(self, appstructs, stats, position):
+        with transaction.manager:
+            write_batch(appstructs, self.provider_id, stats)
+        stats.position = position
+        if self.progress is not None:
+            self.progress(stats)
+
+    def run(self, paths):
+        """
+        Import the files or directories of paths and return ImportStats.
+        """
+        stats = ImportStats(self.offset)
+        appstructs = []
+        position = self.offset
+        with ParallelValidator(self.processes) as validator:
+            for index, appstruct, errors in validator.validate(
+                    self.iter_cstructs(paths), EventSchema, self.offset):
+                position = index + 1
+                if errors:
+                    stats.invalid += 1
+                    for name, messages in errors:
+                        log.warning(u"Event {} {}: {}".format(
+                            index, name, format_messages(messages)))
+                    continue
+                appstructs.append(appstruct)
+                if len(appstructs) == self.batch_size:
+                    self.commit(appstructs, stats, position)
+                    appstructs = []
+        self.commit(appstructs, stats, position)
+        return stats
@@ -0,0 +1,102 @@
+"""
+Harvest metrics, as Prometheus text exposition and as a summary table.
+
+The metrics file is meant to be collected by the textfile collector of the
+Prometheus node exporter. It is written to a temporary file first and then
+renamed, so that the collector never reads a partial file.
+"""
+import os
+
+
+PREFIX = 'ode_harvest'
+
+EVENT_COUNTERS = ('parsed', 'inserted', 'updated', 'skipped', 'invalid',
+                  'deleted')
+
+TABLE_COLUMNS = (
+    ('source', 'url'),
+    ('status', 'status'),
+    ('bytes', 'bytes'),
+) + tuple((name, name) for name in EVENT_COUNTERS)
+
+
+def escape_label(value):
+    return (u'%s' % value).replace('\\', '\\\\').replace('\n', '\\n') \
+        .replace('"', '\\"')
+
+
+def format_labels(labels):
+    return u','.join(u'%s="%s"' % (name, escape_label(value))
+                     for name, value in labels)
+
+
+def prometheus_text(all_stats):
+    """
+    Return the metrics of the latest harvest of each source in the
+    Prometheus text format.
+    """
+    metrics = [
+        ('bytes', 'Bytes fetched from the source', []),
+        ('events', 'Events of the source by outcome', []),
+        ('stage_seconds', 'Seconds spent in each harvest stage', []),
+        ('success', 'Whether the source was harvested', []),
+        ('timestamp_seconds', 'Time the harvest of the source ended', []),
+    ]
+    samples = dict((name, values) for name, _, values in metrics)
+    for stats in all_stats:
+        source = [('source', stats.url)]
+        samples['bytes'].append((source, stats.bytes))
+        for name in EVENT_COUNTERS:
+            samples['events'].append(
+                (source + [('outcome', name)], getattr(stats, name)))
+        for stage, seconds in stats.timings.items():
+            samples['stage_seconds'].append(
+                (source + [('stage', stage)], seconds))
+        samples['success'].append(
+            (source, int(stats.status != stats.FAILED)))
+        if stats.finished is not None:
+            samples['timestamp_seconds'].append((source, stats.finished))
+
+    lines = []
+    for name, description, values in metrics:
+        name = '%s_%s' % (PREFIX, name)
+        lines.append(u'# HELP %s %s' % (name, description))
+        lines.append(u'# TYPE %s gauge' % name)
+        for labels, value in values:
+            lines.append(u'%s{%s} %s' % (name, format_labels(labels),
+                                         repr(value)))
+    return u'\n'.join(lines) + u'\n'
+
+
+def write_metrics_file(all_stats, path):
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as metrics_file:
+        metrics_file.write(prometheus_text(all_stats).encode('utf-8'))
+    os.rename(temporary_path, path)
+
+
+def summary_table(all_stats):
+    """
+    Return a plain text table of the counters and stage timings of each
+    source.
+    """
+    all_stats = list(all_stats)
+    stages = all_stats[0].STAGES if all_stats else ()
+    header = [title for title, _ in TABLE_COLUMNS] + \
+        [u'%s (s)' % stage for stage in stages]
+    rows = [header]
+    for stats in all_stats:
+        row = [u'%s' % getattr(stats, attribute)
+               for _, attribute in TABLE_COLUMNS]
+        row.extend(u'%.3f' % seconds for seconds in stats.timings.values())
+        rows.append(row)
+    widths = [max(len(row[index]) for row in rows)
+              for index in range(len(header))]
+    lines = []
+    for row in rows:
+        # Left align the source and status, right align numbers
+        cells = [cell.ljust(width) if index < 2 else cell.rjust(width)
+                 for index, (cell, width) in enumerate(zip(row, widths))]
+        lines.append(u'  '.join(cells).rstrip())
+    lines.insert(1, u'  '.join(u'-' * width for width in widths))
+    return u'\n'.join(lines)
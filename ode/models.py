@@ -1,13 +1,21 @@
+from datetime import timedelta
+
 import pyramid
 from sqlalchemy import (Column, Integer, Unicode, DateTime, ForeignKey,
                         Boolean, String, UnicodeText)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy.orm import relationship
-from sqlalchemy import Table
+from sqlalchemy.orm import scoped_session, sessionmaker, object_session
+from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy import inspect
+from sqlalchemy import Table, Index, false
+from sqlalchemy.event import listens_for
 from uuid import uuid1
 from zope.sqlalchemy import ZopeTransactionExtension
 
+from ode.serializers import DataSerializer, EventSerializer
+from ode.serializers import data_dict_to_list
 from ode.urls import absolute_url
 
 
@@ -16,6 +24,24 @@ DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
 
 SAFE_MAX_LENGTH = 1000
 TAG_MAX_LENGTH = 50
+DEFAULT_HARVEST_INTERVAL = 3600
+MAX_HARVEST_BACKOFF = 24 * 3600
+
+
+def tag_cache():
+    """
+    Mapping of tag names to Tag objects, scoped to the current session
+    transaction.
+    """
+    return DBSession().info.setdefault('tag_cache', {})
+
+
+@listens_for(DBSession, 'after_transaction_end')
+def clear_tag_cache(session, transaction):
+    # Subtransactions end on every flush, keep the cache until the real
+    # transaction or a savepoint ends.
+    if transaction.parent is None or transaction.nested:
+        session.info.pop('tag_cache', None)
 
 
 def default_column():
@@ -25,17 +51,30 @@ def default_column():
 class BaseModel(object):
 
     HIDDEN_FIELDS = ('location_id', 'event_id')
+    SERIALIZER_CLASS = DataSerializer
 
     id = Column(Integer, primary_key=True)
 
+    @classmethod
+    def data_serializer(cls):
+        """
+        Return the serializer of this model, built on first use.
+        """
+        serializer = cls.__dict__.get('_data_serializer')
+        if serializer is None:
+            serializer = cls.SERIALIZER_CLASS(cls)
+            cls._data_serializer = serializer
+        return serializer
+
+    def to_data_dict(self):
+        return self.data_serializer()(self)
+
     def to_data_list(self):
-        result = []
-        for column in self.__class__.__mapper__.columns:
-            if column.name in self.HIDDEN_FIELDS:
-                continue
-            result.append({'name': column.name,
-                           'value': getattr(self, column.name)})
-        return result
+        """
+        Compatibility only: the name/value list of the former serializer,
+        converted from to_data_dict.
+        """
+        return data_dict_to_list(self.to_data_dict())
 
     @classmethod
     def list_to_objects(cls, appstruct_list):
@@ -48,6 +87,13 @@ class BaseModel(object):
     def from_appstruct(cls, appstruct):
         return cls(**appstruct)
 
+    @classmethod
+    def preload_related(cls, appstructs):
+        """
+        Resolve objects related to several deserialized items at once,
+        before they get instanciated one by one.
+        """
+
     def update_from_appstruct(self, appstruct):
         uid = appstruct.pop('id', None)
         if uid:
@@ -63,7 +109,7 @@ class BaseModel(object):
 
     def to_item(self, request):
         return {
-            "data": self.to_data_list(),
+            "data": self.to_data_dict(),
             'href': self.absolute_url(request),
         }
 
@@ -75,12 +121,32 @@ class BaseModel(object):
     def get_by_id(cls, id):
         return DBSession.query(cls).filter_by(id=id).first()
 
+    @classmethod
+    def get_by_ids(cls, ids, options=()):
+        """
+        Return a dictionary mapping ids to model objects, using a single
+        query with the given loader options.
+        """
+        if not ids:
+            return {}
+        query = DBSession.query(cls).options(*options).filter(
+            cls.id.in_(ids))
+        return dict((obj.id, obj) for obj in query)
+
 
 Base = declarative_base(cls=BaseModel)
 
 
 class Media(Base):
     __tablename__ = 'media'
+    __table_args__ = (
+        Index('ix_media_event_id', 'event_id'),
+    )
+    EVENT_ATTRIBUTES = {
+        'image': 'images',
+        'sound': 'sounds',
+        'video': 'videos',
+    }
     event_id = Column(Unicode(SAFE_MAX_LENGTH), ForeignKey('events.id'))
     license = Column(Unicode(20))
     url = default_column()
@@ -118,7 +184,9 @@ tag_association = Table(
     'tag_association', Base.metadata,
     Column('id', Integer, primary_key=True),
     Column('tag_id', Integer, ForeignKey('tags.id')),
-    Column('event_id', Unicode(SAFE_MAX_LENGTH), ForeignKey('events.id'))
+    Column('event_id', Unicode(SAFE_MAX_LENGTH), ForeignKey('events.id')),
+    Index('ix_tag_association_event_id_tag_id', 'event_id', 'tag_id'),
+    Index('ix_tag_association_tag_id', 'tag_id'),
 )
 
 
@@ -126,7 +194,9 @@ category_association = Table(
     'category_association', Base.metadata,
     Column('id', Integer, primary_key=True),
     Column('tag_id', Integer, ForeignKey('tags.id')),
-    Column('event_id', Unicode(SAFE_MAX_LENGTH), ForeignKey('events.id'))
+    Column('event_id', Unicode(SAFE_MAX_LENGTH), ForeignKey('events.id')),
+    Index('ix_category_association_event_id_tag_id', 'event_id', 'tag_id'),
+    Index('ix_category_association_tag_id', 'tag_id'),
 )
 
 
@@ -136,18 +206,49 @@ class Tag(Base):
 
     @classmethod
     def from_appstruct(cls, appstruct):
-        obj = DBSession.query(cls).filter_by(name=appstruct).first()
+        cache = tag_cache()
+        obj = cache.get(appstruct)
         if obj is None:
-            obj = cls(name=appstruct)
-            DBSession.add(obj)
+            obj = DBSession.query(cls).filter_by(name=appstruct).first()
+            if obj is None:
+                obj = cls(name=appstruct)
+                DBSession.add(obj)
+            cache[appstruct] = obj
         return obj
 
+    @classmethod
+    def preload(cls, names):
+        """
+        Resolve tag names with a single query and create the missing ones,
+        so that subsequent from_appstruct() calls are served from the cache.
+        """
+        cache = tag_cache()
+        missing = set(names).difference(cache)
+        if not missing:
+            return
+        query = DBSession.query(cls).filter(cls.name.in_(missing))
+        for obj in query:
+            cache[obj.name] = obj
+        new_objects = [cls(name=name) for name in missing
+                       if name not in cache]
+        DBSession.add_all(new_objects)
+        for obj in new_objects:
+            cache[obj.name] = obj
+
     def update_from_appstruct_item(self, key, value):
         self.name = value
 
 
 class Event(Base):
     __tablename__ = 'events'
+    __table_args__ = (
+        # Time window filters of the events collection
+        Index('ix_events_start_time_end_time', 'start_time', 'end_time'),
+        Index('ix_events_end_time', 'end_time'),
+        Index('ix_events_provider_id_start_time', 'provider_id',
+              'start_time'),
+        Index('ix_events_harvest_source_id', 'harvest_source_id'),
+    )
 
     id = Column(Unicode(SAFE_MAX_LENGTH), unique=True, primary_key=True)
 
@@ -174,12 +275,20 @@ class Event(Base):
     publication_end = Column(DateTime(timezone=False))
 
     location = relationship('Location', uselist=False)
-    sounds = relationship('Sound')
-    videos = relationship('Video')
-    images = relationship('Image')
-    tags = relationship('Tag', secondary=tag_association, backref="events_tag")
+    sounds = relationship('Sound', order_by='Sound.id')
+    videos = relationship('Video', order_by='Video.id')
+    images = relationship('Image', order_by='Image.id')
+    # Association rows are written from the event side only, in the order
+    # of the event collections
+    tags = relationship('Tag', secondary=tag_association,
+                        backref=backref('events_tag', viewonly=True),
+                        sync_backref=False,
+                        order_by=tag_association.c.id)
     categories = relationship('Tag', secondary=category_association,
-                              backref="events_category")
+                              backref=backref('events_category',
+                                              viewonly=True),
+                              sync_backref=False,
+                              order_by=category_association.c.id)
 
     press_contact_email = default_column()
     press_contact_name = default_column()
@@ -188,48 +297,137 @@ class Event(Base):
     ticket_contact_name = default_column()
     ticket_contact_phone_number = default_column()
 
+    # Harvesting bookkeeping: source the event was last harvested from,
+    # fingerprint of its harvested data, and whether the source dropped it
+    harvest_source_id = Column(
+        Integer, ForeignKey('sources.id', ondelete='SET NULL'))
+    fingerprint = Column(String(40))
+    deleted = Column(Boolean(), nullable=False, default=False,
+                     server_default=false())
+
+    HIDDEN_FIELDS = ('harvest_source_id', 'fingerprint', 'deleted')
+    SERIALIZER_CLASS = EventSerializer
+
     def __init__(self, *args, **kwargs):
         if 'id' not in kwargs:
             kwargs['id'] = self.make_uid()
         self.update_from_appstruct(kwargs)
 
+    @classmethod
+    def eager_loading_options(cls):
+        return [
+            joinedload(cls.location),
+            selectinload(cls.tags),
+            selectinload(cls.categories),
+        ]
+
+    @classmethod
+    def load_media(cls, events):
+        """
+        Populate images, videos and sounds of several events with a single
+        polymorphic query.
+        """
+        events = [event for event in events
+                  if 'images' in inspect(event).unloaded]
+        if not events:
+            return
+        media_by_event = dict(
+            (event.id, dict((attrname, []) for attrname
+                            in Media.EVENT_ATTRIBUTES.values()))
+            for event in events
+        )
+        session = object_session(events[0])
+        query = session.query(Media).filter(
+            Media.event_id.in_(list(media_by_event))).order_by(Media.id)
+        for media in query:
+            attrname = Media.EVENT_ATTRIBUTES.get(media.type)
+            if attrname:
+                media_by_event[media.event_id][attrname].append(media)
+        for event in events:
+            for attrname, values in media_by_event[event.id].items():
+                set_committed_value(event, attrname, values)
+
+    @classmethod
+    def rows_query(cls):
+        """
+        Query plain rows of event and location columns, for read-only
+        access without instanciating events. Rows start with the serialized
+        event columns, followed by location columns then hidden columns.
+        Deleted events are left out.
+        """
+        table = cls.__table__
+        location_columns = [
+            getattr(Location, name).label('location_' + name)
+            for name in cls.SERIALIZER_CLASS.LOCATION_FIELDS
+        ]
+        columns = [column for column in table.columns
+                   if column.name not in cls.HIDDEN_FIELDS]
+        columns += location_columns
+        columns += [table.c[name] for name in cls.HIDDEN_FIELDS]
+        return DBSession.query(*columns).select_from(cls).outerjoin(
+            Location, Location.event_id == cls.id).filter(~cls.deleted)
+
+    @classmethod
+    def load_related_values(cls, ids, session=DBSession):
+        """
+        Read tag names, category names and media of several events, with
+        one query per kind. Return a dictionary mapping event ids to
+        dictionaries of values by attribute name.
+        """
+        related = dict((id, {}) for id in ids)
+        if not related:
+            return related
+        for attrname, table in (('tags', tag_association),
+                                ('categories', category_association)):
+            query = session.query(table.c.event_id, Tag.name).join(
+                Tag, Tag.id == table.c.tag_id).filter(
+                table.c.event_id.in_(list(related))).order_by(table.c.id)
+            for event_id, name in query:
+                related[event_id].setdefault(attrname, []).append(name)
+        query = session.query(
+            Media.event_id, Media.type, Media.url, Media.license).filter(
+            Media.event_id.in_(list(related))).order_by(Media.id)
+        for event_id, type, url, license in query:
+            attrname = Media.EVENT_ATTRIBUTES.get(type)
+            if attrname:
+                related[event_id].setdefault(attrname, []).append(
+                    {'url': url, 'license': license})
+        return related
+
+    @classmethod
+    def harvested_fingerprints(cls, source_id):
+        """
+        Return a dictionary mapping ids of the events harvested from a
+        source, and not deleted, to their fingerprint.
+        """
+        query = DBSession.query(cls.id, cls.fingerprint).filter(
+            cls.harvest_source_id == source_id, ~cls.deleted)
+        return dict(query)
+
+    @classmethod
+    def preload_related(cls, appstructs):
+        names = set()
+        for appstruct in appstructs:
+            for key in ('tags', 'categories'):
+                names.update(appstruct.get(key) or [])
+        Tag.preload(names)
+
+    def update_from_appstruct(self, appstruct):
+        # Writes from the API or imports bring back events dropped by their
+        # source and take them out of harvest bookkeeping, so that the next
+        # harvest does not skip them as unchanged. The harvester sets these
+        # fields itself.
+        appstruct.setdefault('deleted', False)
+        appstruct.setdefault('fingerprint', None)
+        appstruct.setdefault('harvest_source_id', None)
+        super(Event, self).update_from_appstruct(appstruct)
+
     def make_uid(self):
         return "{}@{}".format(
             uuid1().hex,
             pyramid.threadlocal.get_current_registry().settings['domain'],
         )
 
-    def to_data_list(self):
-        result = []
-
-        for column in self.__class__.__mapper__.columns:
-            value = getattr(self, column.name)
-            if value:
-                result.append({'name': column.name, 'value': value})
-
-        if getattr(self, 'location', None):
-            location_fields = ('name', 'address', 'post_code', 'capacity',
-                               'town', 'country')
-            for name in location_fields:
-                value = getattr(self.location, name)
-                if value:
-                    result.append({'name': 'location_' + name,
-                                   'value': getattr(self.location, name)})
-
-        for attrname in ('tags', 'categories'):
-            objects = getattr(self, attrname, None)
-            if objects:
-                values = [obj.name for obj in objects]
-                result.append({'name': attrname, 'value': values})
-
-        for attrname in ('images', 'videos', 'sounds'):
-            objects = getattr(self, attrname, None)
-            if objects:
-                values = [{'url': obj.url, 'license': obj.license}
-                          for obj in objects]
-                result.append({'name': attrname, 'value': values})
-        return result
-
     def update_from_appstruct_item(self, key, value):
         if key.startswith('location_'):
             if self.location is None:
@@ -241,6 +439,9 @@ class Event(Base):
 
 class Location(Base):
     __tablename__ = 'locations'
+    __table_args__ = (
+        Index('ix_locations_event_id', 'event_id'),
+    )
 
     name = default_column()
     address = default_column()
@@ -253,10 +454,68 @@ class Location(Base):
 
 class Source(Base):
     __tablename__ = 'sources'
+    __table_args__ = (
+        Index('ix_sources_provider_id', 'provider_id'),
+        Index('ix_sources_next_run', 'next_run'),
+    )
     url = default_column()
     active = Column(Boolean())
     provider_id = default_column()
-    HIDDEN_FIELDS = ('provider_id', 'active')
+
+    # HTTP validators of the last successful harvest
+    etag = default_column()
+    last_modified = default_column()
+    content_hash = Column(String(40))
+
+    # Harvest schedule: seconds between harvests, time of the next one and
+    # number of consecutive failures
+    harvest_interval = Column(Integer())
+    next_run = Column(DateTime(timezone=False))
+    failure_count = Column(Integer(), nullable=False, default=0,
+                           server_default='0')
+
+    HIDDEN_FIELDS = ('provider_id', 'active', 'etag', 'last_modified',
+                     'content_hash', 'harvest_interval', 'next_run',
+                     'failure_count')
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def update_validators(self, headers):
+        self.etag = headers.get('ETag')
+        self.last_modified = headers.get('Last-Modified')
+
+    def reset_validators(self):
+        self.etag = None
+        self.last_modified = None
+        self.content_hash = None
+
+    def schedule_success(self, now, default_interval=DEFAULT_HARVEST_INTERVAL):
+        self.failure_count = 0
+        interval = self.harvest_interval or default_interval
+        self.next_run = now + timedelta(seconds=interval)
+
+    def schedule_failure(self, now, default_interval=DEFAULT_HARVEST_INTERVAL):
+        """
+        Postpone the next harvest exponentially with the number of
+        consecutive failures, from one interval after the first failure.
+        """
+        self.failure_count = (self.failure_count or 0) + 1
+        interval = self.harvest_interval or default_interval
+        delay = min(interval * 2 ** (self.failure_count - 1),
+                    MAX_HARVEST_BACKOFF)
+        self.next_run = now + timedelta(seconds=max(delay, interval))
+
+    def update_from_appstruct_item(self, key, value):
+        if key == 'url' and value != self.url:
+            # Validators of the previous URL are meaningless for the new one
+            self.reset_validators()
+        setattr(self, key, value)
 
 
 icalendar_to_model_keys = {
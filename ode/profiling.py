@@ -0,0 +1,219 @@
+"""
+Opt-in request profiling.
+
+Enabled with the ode.profiling.enabled setting, it logs one JSON line per
+request with its wall time, the number of SQL statements and the time
+spent running them, and the time spent in renderers. Streamed bodies are
+accounted for once they have been sent.
+
+A fraction of the requests, set by ode.profiling.profile_rate, can also
+be run under cProfile. Profiles of requests slower than
+ode.profiling.slow_threshold seconds are dumped to
+ode.profiling.profile_dir, to be read with pstats or snakeviz.
+"""
+from collections import OrderedDict
+import cProfile
+from functools import partial
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from timeit import default_timer
+
+from pyramid.interfaces import IRendererFactory
+from pyramid.settings import asbool
+from pyramid.tweens import INGRESS
+from sqlalchemy.engine import Engine
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+PROFILED_RENDERERS = ('json', 'csv', 'ical')
+DEFAULT_SLOW_THRESHOLD = 1.0
+
+_local = threading.local()
+
+
+def current_profile():
+    return getattr(_local, 'profile', None)
+
+
+class RequestProfile(object):
+    """
+    Timings and SQL statistics of a request
+    """
+
+    def __init__(self, request):
+        self.method = request.method
+        self.path = request.path
+        self.status = None
+        self.start = default_timer()
+        self.wall_seconds = None
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.render_seconds = 0.0
+
+    def finish(self):
+        self.wall_seconds = default_timer() - self.start
+
+    def as_dict(self):
+        return OrderedDict([
+            ('method', self.method),
+            ('path', self.path),
+            ('status', self.status),
+            ('wall_seconds', round(self.wall_seconds, 6)),
+            ('sql_count', self.sql_count),
+            ('sql_seconds', round(self.sql_seconds, 6)),
+            ('render_seconds', round(self.render_seconds, 6)),
+        ])
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if current_profile() is not None:
+        conn.info.setdefault('profiling_start', []).append(default_timer())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    profile = current_profile()
+    starts = conn.info.get('profiling_start')
+    if profile is not None and starts:
+        profile.sql_count += 1
+        profile.sql_seconds += default_timer() - starts.pop()
+
+
+class TimedRendererFactory(object):
+    """
+    Wrap a renderer factory to add the time spent rendering to the profile
+    of the current request.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def __call__(self, info):
+        render = self.factory(info)
+
+        def timed_render(value, system):
+            start = default_timer()
+            try:
+                return render(value, system)
+            finally:
+                profile = current_profile()
+                if profile is not None:
+                    profile.render_seconds += default_timer() - start
+        return timed_render
+
+
+class ProfiledAppIter(object):
+    """
+    Keep profiling a streamed body while it is being sent, and report the
+    profile once it is closed.
+    """
+
+    def __init__(self, app_iter, profile, report):
+        self.app_iter = app_iter
+        self.profile = profile
+        self.report = report
+
+    def __iter__(self):
+        iterator = iter(self.app_iter)
+        while True:
+            _local.profile = self.profile
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                _local.profile = None
+            yield chunk
+
+    def close(self):
+        close = getattr(self.app_iter, 'close', None)
+        if close is not None:
+            close()
+        self.report(self.profile)
+
+
+def profile_file_name(profile):
+    path = re.sub(r'[^A-Za-z0-9_.-]+', '_', profile.path.strip('/'))
+    return '%s-%s-%s-%dms.prof' % (
+        time.strftime('%Y%m%dT%H%M%S'), profile.method, path or 'root',
+        profile.wall_seconds * 1000)
+
+
+def profiling_tween_factory(handler, registry):
+    """
+    Log the profile of each request.
+
+    Settings: ode.profiling.slow_threshold in seconds (1 by default),
+    ode.profiling.profile_dir and ode.profiling.profile_rate, the fraction
+    of requests run under cProfile (all of them by default when a
+    directory is set).
+    """
+    settings = registry.settings
+    slow_threshold = float(settings.get('ode.profiling.slow_threshold',
+                                        DEFAULT_SLOW_THRESHOLD))
+    profile_dir = settings.get('ode.profiling.profile_dir')
+    profile_rate = float(settings.get('ode.profiling.profile_rate', 1))
+    if profile_dir and not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+
+    def report(profile, profiler=None):
+        profile.finish()
+        slow = profile.wall_seconds >= slow_threshold
+        level = logging.WARNING if slow else logging.INFO
+        log.log(level, json.dumps(profile.as_dict()))
+        if slow and profiler is not None:
+            profiler.dump_stats(
+                os.path.join(profile_dir, profile_file_name(profile)))
+
+    def profiling_tween(request):
+        profile = RequestProfile(request)
+        profiler = None
+        if profile_dir and random.random() < profile_rate:
+            profiler = cProfile.Profile()
+        _local.profile = profile
+        try:
+            if profiler is not None:
+                response = profiler.runcall(handler, request)
+            else:
+                response = handler(request)
+        finally:
+            _local.profile = None
+        profile.status = response.status_code
+        if isinstance(response.app_iter, list):
+            report(profile, profiler)
+        else:
+            response.app_iter = ProfiledAppIter(
+                response.app_iter, profile, partial(report, profiler=profiler))
+        return response
+
+    return profiling_tween
+
+
+def profile_renderers(config):
+    registry = config.registry
+    for name in PROFILED_RENDERERS:
+        factory = registry.getUtility(IRendererFactory, name=name)
+        registry.registerUtility(TimedRendererFactory(factory),
+                                 IRendererFactory, name=name)
+
+
+def includeme(config):
+    """
+    Set up profiling, when the ode.profiling.enabled setting is true.
+    """
+    if not asbool(config.registry.settings.get('ode.profiling.enabled')):
+        return
+    if not event.contains(Engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    config.add_tween('ode.profiling.profiling_tween_factory', under=INGRESS)
+    # Run once the renderers have been added
+    config.action(None, profile_renderers, (config,))
@@ -3,13 +3,24 @@ import csv
 import six
 from six import StringIO
 
-from icalendar import Calendar, Event
+from icalendar import Event
 from pyramid.renderers import JSON
 
 
 from ode.models import icalendar_to_model_keys
-from ode.deserializers import data_list_to_dict
 from ode.models import Event as EventModel, Location
+from ode.resources.base import ItemStream
+from ode.serializers import data_dict_to_list
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def encode_chunks(chunks):
+    for chunk in chunks:
+        if isinstance(chunk, six.text_type):
+            chunk = chunk.encode('utf-8')
+        yield chunk
 
 
 class IcalRenderer(object):
@@ -17,24 +28,49 @@ class IcalRenderer(object):
     def __init__(self, info):
         pass
 
+    CALENDAR_HEADER = b'BEGIN:VCALENDAR\r\n'
+    CALENDAR_FOOTER = b'END:VCALENDAR\r\n'
+
     def __call__(self, value, system):
         request = system.get('request')
         if request is not None:
             response = request.response
             response.content_type = 'text/calendar'
-        calendar = Calendar()
-        for item in value['collection']['items']:
-            self.add_event(calendar, data_list_to_dict(item['data']))
-        return calendar.to_ical()
+        items = value['collection']['items']
+        # Without a request, eg. from render(), streams are read at once
+        if isinstance(items, ItemStream) and request is not None:
+            response.app_iter = self.iter_ical(items)
+            return None
+        return b''.join(self.iter_ical(items))
+
+    @classmethod
+    def iter_ical(cls, items, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Serialize a calendar one VEVENT at a time, grouped in chunks of
+        about chunk_size bytes
+        """
+        chunk = [cls.CALENDAR_HEADER]
+        length = 0
+        for item in items:
+            event = cls.build_event(item['data'])
+            data = event.to_ical()
+            chunk.append(data)
+            length += len(data)
+            if length >= chunk_size:
+                yield b''.join(chunk)
+                chunk = []
+                length = 0
+        chunk.append(cls.CALENDAR_FOOTER)
+        yield b''.join(chunk)
 
     @staticmethod
-    def add_event(calendar, event_data):
+    def build_event(event_data):
         event = Event()
         for icalendar_key, model_attribute in icalendar_to_model_keys.items():
             if model_attribute in event_data:
                 if event_data[model_attribute] is not None:
                     event.add(icalendar_key, event_data[model_attribute])
-        calendar.add_component(event)
+        return event
 
 
 class NoContentRenderer(object):
@@ -87,21 +123,33 @@ class CsvRenderer(object):
             return value
 
     @classmethod
-    def build_csv(cls, items):
-        fieldnames = [column.name for column in EventModel.__mapper__.columns]
+    def fieldnames(cls):
+        fieldnames = [column.name for column in EventModel.__mapper__.columns
+                      if column.name not in EventModel.HIDDEN_FIELDS]
         fieldnames += ['location_' + column.name
                        for column in Location.__mapper__.columns
                        if column.name != 'event_id']
         fieldnames += ['tags', 'categories'] + cls.MEDIA_ATTRIBUTES
+        return fieldnames
+
+    @classmethod
+    def iter_csv(cls, items, chunk_size=STREAM_CHUNK_SIZE):
         output = StringIO()
-        writer = csv.DictWriter(output, fieldnames=fieldnames)
+        writer = csv.DictWriter(output, fieldnames=cls.fieldnames())
         writer.writeheader()
         for item in items:
-            data_dict = data_list_to_dict(item['data'])
-            for key, value in data_dict.items():
-                data_dict[key] = cls.format_value(key, value)
-            writer.writerow(data_dict)
-        return output.getvalue()
+            writer.writerow(dict(
+                (key, cls.format_value(key, value))
+                for key, value in item['data'].items()))
+            if output.tell() >= chunk_size:
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate()
+        yield output.getvalue()
+
+    @classmethod
+    def build_csv(cls, items):
+        return ''.join(cls.iter_csv(items))
 
     def __call__(self, value, system):
         request = system.get('request')
@@ -109,6 +157,9 @@ class CsvRenderer(object):
             response = request.response
             response.content_type = 'text/csv'
         items = value['collection']['items']
+        if isinstance(items, ItemStream) and request is not None:
+            response.app_iter = encode_chunks(self.iter_csv(items))
+            return None
         if items:
             return self.build_csv(items)
         else:
@@ -119,5 +170,30 @@ def datetime_adapter(obj, request):
     return obj.isoformat()
 
 
-JsonRenderer = JSON()
+class CollectionJsonRenderer(JSON):
+    """
+    JSON renderer writing the data dictionaries of collection items as
+    Collection+JSON lists of name/value pairs
+    """
+
+    def __call__(self, info):
+        render = super(CollectionJsonRenderer, self).__call__(info)
+
+        def _render(value, system):
+            return render(self.to_collection_json(value), system)
+        return _render
+
+    @staticmethod
+    def to_collection_json(value):
+        if not isinstance(value, dict) or 'collection' not in value:
+            return value
+        collection = dict(value['collection'])
+        collection['items'] = [
+            dict(item, data=data_dict_to_list(item['data']))
+            for item in collection['items']
+        ]
+        return dict(value, collection=collection)
+
+
+JsonRenderer = CollectionJsonRenderer()
 JsonRenderer.add_adapter(datetime.datetime, datetime_adapter)
@@ -1,3 +1,5 @@
+from six.moves.urllib.parse import urlencode
+from sqlalchemy.orm import Session
 from sqlalchemy.orm.exc import NoResultFound
 from cornice.resource import view
 
@@ -7,9 +9,26 @@ from ode.validation.schema import COLLECTION_MAX_LENGTH
 from ode.validation.validators import has_provider_id
 from ode.validation.validators import validate_querystring
 from ode.urls import absolute_url
+from ode.resources.pagination import encode_cursor, decode_cursor
+from ode.resources.pagination import check_value
+from ode.resources.pagination import order_by_criteria, keyset_criterion
+from ode.resources.pagination import InvalidCursor
 
 
 COLLECTION_JSON_MIMETYPE = 'application/vnd.collection+json'
+STREAM_BATCH_SIZE = 500
+
+
+class ItemStream(object):
+    """
+    Collection items produced lazily, for renderers able to stream them
+    """
+
+    def __init__(self, items):
+        self.items = items
+
+    def __iter__(self):
+        return iter(self.items)
 
 
 def set_content_type(response, request):
@@ -27,6 +46,21 @@ class ResourceMixin(object):
     def name(self):
         return self.model.__name__.lower()
 
+    def query(self):
+        """Query used to read resources"""
+        return DBSession.query(self.model)
+
+    def collection_query(self):
+        """Query used to read collections of resources"""
+        return self.query()
+
+    def load_resources(self, resources):
+        """Hook to load data related to resources read from the database"""
+
+    def resources_by_id(self, ids):
+        """Resources to update, by id, read with a single query"""
+        return self.model.get_by_ids(ids)
+
     @view(validators=[has_provider_id], renderer='no_content')
     def delete(self):
         """Delete a resource by id"""
@@ -44,25 +78,33 @@ class ResourceMixin(object):
         """Add new resources"""
         items = self.request.validated['items']
         provider_id = self.request.validated['provider_id']
-        result_items = []
+        resources = self.resources_by_id(
+            [item['data']['id'] for item in items if 'id' in item['data']])
+        self.load_resources(list(resources.values()))
+        # Ownership is checked before anything is added to the session
+        for item in items:
+            resource = resources.get(item['data'].get('id'))
+            if resource is not None and provider_id != resource.provider_id:
+                self.request.response.status_code = 403
+                return self.collection_json([resource.to_item(self.request)])
+        self.model.preload_related([item['data'] for item in items])
+        posted = []
         for item in items:
             item['data']['provider_id'] = provider_id
             resource = None
-            if 'id' in item['data'].keys():
-                resource = self.model.get_by_id(item['data']['id'])
-                if resource is not None:
-                    if provider_id != resource.provider_id:
-                        self.request.response.status_code = 403
-                        return self.collection_json(
-                            [resource.to_item(self.request)]
-                            )
-                    resource.update_from_appstruct(item['data'])
-                    DBSession.merge(resource)
+            if 'id' in item['data']:
+                resource = resources.get(item['data']['id'])
             if resource is None:
                 resource = self.model(**item['data'])
                 DBSession.add(resource)
-            DBSession.flush()
-            result_items.append(resource.to_item(self.request))
+                if resource.id is not None:
+                    # Later items with the same id update this one
+                    resources[resource.id] = resource
+            else:
+                resource.update_from_appstruct(item['data'])
+            posted.append(resource)
+        DBSession.flush()
+        result_items = [resource.to_item(self.request) for resource in posted]
         response = self.request.response
         response.status_code = 201
         if len(result_items) == 1:
@@ -74,9 +116,10 @@ class ResourceMixin(object):
         """Get a specific resource by id"""
         id = self.request.matchdict['id']
         try:
-            resource = DBSession.query(self.model).filter_by(id=id).one()
+            resource = self.query().filter_by(id=id).one()
         except NoResultFound:
             raise HTTPNotFound()
+        self.load_resources([resource])
         items = [resource.to_item(self.request)]
         return self.collection_json(items)
 
@@ -94,44 +137,121 @@ class ResourceMixin(object):
         return absolute_url(self.request, route_name)
 
     def collection_get_filter_query(self, query):
+        provider_id = self.request.validated.get('provider_id')
         if 'provider_id' in self.request.validated:
-            query = query.filter_by(
-                provider_id=self.request.validated['provider_id'])
+            query = query.filter(self.model.provider_id == provider_id)
         return query
 
+    def sort_column(self):
+        sort_by = self.request.validated.get('sort_by')
+        if not sort_by:
+            return self.model.id
+        if sort_by not in self.model.__mapper__.columns.keys() or \
+                sort_by in self.model.HIDDEN_FIELDS:
+            message = self._(
+                u"${sort_by} is not a valid sorting criterion",
+                mapping={'sort_by': sort_by})
+            raise HTTPBadRequest(message)
+        return getattr(self.model, sort_by)
+
     def collection_get_query(self):
-        query = DBSession.query(self.model)
+        query = self.collection_query()
         query = self.collection_get_filter_query(query)
-        sort_by = self.request.validated.get('sort_by')
-        if sort_by:
-            order_criterion = getattr(self.model, sort_by, None)
-            if order_criterion:
-                if self.request.validated['sort_direction'] == 'desc':
-                    order_criterion = order_criterion.desc()
-                query = query.order_by(order_criterion)
-            else:
-                message = self._(
-                    u"${sort_by} is not a valid sorting criterion",
-                    mapping={'sort_by': sort_by})
-                raise HTTPBadRequest(message)
-        total_count = query.count()
-        limit = self.request.validated.get('limit', COLLECTION_MAX_LENGTH)
-        query = query.limit(limit)
-        offset = self.request.validated.get('offset')
-        if offset:
-            query = query.offset(offset)
+        total_count = None
+        if self.request.validated.get('total_count', True):
+            total_count = query.count()
+        sort_column = self.sort_column()
+        descending = self.sort_descending()
+        query = query.order_by(
+            *order_by_criteria(sort_column, self.model.id, descending))
+        cursor = self.request.validated.get('cursor')
+        if cursor:
+            try:
+                sort_by, value, id = decode_cursor(cursor)
+                if sort_by != sort_column.key or id is None:
+                    raise InvalidCursor(cursor)
+                value = check_value(sort_column, value)
+                id = check_value(self.model.id, id)
+            except InvalidCursor:
+                raise HTTPBadRequest(self._(u"Invalid cursor"))
+            query = query.filter(keyset_criterion(
+                sort_column, self.model.id, descending, value, id))
+        else:
+            offset = self.request.validated.get('offset')
+            if offset:
+                query = query.offset(offset)
+        # Fetch an extra item to know whether there is a next page
+        query = query.limit(self.collection_get_limit() + 1)
         return (query, total_count)
 
+    def sort_descending(self):
+        return self.request.validated.get('sort_direction') == 'desc'
+
+    def collection_get_limit(self):
+        return self.request.validated.get('limit', COLLECTION_MAX_LENGTH)
+
+    def next_link(self, last_resource):
+        sort_column = self.sort_column()
+        cursor = encode_cursor(sort_column.key,
+                               getattr(last_resource, sort_column.key),
+                               last_resource.id)
+        params = [(key, value) for key, value in self.request.GET.items()
+                  if key not in ('cursor', 'offset')]
+        params.append(('cursor', cursor))
+        return {
+            'rel': 'next',
+            'href': self.absolute_url() + '?' + urlencode(params),
+        }
+
     @view(validators=[validate_querystring])
     def collection_get(self):
         """Get list of resources"""
         query, total_count = self.collection_get_query()
-        items = [resource.to_item(self.request) for resource in query.all()]
+        resources = query.all()
+        limit = self.collection_get_limit()
+        has_next = len(resources) > limit
+        resources = resources[:limit]
+        items = self.batch_to_items(resources)
         result = self.collection_json(items)
         result['collection']['current_count'] = len(items)
-        result['collection']['total_count'] = total_count
+        if total_count is not None:
+            result['collection']['total_count'] = total_count
+        if has_next:
+            result['collection']['links'] = [self.next_link(resources[-1])]
         return result
 
+    def collection_stream(self):
+        """
+        Get all resources matching the query string, read lazily from a
+        server-side cursor.
+        """
+        query = self.collection_get_filter_query(self.collection_query())
+        query = query.order_by(*order_by_criteria(
+            self.sort_column(), self.model.id, self.sort_descending()))
+        return self.collection_json(ItemStream(self.iter_items(query)))
+
+    def iter_items(self, query):
+        # The response body is produced after the request transaction is
+        # over, so read from a session of our own.
+        session = Session(bind=DBSession.get_bind())
+        try:
+            query = query.with_session(session).yield_per(STREAM_BATCH_SIZE)
+            batch = []
+            for resource in query:
+                batch.append(resource)
+                if len(batch) == STREAM_BATCH_SIZE:
+                    for item in self.batch_to_items(batch, session):
+                        yield item
+                    batch = []
+            for item in self.batch_to_items(batch, session):
+                yield item
+        finally:
+            session.close()
+
+    def batch_to_items(self, resources, session=DBSession):
+        self.load_resources(resources)
+        return [resource.to_item(self.request) for resource in resources]
+
     def put(self):
         """Update an existing resource by id"""
         resouce_id = self.request.matchdict['id']
@@ -1,8 +1,10 @@
 from cornice.resource import resource, view
 
-from ode.models import Event
+from ode.models import DBSession, Event
+from ode.urls import absolute_url
 from ode.validation.schema import EventCollectionSchema
 from ode.validation.validators import validate_querystring, has_provider_id
+from ode.validation.validators import reject_stream
 from ode.resources.base import ResourceMixin, set_content_type
 from ode.resources.base import COLLECTION_JSON_MIMETYPE
 
@@ -19,6 +21,30 @@ class EventResource(ResourceMixin):
 
     model = Event
 
+    def query(self):
+        return DBSession.query(Event).options(
+            *Event.eager_loading_options()).filter(~Event.deleted)
+
+    def load_resources(self, resources):
+        Event.load_media(resources)
+
+    def resources_by_id(self, ids):
+        return Event.get_by_ids(ids, Event.eager_loading_options())
+
+    def collection_query(self):
+        # Collections are read-only, select rows rather than instanciating
+        # events
+        return Event.rows_query()
+
+    def batch_to_items(self, rows, session=DBSession):
+        related = Event.load_related_values([row.id for row in rows],
+                                            session)
+        serializer = Event.data_serializer()
+        return [{
+            'data': serializer.from_row(row, related[row.id]),
+            'href': absolute_url(self.request, 'eventresource', id=row.id),
+        } for row in rows]
+
     @view(validators=[has_provider_id], schema=EventCollectionSchema,
           renderer='json', content_type=CONTENT_TYPES)
     def collection_post(self):
@@ -43,8 +69,10 @@ class EventResource(ResourceMixin):
           validators=[validate_querystring])
     @view(accept='text/csv', renderer='csv', validators=[validate_querystring])
     @view(accept=['', COLLECTION_JSON_MIMETYPE], renderer='json',
-          validators=[validate_querystring])
+          validators=[validate_querystring, reject_stream])
     def collection_get(self):
+        if self.request.validated.get('stream'):
+            return self.collection_stream()
         return ResourceMixin.collection_get(self)
 
     @view(accept='text/calendar', renderer='ical')
@@ -0,0 +1,99 @@
+import base64
+import datetime
+import json
+
+import six
+from sqlalchemy import and_, or_
+
+
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'datetime': value.isoformat()}
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict):
+        for datetime_format in DATETIME_FORMATS:
+            try:
+                return datetime.datetime.strptime(value['datetime'],
+                                                  datetime_format)
+            except (KeyError, TypeError, ValueError):
+                continue
+        raise InvalidCursor(value)
+    return value
+
+
+def check_value(column, value):
+    """
+    Return a decoded cursor value if it suits the type of the column, so
+    that tampered cursors never reach the database.
+    """
+    if value is None:
+        return value
+    python_type = column.type.python_type
+    if issubclass(python_type, six.string_types):
+        valid_types = six.string_types
+    elif issubclass(python_type, six.integer_types) and \
+            python_type is not bool:
+        valid_types = six.integer_types
+    else:
+        valid_types = python_type
+    if not isinstance(value, valid_types) or \
+            isinstance(value, bool) and python_type is not bool:
+        raise InvalidCursor(value)
+    return value
+
+
+def encode_cursor(sort_by, value, id):
+    """
+    Build an opaque cursor pointing after the item with the given sort key
+    value and id.
+    """
+    data = json.dumps([sort_by, encode_value(value), id])
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Return the (sort_by, value, id) tuple encoded by encode_cursor().
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        sort_by, value, id = json.loads(data.decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidCursor(cursor)
+    return sort_by, decode_value(value), id
+
+
+def order_by_criteria(column, id_column, descending):
+    """
+    Total ordering on a column and the primary key. NULL values are
+    considered greater than any other value, as PostgreSQL does.
+    """
+    if descending:
+        return [column.desc().nullsfirst(), id_column.desc()]
+    return [column.asc().nullslast(), id_column.asc()]
+
+
+def keyset_criterion(column, id_column, descending, value, id):
+    """
+    Criterion selecting rows following (value, id) in the ordering given by
+    order_by_criteria().
+    """
+    if descending:
+        if value is None:
+            return or_(column.isnot(None),
+                       and_(column.is_(None), id_column < id))
+        return or_(column < value, and_(column == value, id_column < id))
+    if value is None:
+        return and_(column.is_(None), id_column > id)
+    return or_(column > value, column.is_(None),
+               and_(column == value, id_column > id))
@@ -4,7 +4,11 @@ import textwrap
 
 import transaction
 from pyramid.paster import bootstrap
-from ode.harvesting import harvest
+from ode.harvesting import harvest, MAX_WORKERS, MAX_PER_HOST
+from ode.harvesting import HarvestScheduler, POLL_INTERVAL
+from ode.harvesting import HARVEST_CHUNK_SIZE
+from ode.metrics import summary_table, write_metrics_file
+from ode.models import DEFAULT_HARVEST_INTERVAL
 import pyramid.paster
 
 
@@ -12,12 +16,55 @@ def main():
     description = """\
     Harvest event from sources.
     Example: 'harvest deployment.ini'
+
+    With --scheduler, keep running and harvest each source when it is due,
+    retrying failing sources with an exponential backoff.
     """
     usage = "usage: %prog config_uri"
     parser = optparse.OptionParser(
         usage=usage,
         description=textwrap.dedent(description)
         )
+    parser.add_option(
+        '-w', '--workers', dest='max_workers', type='int',
+        default=MAX_WORKERS,
+        help="Maximum number of sources fetched concurrently",
+    )
+    parser.add_option(
+        '-p', '--per-host', dest='max_per_host', type='int',
+        default=MAX_PER_HOST,
+        help="Maximum number of concurrent requests to a single host",
+    )
+    parser.add_option(
+        '-c', '--chunk-size', dest='chunk_size', type='int',
+        default=HARVEST_CHUNK_SIZE,
+        help="Number of events validated and flushed at once",
+    )
+    parser.add_option(
+        '-m', '--metrics-file', dest='metrics_file',
+        help="Write metrics of the harvested sources to this file, in the "
+             "Prometheus text format",
+    )
+    parser.add_option(
+        '-q', '--quiet', dest='quiet', action='store_true', default=False,
+        help="Do not print the summary of the harvested sources",
+    )
+    parser.add_option(
+        '-s', '--scheduler', dest='scheduler', action='store_true',
+        default=False,
+        help="Run continuously, committing each source separately",
+    )
+    parser.add_option(
+        '-i', '--interval', dest='interval', type='int',
+        default=DEFAULT_HARVEST_INTERVAL,
+        help="Seconds between harvests of sources without their own "
+             "interval (scheduler mode)",
+    )
+    parser.add_option(
+        '--poll', dest='poll_interval', type='int', default=POLL_INTERVAL,
+        help="Maximum seconds between checks for due sources "
+             "(scheduler mode)",
+    )
 
     options, args = parser.parse_args(sys.argv[1:])
     if not len(args) >= 1:
@@ -28,7 +75,21 @@ def main():
     env = bootstrap(config_uri)
     closer = env['closer']
     try:
-        with transaction.manager:
-            harvest()
+        if options.scheduler:
+            scheduler = HarvestScheduler(
+                options.max_workers, options.max_per_host,
+                default_interval=options.interval,
+                poll_interval=options.poll_interval,
+                chunk_size=options.chunk_size,
+                metrics_file=options.metrics_file)
+            scheduler.run()
+        else:
+            with transaction.manager:
+                all_stats = harvest(options.max_workers, options.max_per_host,
+                                    options.chunk_size)
+            if options.metrics_file:
+                write_metrics_file(all_stats, options.metrics_file)
+            if not options.quiet:
+                print(summary_table(all_stats))
     finally:
         closer()
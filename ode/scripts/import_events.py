@@ -0,0 +1,69 @@
+import optparse
+import sys
+import textwrap
+
+import six
+from pyramid.paster import bootstrap
+import pyramid.paster
+
+from ode.importing import EventImporter, IMPORT_BATCH_SIZE
+
+
+def print_progress(stats):
+    print(six.text_type(stats))
+    sys.stdout.flush()
+
+
+def main():
+    description = """\
+    Import events from JSON, CSV or iCalendar files, or from directories
+    of such files, without going through the web API.
+    Example: 'ode_import --provider-id 123 development.ini archive/'
+
+    Events are validated in worker processes and written in batches, each
+    batch in its own transaction. The offset printed after each batch can
+    be given to --offset to resume an interrupted import.
+    """
+    usage = "usage: %prog [options] config_uri path [path ...]"
+    parser = optparse.OptionParser(
+        usage=usage,
+        description=textwrap.dedent(description)
+        )
+    parser.add_option(
+        '-p', '--provider-id', dest='provider_id',
+        help="Provider the imported events belong to (required)",
+    )
+    parser.add_option(
+        '-j', '--jobs', dest='processes', type='int',
+        help="Number of validation processes, one per CPU by default",
+    )
+    parser.add_option(
+        '-b', '--batch-size', dest='batch_size', type='int',
+        default=IMPORT_BATCH_SIZE,
+        help="Number of events written per transaction",
+    )
+    parser.add_option(
+        '-o', '--offset', dest='offset', type='int', default=0,
+        help="Skip this many events, to resume a previous import",
+    )
+
+    options, args = parser.parse_args(sys.argv[1:])
+    if len(args) < 2:
+        print('You must provide a configuration file and paths to import')
+        return 2
+    if not options.provider_id:
+        print('You must provide a provider id')
+        return 2
+    config_uri = args[0]
+    pyramid.paster.setup_logging(config_uri)
+    env = bootstrap(config_uri)
+    closer = env['closer']
+    try:
+        importer = EventImporter(
+            options.provider_id, processes=options.processes,
+            batch_size=options.batch_size, offset=options.offset,
+            progress=print_progress)
+        stats = importer.run(args[1:])
+        print(u'Import finished. ' + six.text_type(stats))
+    finally:
+        closer()
@@ -1,7 +1,7 @@
 import os
 import sys
 
-from sqlalchemy import engine_from_config
+from sqlalchemy import engine_from_config, inspect
 
 from pyramid.paster import (
     get_appsettings,
@@ -20,6 +20,16 @@ def usage(argv):
     sys.exit(1)
 
 
+def stamp_head(config_uri):
+    """
+    Mark all alembic migrations as applied, for tables created up to date.
+    """
+    # Imported here so that scanning the ode package does not need alembic
+    from alembic import command
+    from alembic.config import Config
+    command.stamp(Config(config_uri.split('#')[0]), 'head')
+
+
 def main(argv=sys.argv):
     if len(argv) < 2:
         usage(argv)
@@ -29,4 +39,9 @@ def main(argv=sys.argv):
     settings = get_appsettings(config_uri, options=options)
     engine = engine_from_config(settings, 'sqlalchemy.')
     DBSession.configure(bind=engine)
+    fresh_database = not inspect(engine).get_table_names()
     Base.metadata.create_all(engine)
+    if fresh_database:
+        # So that 'alembic upgrade head' does not run migrations again on
+        # the new tables. Existing databases are left to alembic.
+        stamp_head(config_uri)
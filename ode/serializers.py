@@ -0,0 +1,103 @@
+from collections import OrderedDict
+from operator import attrgetter
+
+
+def data_dict_to_list(data):
+    """
+    Turn a data dictionary into a Collection+JSON list of name/value pairs
+    """
+    return [{'name': name, 'value': value} for name, value in data.items()]
+
+
+class DataSerializer(object):
+    """
+    Serialize model objects to an ordered dictionary of their data, using
+    getters computed once per model.
+    """
+
+    def __init__(self, model):
+        self.column_getters = [
+            (column.name, attrgetter(column.name))
+            for column in model.__mapper__.columns
+            if column.name not in model.HIDDEN_FIELDS
+        ]
+
+    def __call__(self, obj):
+        return OrderedDict((name, getter(obj))
+                           for name, getter in self.column_getters)
+
+
+class EventSerializer(DataSerializer):
+    """
+    Serialize events with their location, tags and media. Empty values are
+    left out.
+    """
+
+    LOCATION_FIELDS = ('name', 'address', 'post_code', 'capacity', 'town',
+                       'country')
+    TAG_ATTRIBUTES = ('tags', 'categories')
+    MEDIA_ATTRIBUTES = ('images', 'videos', 'sounds')
+
+    def __init__(self, model):
+        super(EventSerializer, self).__init__(model)
+        self.location_getters = [
+            ('location_' + name, attrgetter(name))
+            for name in self.LOCATION_FIELDS
+        ]
+        self.tag_getters = [(name, attrgetter(name))
+                            for name in self.TAG_ATTRIBUTES]
+        self.media_getters = [(name, attrgetter(name))
+                              for name in self.MEDIA_ATTRIBUTES]
+
+    def __call__(self, event):
+        result = OrderedDict()
+        # Loaded column values are read from the instance dictionary,
+        # bypassing attribute instrumentation; expired ones are loaded
+        # by the getter.
+        values = event.__dict__
+        for name, getter in self.column_getters:
+            value = values[name] if name in values else getter(event)
+            if value:
+                result[name] = value
+
+        location = event.location
+        if location:
+            for name, getter in self.location_getters:
+                value = getter(location)
+                if value:
+                    result[name] = value
+
+        for name, getter in self.tag_getters:
+            objects = getter(event)
+            if objects:
+                result[name] = [obj.name for obj in objects]
+
+        for name, getter in self.media_getters:
+            objects = getter(event)
+            if objects:
+                result[name] = [{'url': obj.url, 'license': obj.license}
+                                for obj in objects]
+        return result
+
+    def from_row(self, row, related):
+        """
+        Serialize a row of event columns followed by location columns, as
+        selected by Event.rows_query(). related maps the names of tag and
+        media attributes to their values.
+        """
+        result = OrderedDict()
+        for (name, getter), value in zip(self.column_getters, row):
+            if value:
+                result[name] = value
+
+        location_values = row[len(self.column_getters):]
+        for (name, getter), value in zip(self.location_getters,
+                                         location_values):
+            if value:
+                result[name] = value
+
+        for name in self.TAG_ATTRIBUTES + self.MEDIA_ATTRIBUTES:
+            value = related.get(name)
+            if value:
+                result[name] = value
+        return result
@@ -2,6 +2,7 @@
 from pyramid import testing
 from webtest import TestApp as BaseTestApp
 from mock import patch
+import transaction
 
 from ode import main
 from ode.tests.support import initTestingDB
@@ -23,11 +24,14 @@ class BaseTestMixin(object):
         'Content-Type': 'application/vnd.collection+json',
     }
 
+    SETTINGS = {}
+
     def setUp(self):
         settings = {
             'sqlalchemy.url': 'sqlite://',
             'domain': 'example.com',
         }
+        settings.update(self.SETTINGS)
         app = main({}, **settings)
         self.app = TestApp(app)
         testing.setUp(settings=settings)
@@ -35,6 +39,7 @@ class BaseTestMixin(object):
 
     def tearDown(self):
         del self.app
+        transaction.abort()
         DBSession.remove()
         testing.tearDown()
 
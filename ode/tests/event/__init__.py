@@ -16,6 +16,14 @@ class TestEventMixin(BaseTestMixin):
         event = DBSession.query(Event).filter_by(id=event_id).first()
         self.assertEqual(event.title, title)
 
+    def post_events(self, events_data, **kwargs):
+        items = [{'data': [{'name': name, 'value': value}
+                           for name, value in data.items()]}
+                 for data in events_data]
+        return self.app.post_json('/v1/events',
+                                  {'collection': {'items': items}},
+                                  headers=self.WRITE_HEADERS, **kwargs)
+
     def post_event(self, event_info=None, headers=None):
         if headers is None:
             headers = {'X-ODE-Provider-Id': '123'}
@@ -7,7 +7,10 @@ from six import StringIO
 
 from ode.models import DBSession, Event, Location, Tag, Sound
 from ode.deserializers import csv_text
+from ode.renderers import CsvRenderer
+from ode.resources.base import ItemStream
 from ode.tests.event import TestEventMixin
+from ode.validation.schema import COLLECTION_MAX_LENGTH
 
 
 class TestGetEvents(TestEventMixin, TestCase):
@@ -97,6 +100,44 @@ class TestGetEvents(TestEventMixin, TestCase):
         row = next(reader)
         self.assertEqual(row['start_time'], '2014-01-25T16:00:00')
 
+    def test_stream(self):
+        for i in range(0, COLLECTION_MAX_LENGTH + 1):
+            event = self.create_event(title=u'Événement %s' % i)
+            event.tags = [Tag(name=u'Tag%s' % i)]
+        DBSession.flush()
+
+        response = self.app.get('/v1/events?stream=true',
+                                headers={'Accept': 'text/csv'})
+
+        self.assertEqual(response.content_type, 'text/csv')
+        reader = csv.DictReader(StringIO(csv_text(response.text)))
+        rows = list(reader)
+        self.assertEqual(len(rows), COLLECTION_MAX_LENGTH + 1)
+        self.assertEqual(rows[0]['title'], 'Événement 0')
+        self.assertEqual(rows[-1]['tags'], u'Tag%s' % COLLECTION_MAX_LENGTH)
+
+    def test_stream_same_output(self):
+        self.create_event(title=u'Événement 1',
+                          location=Location(name=u'Évian'))
+        self.create_event(title=u'Événement 2', description=u'Foo bar')
+        DBSession.flush()
+
+        response = self.app.get('/v1/events', headers={'Accept': 'text/csv'})
+        stream_response = self.app.get('/v1/events?stream=true',
+                                       headers={'Accept': 'text/csv'})
+
+        self.assertEqual(stream_response.body, response.body)
+
+    def test_stream_without_request(self):
+        items = [{'data': {'title': u'Événement'}}]
+        renderer = CsvRenderer(None)
+        body = renderer({'collection': {'items': ItemStream(items)}}, {})
+        self.assertEqual(body, renderer({'collection': {'items': items}}, {}))
+
+    def test_stream_json(self):
+        response = self.app.get('/v1/events?stream=true', status=400)
+        self.assertErrorMessage(response, 'Streaming is only available')
+
 
 class TestPostEvents(TestEventMixin, TestCase):
 
@@ -10,7 +10,10 @@ else:
 import icalendar
 
 from ode.models import DBSession, Event
+from ode.renderers import IcalRenderer
+from ode.resources.base import ItemStream
 from ode.tests.event import TestEventMixin
+from ode.validation.schema import COLLECTION_MAX_LENGTH
 
 
 class TestGetEvent(TestEventMixin, TestCase):
@@ -67,6 +70,52 @@ class TestGetEventList(TestEventMixin, TestCase):
         self.assertContains(response, u'SUMMARY:Événement 1')
         self.assertContains(response, u'SUMMARY:Événement 2')
 
+    def test_same_output_as_calendar(self):
+        self.create_event(title=u'Événement 1', location_name=u'Évian',
+                          start_time=datetime(2013, 12, 25, 15, 0))
+        self.create_event(title=u'Événement 2', url=u'http://example.com/')
+        response = self.app.get('/v1/events',
+                                headers={'Accept': 'text/calendar'})
+
+        calendar = icalendar.Calendar()
+        for event in DBSession.query(Event).order_by(Event.id):
+            calendar.add_component(
+                IcalRenderer.build_event(event.to_data_dict()))
+        self.assertEqual(response.body, calendar.to_ical())
+
+    def test_stream(self):
+        for i in range(0, COLLECTION_MAX_LENGTH + 1):
+            self.create_event(title=u'Événement %s' % i)
+        DBSession.flush()
+
+        response = self.app.get('/v1/events?stream=true',
+                                headers={'Accept': 'text/calendar'})
+
+        self.assertEqual(response.content_type, 'text/calendar')
+        calendar = icalendar.Calendar.from_ical(response.body)
+        events = calendar.walk('VEVENT')
+        self.assertEqual(len(events), COLLECTION_MAX_LENGTH + 1)
+        self.assertEqual(events[-1]['SUMMARY'],
+                         u'Événement %s' % COLLECTION_MAX_LENGTH)
+
+    def test_stream_chunks(self):
+        items = [{'data': {'title': u'Event %s' % i,
+                           'start_time': datetime(2014, 1, 25, i)}}
+                 for i in range(10)]
+        chunks = list(IcalRenderer.iter_ical(items, chunk_size=100))
+        self.assertGreater(len(chunks), 1)
+        body = b''.join(chunks)
+        self.assertEqual(body, b''.join(IcalRenderer.iter_ical(items)))
+        self.assertEqual(body.count(b'BEGIN:VEVENT'), 10)
+        self.assertIn(b'SUMMARY:Event 9\r\n', body)
+        self.assertIn(b'DTSTART;VALUE=DATE-TIME:20140125T090000\r\n', body)
+
+    def test_stream_without_request(self):
+        items = [{'data': {'title': u'Event'}}]
+        renderer = IcalRenderer(None)
+        body = renderer({'collection': {'items': ItemStream(items)}}, {})
+        self.assertEqual(body, renderer({'collection': {'items': items}}, {}))
+
 
 class TestPostEvent(TestEventMixin, TestCase):
 
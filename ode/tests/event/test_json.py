@@ -4,10 +4,14 @@ from datetime import datetime
 from six.moves.urllib.parse import quote
 
 from ode.models import DBSession, Event, Tag, Image, Video, Sound
+from ode.models import SAFE_MAX_LENGTH
 from ode.tests.event import TestEventMixin
 from ode.deserializers import data_list_to_dict
 from ode.validation.schema import COLLECTION_MAX_LENGTH
 from ode.resources.base import COLLECTION_JSON_MIMETYPE
+from ode.resources.pagination import encode_cursor
+from ode.tests.support import QueryCounter
+from ode.validation import parallel
 
 
 def remove_ids(fields):
@@ -311,6 +315,181 @@ class TestJson(TestEventMixin, TestCase):
         self.assertEqual(self.get_item_title(items[0]), 'AAA')
         self.assertEqual(self.get_item_title(items[1]), 'BBB')
 
+    def walk_pages(self, url):
+        titles = []
+        while url:
+            collection = self.app.get_json(url)['collection']
+            titles += [data_list_to_dict(item['data']).get('title')
+                       for item in collection['items']]
+            links = collection.get('links', [])
+            url = links[0]['href'] if links else None
+        return titles
+
+    def test_cursor_pagination(self):
+        for title in (u'CCC', u'AAA', u'BBB', u'AAA', None, u'DDD'):
+            self.create_event(title=title)
+        expected = [u'AAA', u'AAA', u'BBB', u'CCC', u'DDD', None]
+        titles = self.walk_pages('/v1/events?sort_by=title&limit=2')
+        self.assertEqual(titles, expected)
+        titles = self.walk_pages(
+            '/v1/events?sort_by=title&sort_direction=desc&limit=4')
+        self.assertEqual(titles, list(reversed(expected)))
+
+    def test_next_link(self):
+        for i in range(3):
+            self.create_event(title=u'Événement %s' % i)
+        collection = self.app.get_json('/v1/events?limit=2')['collection']
+        self.assertEqual(collection['links'][0]['rel'], 'next')
+        self.assertIn('limit=2', collection['links'][0]['href'])
+        self.assertIn('cursor=', collection['links'][0]['href'])
+        collection = self.app.get_json(
+            collection['links'][0]['href'])['collection']
+        self.assertEqual(len(collection['items']), 1)
+        self.assertNotIn('links', collection)
+
+    def test_cursor_with_another_sort_key(self):
+        for i in range(3):
+            self.create_event(title=u'Événement %s' % i)
+        collection = self.app.get_json('/v1/events?limit=2')['collection']
+        url = collection['links'][0]['href'] + '&sort_by=title'
+        response = self.app.get(url, status=400)
+        self.assertErrorMessage(response, 'Invalid cursor')
+
+    def test_invalid_cursor(self):
+        response = self.app.get('/v1/events?cursor=BOGUS', status=400)
+        self.assertErrorMessage(response, 'Invalid cursor')
+
+    def test_cursor_value_of_another_type(self):
+        self.create_event(title=u'Événement')
+        for sort_by, value, id in [
+                ('title', 42, u'1@example.com'),
+                ('title', [u'AAA'], u'1@example.com'),
+                ('start_time', u'2014-01-25', u'1@example.com'),
+                ('start_time', True, u'1@example.com'),
+                ('id', u'1@example.com', {'id': 1}),
+                ('id', u'1@example.com', None)]:
+            url = '/v1/events?sort_by=%s&cursor=%s' % (
+                sort_by, quote(encode_cursor(sort_by, value, id)))
+            response = self.app.get(url, status=400)
+            self.assertErrorMessage(response, 'Invalid cursor')
+
+    def test_hidden_fields_are_not_sorting_criteria(self):
+        for sort_by in ('fingerprint', 'deleted'):
+            response = self.app.get('/v1/events?sort_by=' + sort_by,
+                                    status=400)
+            self.assertErrorMessage(response, 'not a valid sorting')
+
+    def test_without_total_count(self):
+        self.create_event(title=u'Événement')
+        response = self.app.get_json('/v1/events?total_count=false')
+        self.assertNotIn('total_count', response['collection'])
+        self.assertEqual(response['collection']['current_count'], 1)
+
+    def create_event_with_relations(self, i):
+        media = [{'url': u'http://example.com/%s' % i, 'license': u'CC BY'}]
+        return self.create_event(
+            title=u'Événement %s' % i,
+            location_name=u'Lieu %s' % i,
+            tags=[u'tag%s' % i, u'tag'],
+            categories=[u'category%s' % i],
+            images=media, videos=media, sounds=media,
+        )
+
+    def test_list_events_query_count(self):
+        for i in range(10):
+            self.create_event_with_relations(i)
+        DBSession.flush()
+        DBSession.expire_all()
+        with QueryCounter() as counter:
+            response = self.app.get_json('/v1/events')
+        items = response['collection']['items']
+        self.assertEqual(len(items), 10)
+        data = data_list_to_dict(items[3]['data'])
+        self.assertEqual(data['location_name'], u'Lieu 3')
+        self.assertEqual(sorted(data['tags']), [u'tag', u'tag3'])
+        self.assertEqual(data['sounds'][0]['url'], u'http://example.com/3')
+        # count, events with locations, tags, categories and media
+        self.assertEqual(counter.count, 5)
+
+    def bulk_data(self, count, title=u'Event'):
+        return [{'id': u'%s@example.com' % i, 'title': u'%s %s' % (title, i),
+                 'start_time': u'2014-01-25T15:00:00',
+                 'tags': [u'tag%s' % i, u'tag'],
+                 'location_name': u'Lieu %s' % i}
+                for i in range(count)]
+
+    def test_bulk_post_query_count(self):
+        with QueryCounter() as counter:
+            response = self.post_events(self.bulk_data(20))
+        self.assertEqual(len(response.json['collection']['items']), 20)
+        self.assertEqual(DBSession.query(Event).count(), 20)
+        self.assertNotIn('location', response.headers)
+        small_count = counter.count
+        self.post_events(self.bulk_data(5))
+        DBSession.expire_all()
+        # Updating or inserting more events does not add queries per event
+        with QueryCounter() as counter:
+            self.post_events(self.bulk_data(40, u'Updated'))
+        self.assertLessEqual(counter.count, small_count + 6)
+        self.assertTitleEqual(u'3@example.com', u'Updated 3')
+        self.assertEqual(DBSession.query(Event).count(), 40)
+
+    def test_bulk_post_same_id_twice(self):
+        events_data = self.bulk_data(2)
+        events_data[1]['id'] = events_data[0]['id']
+        response = self.post_events(events_data)
+        self.assertEqual(len(response.json['collection']['items']), 2)
+        self.assertTitleEqual(u'0@example.com', u'Event 1')
+
+    def test_bulk_post_event_of_another_provider(self):
+        self.create_event(id=u'1@example.com', title=u'Other',
+                          provider_id=u'456')
+        DBSession.flush()
+        response = self.post_events(self.bulk_data(3), status=403)
+        items = response.json['collection']['items']
+        self.assertEqual(len(items), 1)
+        self.assertEqual(data_list_to_dict(items[0]['data'])['title'],
+                         u'Other')
+        self.assertEqual(DBSession.query(Event).count(), 1)
+        # Tags of the rejected events are not created either
+        self.assertEqual(DBSession.query(Tag).count(), 0)
+
+    def create_deleted_event(self):
+        event = self.create_event(id=u'1@example.com', title=u'Harvested',
+                                  provider_id=u'123', deleted=True,
+                                  fingerprint=u'0' * 40)
+        DBSession.flush()
+        return event
+
+    def test_post_brings_back_deleted_event(self):
+        event = self.create_deleted_event()
+        self.post_events(self.bulk_data(2))
+        self.assertFalse(event.deleted)
+        self.assertIsNone(event.fingerprint)
+        response = self.app.get('/v1/events/1@example.com', headers={
+            'Accept': COLLECTION_JSON_MIMETYPE})
+        self.assertEqual(len(response.json['collection']['items']), 1)
+
+    def test_put_brings_back_deleted_event(self):
+        event = self.create_deleted_event()
+        self.app.put_json('/v1/events/1@example.com', {
+            'template': {'data': [
+                {'name': u'title', 'value': u'Updated'},
+                {'name': u'start_time', 'value': u'2014-01-25T09:00'},
+            ]}
+        }, headers=self.WRITE_HEADERS)
+        self.assertFalse(event.deleted)
+        self.app.get('/v1/events/1@example.com')
+
+    def test_get_event_query_count(self):
+        event_id = self.create_event_with_relations(1).id
+        DBSession.flush()
+        DBSession.expire_all()
+        with QueryCounter() as counter:
+            self.app.get_json('/v1/events/%s' % event_id, headers={
+                'Accept': COLLECTION_JSON_MIMETYPE})
+        self.assertEqual(counter.count, 4)
+
     def test_get_event(self):
         id = self.post_event()
 
@@ -517,3 +696,48 @@ class TestJson(TestEventMixin, TestCase):
         collection = response.json['collection']
         events = collection['items']
         self.assertEqual(len(events), 0)
+
+
+class TestParallelValidation(TestEventMixin, TestCase):
+
+    SETTINGS = {
+        'ode.validation.processes': '2',
+        'ode.validation.parallel_threshold': '3',
+    }
+
+    def tearDown(self):
+        super(TestParallelValidation, self).tearDown()
+        parallel.close()
+
+    def events_data(self, count):
+        return [{'id': u'%s@example.com' % i, 'title': u'Event %s' % i,
+                 'start_time': u'2014-01-25T15:00:00'}
+                for i in range(count)]
+
+    def test_post_large_collection(self):
+        response = self.post_events(self.events_data(5))
+        self.assertEqual(len(response.json['collection']['items']), 5)
+        self.assertTitleEqual(u'4@example.com', u'Event 4')
+
+    def test_errors_of_large_collection(self):
+        events_data = self.events_data(5)
+        events_data[1]['title'] = u'x' * (SAFE_MAX_LENGTH + 1)
+        del events_data[3]['start_time']
+        response = self.post_events(events_data, status=400)
+        errors = dict((error['name'], error['description'])
+                      for error in response.json['errors'])
+        self.assertEqual(sorted(errors), ['items.1.data.title',
+                                          'items.3.data.start_time'])
+        self.assertIn('Longer than maximum', errors['items.1.data.title'])
+        self.assertEqual(errors['items.3.data.start_time'], 'Required')
+        self.assertEqual(DBSession.query(Event).count(), 0)
+
+    def test_workers_are_started_with_the_application(self):
+        # Not from a request thread
+        self.assertIsNotNone(parallel.shared_validator(3).pool)
+
+    def test_small_collection_validated_serially(self):
+        validate = self.patch('ode.validation.parallel.'
+                              'ParallelValidator.validate')
+        self.post_events(self.events_data(2))
+        self.assertFalse(validate.called)
@@ -2,8 +2,9 @@
 from unittest import TestCase
 from datetime import datetime
 
-from ode.models import DBSession
+from ode.models import DBSession, Event, Source, Tag
 from ode.tests.event import TestEventMixin
+from ode.tests.support import QueryCounter
 
 
 class TestModel(TestEventMixin, TestCase):
@@ -58,3 +59,68 @@ class TestModel(TestEventMixin, TestCase):
         self.assertTrue(event.id.endswith("@example.com"))
         self.assertEqual(event.tags[0].name, 'tag')
         self.assertEqual(event.categories[0].name, 'tag')
+
+    def test_preload_tags(self):
+        self.create_event(tags=['existing'])
+        DBSession.flush()
+        appstructs = [
+            {'tags': ['existing', 'new'], 'categories': ['category']},
+            {'tags': ['new'], 'categories': ['existing']},
+        ]
+        with QueryCounter() as counter:
+            Event.preload_related(appstructs)
+        self.assertEqual(counter.count, 1)
+        DBSession.flush()
+        with QueryCounter() as counter:
+            event1 = self.create_event(**appstructs[0])
+            event2 = self.create_event(**appstructs[1])
+        self.assertEqual(counter.count, 0)
+        DBSession.flush()
+        self.assertIs(event1.tags[1], event2.tags[0])
+        self.assertIs(event1.tags[0], event2.categories[0])
+        self.assertEqual(DBSession.query(Tag).count(), 3)
+
+    def test_same_new_tag_in_two_events_without_preload(self):
+        event1 = self.create_event(tags=['new'])
+        event2 = self.create_event(tags=['new'])
+        DBSession.flush()
+        self.assertIs(event1.tags[0], event2.tags[0])
+        self.assertEqual(DBSession.query(Tag).count(), 1)
+
+    def test_to_data_list(self):
+        event = self.create_event(title=u'Title', location_name=u'Évian',
+                                  tags=['tag1', 'tag2'])
+        DBSession.flush()
+        data = dict((field['name'], field['value'])
+                    for field in event.to_data_list())
+        self.assertEqual(data['title'], u'Title')
+        self.assertEqual(data['location_name'], u'Évian')
+        self.assertEqual(data['tags'], ['tag1', 'tag2'])
+        self.assertNotIn('description', data)
+        self.assertNotIn('categories', data)
+
+    def test_data_serializer_built_once(self):
+        self.assertIs(Event.data_serializer(), Event.data_serializer())
+        self.assertIsNot(Event.data_serializer(), Source.data_serializer())
+
+    def test_rows_serialize_like_events(self):
+        media = [{'url': u'http://example.com/', 'license': u'CC BY'}]
+        self.create_event(title=u'Événement', location_name=u'Évian',
+                          start_time=datetime(2014, 1, 25, 15),
+                          tags=['tag2', 'tag1'], categories=['category'],
+                          images=media, sounds=media)
+        self.create_event(title=u'Sans lieu')
+        DBSession.flush()
+        DBSession.expire_all()
+
+        events = DBSession.query(Event).order_by(Event.id).all()
+        Event.load_media(events)
+        rows = Event.rows_query().order_by(Event.id).all()
+        with QueryCounter() as counter:
+            related = Event.load_related_values([row.id for row in rows])
+        self.assertEqual(counter.count, 3)
+        serializer = Event.data_serializer()
+        self.assertEqual(
+            [list(serializer.from_row(row, related[row.id]).items())
+             for row in rows],
+            [list(event.to_data_dict().items()) for event in events])
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from ode.models import (
     DBSession,
     Base
@@ -14,3 +14,23 @@ def initTestingDB():
     #    model = Page('FrontPage', 'This is the front page')
     #    DBSession.add(model)
     return DBSession
+
+
+class QueryCounter(object):
+    """
+    Context manager counting SQL statements sent through DBSession.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def callback(self, *args, **kwargs):
+        self.count += 1
+
+    def __enter__(self):
+        self.engine = DBSession.get_bind()
+        event.listen(self.engine, 'before_cursor_execute', self.callback)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self.callback)
@@ -0,0 +1,105 @@
+# -*- encoding: utf-8 -*-
+from unittest import TestCase
+
+from ode.cache import ResponseCache, generation, invalidate
+from ode.models import DBSession
+from ode.resources.base import COLLECTION_JSON_MIMETYPE
+from ode.tests.event import TestEventMixin
+from ode.tests.support import QueryCounter
+
+
+class TestResponseCache(TestCase):
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(max_entries=2)
+        cache.set('a', 1, generation())
+        cache.set('b', 2, generation())
+        cache.get('a')
+        cache.set('c', 3, generation())
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_invalidate(self):
+        cache = ResponseCache(max_entries=2)
+        cache.set('a', 1, generation())
+        invalidate()
+        self.assertIsNone(cache.get('a'))
+
+    def test_response_built_during_write_is_not_cached(self):
+        cache = ResponseCache(max_entries=2)
+        entry_generation = generation()
+        invalidate()
+        cache.set('a', 1, entry_generation)
+        self.assertIsNone(cache.get('a'))
+
+    def test_expiry(self):
+        cache = ResponseCache(max_entries=2, max_age=-1)
+        cache.set('a', 1, generation())
+        self.assertIsNone(cache.get('a'))
+
+
+class TestCachedEvents(TestEventMixin, TestCase):
+
+    SETTINGS = {'ode.cache.max_entries': '10'}
+
+    def get(self, url, **kwargs):
+        headers = {'Accept': COLLECTION_JSON_MIMETYPE}
+        headers.update(kwargs.pop('headers', {}))
+        return self.app.get(url, headers=headers, **kwargs)
+
+    def test_cached_response(self):
+        self.create_event(title=u'Événement')
+        DBSession.flush()
+        response = self.get('/v1/events')
+        with QueryCounter() as counter:
+            cached = self.get('/v1/events')
+        self.assertEqual(counter.count, 0)
+        self.assertEqual(cached.body, response.body)
+        self.assertEqual(cached.etag, response.etag)
+        self.assertEqual(cached.content_type, COLLECTION_JSON_MIMETYPE)
+
+    def test_query_string_is_normalized(self):
+        response = self.get('/v1/events?limit=5&offset=1')
+        with QueryCounter() as counter:
+            self.get('/v1/events?offset=1&limit=5')
+        self.assertEqual(counter.count, 0)
+        with QueryCounter() as counter:
+            self.get('/v1/events?offset=2&limit=5')
+        self.assertNotEqual(counter.count, 0)
+        self.assertTrue(response.etag)
+
+    def test_accept_is_part_of_the_key(self):
+        self.create_event(title=u'Événement')
+        DBSession.flush()
+        self.get('/v1/events')
+        response = self.get('/v1/events', headers={'Accept': 'text/csv'})
+        self.assertEqual(response.content_type, 'text/csv')
+
+    def test_not_modified(self):
+        response = self.get('/v1/events')
+        etag = response.headers['ETag']
+        response = self.get('/v1/events', headers={'If-None-Match': etag},
+                            status=304)
+        self.assertEqual(response.body, b'')
+
+    def test_write_invalidates(self):
+        self.get('/v1/events')
+        self.post_event()
+        response = self.get('/v1/events')
+        self.assertEqual(len(response.json['collection']['items']), 1)
+
+    def test_delete_invalidates(self):
+        event = self.create_event(title=u'Événement', provider_id='123')
+        DBSession.flush()
+        self.get('/v1/events/%s' % event.id)
+        self.app.delete('/v1/events/%s' % event.id,
+                        headers=self.PROVIDER_ID_HEADER, status=204)
+        # Done by pyramid_tm outside of tests
+        DBSession.flush()
+        self.get('/v1/events/%s' % event.id, status=404)
+
+    def test_stream_is_not_cached(self):
+        response = self.get('/v1/events?stream=true',
+                            headers={'Accept': 'text/csv'})
+        self.assertNotIn('ETag', response.headers)
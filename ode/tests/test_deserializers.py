@@ -1,9 +1,18 @@
 # -*- encoding: utf-8 -*-
 from unittest import TestCase
 
+from datetime import timedelta
+
+from cornice.errors import Errors
+from ics import Event
+from mock import patch
+
 from ode.deserializers import (
     data_list_to_dict,
     icalendar_extractor,
+    iter_icalendar_items,
+    iter_collection_items,
+    guess_format,
     json_extractor,
     csv_extractor
     )
@@ -196,6 +205,201 @@ class TestExtractor(TestCase):
         self.assertDictEqual(cstruct, self.cstruct_csv)
 
 
+class TestStreamingIcalendar(TestCase):
+
+    class DummyRequest(object):
+
+        def __init__(self):
+            self.errors = Errors()
+
+    def test_chunked_body(self):
+        request = self.DummyRequest()
+        chunks = [ics_sample[i:i + 7] for i in range(0, len(ics_sample), 7)]
+        items = list(iter_icalendar_items(iter(chunks), request))
+        self.assertEqual(items, TestExtractor.cstruct_ics['items'])
+        self.assertFalse(request.errors)
+
+    def test_invalid_event_does_not_abort_feed(self):
+        request = self.DummyRequest()
+        bogus_event = ('BEGIN:VEVENT\n'
+                       'SUMMARY:Bogus\n'
+                       'DTSTART;VALUE=DATE-TIME:BOGUS\n'
+                       'END:VEVENT\n')
+        body = ics_sample.replace('BEGIN:VEVENT',
+                                  bogus_event + 'BEGIN:VEVENT')
+        items = list(iter_icalendar_items(body, request))
+        self.assertEqual(items, TestExtractor.cstruct_ics['items'])
+        self.assertEqual(len(request.errors), 1)
+        self.assertEqual(request.errors[0]['name'], 'items.0')
+        self.assertIn('Invalid iCalendar event',
+                      request.errors[0]['description'])
+
+    def test_truncated_calendar(self):
+        request = self.DummyRequest()
+        body = ics_sample.split('END:VEVENT')[0]
+        items = list(iter_icalendar_items(body, request))
+        self.assertEqual(items, [])
+        self.assertIn('Invalid iCalendar request body',
+                      request.errors[0]['description'])
+
+    def test_timezone_defined_after_event(self):
+        request = self.DummyRequest()
+        body = (
+            'BEGIN:VCALENDAR\n'
+            'BEGIN:VEVENT\n'
+            'UID:1@example.com\n'
+            'DTSTART;TZID=Custom Zone:20140125T150000\n'
+            'SUMMARY:Before\n'
+            'END:VEVENT\n'
+            'BEGIN:VTIMEZONE\n'
+            'TZID:Custom Zone\n'
+            'BEGIN:STANDARD\n'
+            'DTSTART:19701025T030000\n'
+            'TZOFFSETFROM:+0200\n'
+            'TZOFFSETTO:+0500\n'
+            'END:STANDARD\n'
+            'END:VTIMEZONE\n'
+            'BEGIN:VEVENT\n'
+            'UID:2@example.com\n'
+            'DTSTART;TZID=Europe/Paris:20140125T150000\n'
+            'SUMMARY:After\n'
+            'END:VEVENT\n'
+            'END:VCALENDAR\n'
+        )
+        begins = []
+
+        def from_container(container, tz):
+            event = from_container.wrapped(container, tz=tz)
+            begins.append((event.name, event.begin.utcoffset()))
+            return event
+
+        from_container.wrapped = Event._from_container
+        with patch('ode.deserializers.Event._from_container',
+                   from_container):
+            items = list(iter_icalendar_items(body, request))
+        self.assertFalse(request.errors)
+        self.assertEqual(len(items), 2)
+        # The first event is parsed once its timezone is
+        self.assertEqual(begins, [(u'Before', timedelta(hours=5)),
+                                  (u'After', timedelta(hours=1))])
+
+    undefined_timezone_event = (
+        'BEGIN:VEVENT\n'
+        'UID:%(uid)s@example.com\n'
+        'DTSTART;TZID=Undefined Zone:20140125T150000\n'
+        'SUMMARY:%(uid)s\n'
+        'END:VEVENT\n'
+    )
+
+    def calendar(self, *uids):
+        return ('BEGIN:VCALENDAR\n' + ''.join(
+            self.undefined_timezone_event % {'uid': uid} for uid in uids) +
+            'END:VCALENDAR\n')
+
+    def test_undefined_timezone_falls_back_to_utc(self):
+        request = self.DummyRequest()
+        body = self.calendar('first', 'second')
+        # Defined too late, in another calendar
+        body += (
+            'BEGIN:VCALENDAR\n'
+            'BEGIN:VTIMEZONE\n'
+            'TZID:Undefined Zone\n'
+            'BEGIN:STANDARD\n'
+            'DTSTART:19701025T030000\n'
+            'TZOFFSETFROM:+0200\n'
+            'TZOFFSETTO:+0500\n'
+            'END:STANDARD\n'
+            'END:VTIMEZONE\n'
+            'END:VCALENDAR\n'
+        )
+        items = iter_icalendar_items(body, request)
+        self.assertEqual(next(items)['data']['title'], u'first')
+        self.assertEqual(next(items)['data']['title'], u'second')
+        self.assertEqual(list(items), [])
+        self.assertFalse(request.errors)
+
+    def test_pending_events_are_bounded(self):
+        request = self.DummyRequest()
+        # Truncated, so that only events parsed beyond the limit are yielded
+        body = self.calendar('first', 'second', 'third').replace(
+            'END:VCALENDAR\n', '')
+        with patch('ode.deserializers.MAX_PENDING_EVENTS', 1):
+            titles = [item['data']['title']
+                      for item in iter_icalendar_items(body, request)]
+        self.assertEqual(titles, [u'first', u'second'])
+        self.assertEqual(len(request.errors), 1)
+
+    def test_truncated_calendar_drops_pending_events(self):
+        request = self.DummyRequest()
+        body = self.calendar('first').replace('END:VCALENDAR\n', '')
+        items = list(iter_icalendar_items(body, request))
+        self.assertEqual(items, [])
+        self.assertEqual(len(request.errors), 1)
+        self.assertIn('Invalid iCalendar request body',
+                      request.errors[0]['description'])
+
+
+class TestStreamingCollectionJson(TestCase):
+
+    class DummyRequest(object):
+
+        def __init__(self):
+            self.errors = Errors()
+
+    collection = (
+        u'{"collection": {"version": "1.0", "items": ['
+        u'{"href": "http://example.com/1", "data": ['
+        u'{"name": "title", "value": "Un"}, {"name": "capacity", '
+        u'"value": 12345}]}, '
+        u'{"data": [{"name": "title", "value": "Deux"}]}'
+        u'], "total_count": 2}}'
+    )
+
+    def test_chunked_body(self):
+        request = self.DummyRequest()
+        items = list(iter_collection_items(iter(self.collection), request))
+        self.assertEqual(items, [
+            {'data': {'title': u'Un', 'capacity': 12345}},
+            {'data': {'title': u'Deux'}},
+        ])
+        self.assertFalse(request.errors)
+
+    def test_invalid_item(self):
+        request = self.DummyRequest()
+        body = self.collection.replace(u'{"data": [{"name": "title", "value'
+                                       u'": "Deux"}]}', u'42')
+        items = list(iter_collection_items(body, request))
+        self.assertEqual(len(items), 1)
+        self.assertEqual(request.errors[0]['name'], 'items.1')
+
+    def test_empty_collection(self):
+        request = self.DummyRequest()
+        body = u'{"collection": {"version": "1.0", "items": []}}'
+        self.assertEqual(list(iter_collection_items(body, request)), [])
+        self.assertFalse(request.errors)
+
+    def test_malformed_json(self):
+        request = self.DummyRequest()
+        items = list(iter_collection_items(self.collection[:-1], request))
+        self.assertEqual(len(items), 2)
+        self.assertIn('Invalid JSON request body',
+                      request.errors[0]['description'])
+
+    def test_extra_data(self):
+        request = self.DummyRequest()
+        list(iter_collection_items(self.collection + u'}', request))
+        self.assertIn('Extra data', request.errors[0]['description'])
+
+    def test_guess_format(self):
+        self.assertEqual(guess_format('application/vnd.collection+json', ''),
+                         'json')
+        self.assertEqual(guess_format('text/calendar; charset=utf-8', '{'),
+                         'icalendar')
+        self.assertEqual(guess_format('text/plain', u'\ufeff\n {"a": 1}'),
+                         'json')
+        self.assertEqual(guess_format(None, ics_sample), 'icalendar')
+
+
 class TestDataListToDict(TestCase):
 
     def test_unique_values(self):
@@ -1,10 +1,20 @@
 # -*- encoding: utf-8 -*-
+import datetime
+import json
+import threading
+import time
 from unittest import TestCase
 from mock import Mock
+import transaction
 
-from ode.models import Event, DBSession
+from ode.models import Event, DBSession, Source, MAX_HARVEST_BACKOFF
 from ode.tests.event import TestEventMixin
-from ode.harvesting import harvest
+from ode.tests.support import QueryCounter
+from ode.validation import parallel
+from ode.validation.schema import EventSchema
+from ode.harvesting import harvest, harvest_cstruct, FETCH_TIMEOUT
+from ode.harvesting import delete_missing_events, HarvestScheduler
+from ode.harvesting import harvest_response, HarvestStats, SourceFetcher
 
 
 valid_icalendar = u"""
@@ -118,22 +128,35 @@ valid_json = (
     )
 
 
+def mock_response(body_text=valid_icalendar, status_code=200, headers=None,
+                  chunk_size=None):
+    """
+    Streamed response, its body being sent chunk_size bytes at a time
+    """
+    content = body_text.encode('utf-8')
+    chunk_size = chunk_size or len(content) or 1
+    chunks = [content[i:i + chunk_size]
+              for i in range(0, len(content), chunk_size)]
+    return Mock(status_code=status_code, headers=headers or {},
+                encoding='utf-8',
+                iter_content=Mock(side_effect=lambda size: iter(chunks)))
+
+
 class TestHarvesting(TestEventMixin, TestCase):
 
     def setup_requests_mock(self, content_type='text/calendar',
-                            body_text=valid_icalendar):
+                            body_text=valid_icalendar, headers=None):
         self.mock_requests = self.patch('ode.harvesting.requests')
-        self.mock_requests.get.return_value = Mock(
-            status_code=200,
-            content_type=content_type,
-            text=body_text,
-        )
+        headers = dict(headers or {}, **{'Content-Type': content_type})
+        self.mock_requests.get.return_value = mock_response(body_text,
+                                                            headers=headers)
 
     def test_fetch_data_from_source(self):
         self.setup_requests_mock()
         source = self.make_source()
         harvest()
-        self.mock_requests.get.assert_called_with(source.url)
+        self.mock_requests.get.assert_called_with(
+            source.url, headers={}, timeout=FETCH_TIMEOUT, stream=True)
         event = DBSession.query(Event).one()
         self.assertEqual(event.title, u"Capitole du Libre")
         self.assertEqual(event.url,
@@ -146,19 +169,41 @@ class TestHarvesting(TestEventMixin, TestCase):
                                  body_text=valid_json)
         source = self.make_source()
         harvest()
-        self.mock_requests.get.assert_called_with(source.url)
+        self.mock_requests.get.assert_called_with(
+            source.url, headers={}, timeout=FETCH_TIMEOUT, stream=True)
         event = DBSession.query(Event).one()
         self.assertEqual(event.title, u"Test medias")
         self.assertEqual(event.description,
                          u"Description")
 
+    def test_feed_is_read_chunk_by_chunk(self):
+        self.setup_requests_mock()
+        body_text = valid_json.replace(u'Description', u'Évènement')
+        responses = {}
+        for feed_format, text in (('json', body_text),
+                                  ('icalendar', valid_icalendar)):
+            url = u'http://example.com/%s' % feed_format
+            # Multibyte characters are split across chunks
+            responses[url] = mock_response(text, chunk_size=7)
+            self.make_source(url=url)
+        self.mock_requests.get.side_effect = (
+            lambda url, **kwargs: responses[url])
+        all_stats = harvest()
+        self.assertEqual(sorted(stats.bytes for stats in all_stats),
+                         sorted(len(text.encode('utf-8'))
+                                for text in (body_text, valid_icalendar)))
+        self.assertEqual(DBSession.query(Event).count(), 2)
+        event = DBSession.query(Event).filter_by(title=u"Test medias").one()
+        self.assertEqual(event.description, u'Évènement')
+
     def test_update_from_uid_missing_domain_part(self):
         self.create_event(title=u'Existing event', id=u'1234@example.com')
         DBSession.flush()
         self.setup_requests_mock(body_text=uid_missing_domain_part)
         source = self.make_source()
         harvest()
-        self.mock_requests.get.assert_called_with(source.url)
+        self.mock_requests.get.assert_called_with(
+            source.url, headers={}, timeout=FETCH_TIMEOUT, stream=True)
         event = DBSession.query(Event).one()
         self.assertEqual(event.title, u"Capitole du Libre")
 
@@ -168,7 +213,8 @@ class TestHarvesting(TestEventMixin, TestCase):
         self.setup_requests_mock(body_text=valid_icalendar)
         source = self.make_source()
         harvest()
-        self.mock_requests.get.assert_called_with(source.url)
+        self.mock_requests.get.assert_called_with(
+            source.url, headers={}, timeout=FETCH_TIMEOUT, stream=True)
         event = DBSession.query(Event).one()
         self.assertEqual(event.title, u"Capitole du Libre")
 
@@ -176,13 +222,15 @@ class TestHarvesting(TestEventMixin, TestCase):
         self.setup_requests_mock(body_text=start_time_missing)
         source = self.make_source()
         harvest()
-        self.mock_requests.get.assert_called_with(source.url)
+        self.mock_requests.get.assert_called_with(
+            source.url, headers={}, timeout=FETCH_TIMEOUT, stream=True)
         self.assertEqual(DBSession.query(Event).count(), 0)
 
     def test_fix_calendar_with_timezone_aware_datetimes(self):
         self.setup_requests_mock(body_text=icalendar_with_timezone)
-        self.make_source()
+        source = self.make_source()
         harvest()
+        source.reset_validators()
         harvest()  # Second call was crashing
 
     def test_bogus_icalendar_data_does_not_crash_harvesting(self):
@@ -191,18 +239,12 @@ class TestHarvesting(TestEventMixin, TestCase):
                                    provider_id='123')
         self.make_source(url=u"http://example.com/b", provider_id='456')
         self.setup_requests_mock()
-        self.mock_requests.get.side_effect = [
-            Mock(
-                status_code=200,
-                content_type='text/calendar',
-                text='*** BOGUS DATA ***',
-            ),
-            Mock(
-                status_code=200,
-                content_type='text/calendar',
-                text=valid_icalendar,
-            ),
-        ]
+        responses = {
+            u"http://example.com/a": mock_response(u'*** BOGUS DATA ***'),
+            u"http://example.com/b": mock_response(valid_icalendar),
+        }
+        self.mock_requests.get.side_effect = (
+            lambda url, **kwargs: responses[url])
         harvest()
         self.assertEqual(DBSession.query(Event).count(), 1)
         expected_messasge = "Invalid iCalendar request body: "
@@ -221,3 +263,489 @@ class TestHarvesting(TestEventMixin, TestCase):
         harvest()
         self.assertEqual(DBSession.query(Event).count(), 0)
         log_mock.warning.assert_any_call(u"Invalid Collection+JSON input")
+
+    def test_fetch_error_does_not_stop_other_sources(self):
+        log_mock = self.patch('ode.harvesting.log')
+        source1 = self.make_source(url=u"http://example.com/a")
+        self.make_source(url=u"http://example.org/b")
+        self.setup_requests_mock()
+        valid_response = self.mock_requests.get.return_value
+
+        def get(url, **kwargs):
+            if url == source1.url:
+                raise IOError("Connection refused")
+            return valid_response
+
+        self.mock_requests.get.side_effect = get
+        harvest()
+        self.assertEqual(DBSession.query(Event).count(), 1)
+        message = u"Failed to harvest source {} with URL {}".format(
+            source1.id, source1.url)
+        self.assertEqual(log_mock.warning.call_args[0][0], message)
+
+    def test_concurrent_requests_per_host_are_limited(self):
+        for i in range(6):
+            self.make_source(url=u"http://example.com/%s" % i)
+        self.setup_requests_mock(body_text=u'')
+        response = self.mock_requests.get.return_value
+        lock = threading.Lock()
+        counters = {'running': 0, 'max_running': 0}
+
+        def get(url, **kwargs):
+            with lock:
+                counters['running'] += 1
+                counters['max_running'] = max(counters['max_running'],
+                                              counters['running'])
+            time.sleep(0.01)
+            with lock:
+                counters['running'] -= 1
+            return response
+
+        self.mock_requests.get.side_effect = get
+        harvest(max_workers=4, max_per_host=2)
+        self.assertEqual(self.mock_requests.get.call_count, 6)
+        self.assertEqual(counters['max_running'], 2)
+
+    def test_fetched_responses_wait_for_the_harvest(self):
+        for i in range(6):
+            self.make_source(url=u"http://example.com/%s" % i)
+        self.setup_requests_mock(body_text=u'')
+        fetcher = SourceFetcher(max_workers=2)
+        results = fetcher.fetch_all(DBSession.query(Source).all())
+        next(results)
+        time.sleep(0.05)
+        # One response taken, two more fetched ahead
+        self.assertEqual(self.mock_requests.get.call_count, 3)
+        self.assertEqual(len(list(results)), 5)
+
+    def test_stopped_fetch_releases_workers(self):
+        for i in range(6):
+            self.make_source(url=u"http://example.com/%s" % i)
+        responses = []
+
+        def fetch(url, headers):
+            response = Mock()
+            responses.append(response)
+            return response
+
+        self.patch('ode.harvesting.fetch', side_effect=fetch)
+        thread_count = threading.active_count()
+        results = SourceFetcher(max_workers=2).fetch_all(
+            DBSession.query(Source).all())
+        _, taken, _, _ = next(results)
+        time.sleep(0.05)
+        # Eg. an exception while harvesting the first response
+        results.close()
+        for _ in range(100):
+            if threading.active_count() == thread_count:
+                break
+            time.sleep(0.01)
+        self.assertEqual(threading.active_count(), thread_count)
+        self.assertEqual(len(responses), 3)
+        self.assertEqual([response.body.close.called
+                          for response in responses if response is not taken],
+                         [True, True])
+
+    def test_store_http_validators(self):
+        self.setup_requests_mock(headers={
+            'ETag': '"abc"',
+            'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT',
+        })
+        source = self.make_source()
+        harvest()
+        self.assertEqual(source.etag, '"abc"')
+        self.assertEqual(source.last_modified,
+                         'Wed, 21 Oct 2015 07:28:00 GMT')
+        self.assertIsNotNone(source.content_hash)
+
+    def test_send_conditional_headers(self):
+        self.setup_requests_mock()
+        source = self.make_source()
+        source.etag = u'"abc"'
+        source.last_modified = u'Wed, 21 Oct 2015 07:28:00 GMT'
+        harvest()
+        self.mock_requests.get.assert_called_with(
+            source.url,
+            headers={
+                'If-None-Match': '"abc"',
+                'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT',
+            },
+            timeout=FETCH_TIMEOUT, stream=True)
+
+    def test_not_modified_source_is_skipped(self):
+        harvest_cstruct_mock = self.patch('ode.harvesting.harvest_cstruct')
+        self.setup_requests_mock()
+        self.mock_requests.get.return_value.status_code = 304
+        self.make_source()
+        harvest()
+        self.assertFalse(harvest_cstruct_mock.called)
+
+    def test_unchanged_content_is_skipped(self):
+        self.setup_requests_mock()
+        self.make_source()
+        harvest()
+        harvest_cstruct_mock = self.patch('ode.harvesting.harvest_cstruct')
+        harvest()
+        self.assertFalse(harvest_cstruct_mock.called)
+        self.assertEqual(DBSession.query(Event).count(), 1)
+
+    def test_unchanged_content_stores_validators(self):
+        self.setup_requests_mock()
+        source = self.make_source()
+        harvest()
+        self.mock_requests.get.return_value = mock_response(headers={
+            'ETag': '"def"',
+            'Last-Modified': 'Thu, 22 Oct 2015 07:28:00 GMT',
+        })
+        harvest()
+        self.assertEqual(source.etag, '"def"')
+        self.assertEqual(source.last_modified,
+                         'Thu, 22 Oct 2015 07:28:00 GMT')
+
+    def test_changing_url_resets_validators(self):
+        source = self.make_source()
+        source.etag = u'"abc"'
+        source.content_hash = 'foo'
+        source.update_from_appstruct({'url': u'http://example.com/other'})
+        self.assertIsNone(source.etag)
+        self.assertIsNone(source.content_hash)
+
+    def make_cstruct(self, uids):
+        return {
+            'items': [
+                {'data': {
+                    'id': uid,
+                    'title': u'Event %s' % uid,
+                    'start_time': u'2014-01-25T15:00:00',
+                }}
+                for uid in uids
+            ]
+        }
+
+    def test_harvest_cstruct_in_chunks(self):
+        self.create_event(title=u'Existing event', id=u'2@example.com')
+        DBSession.flush()
+        source = self.make_source()
+        get_by_ids = self.patch('ode.harvesting.Event.get_by_ids',
+                                wraps=Event.get_by_ids)
+        cstruct = self.make_cstruct([u'1', u'2', u'3', u'4', u'5'])
+        harvest_cstruct(cstruct, source, chunk_size=2)
+        self.assertEqual(get_by_ids.call_count, 3)
+        self.assertEqual(DBSession.query(Event).count(), 5)
+        self.assertTitleEqual(u'2@example.com', u'Event 2')
+
+    def test_harvest_cstruct_duplicate_uid_in_chunk(self):
+        source = self.make_source()
+        cstruct = self.make_cstruct([u'1', u'2', u'1'])
+        cstruct['items'][2]['data']['title'] = u'Updated'
+        harvest_cstruct(cstruct, source)
+        self.assertEqual(DBSession.query(Event).count(), 2)
+        self.assertTitleEqual(u'1@example.com', u'Updated')
+
+    def test_unchanged_events_are_skipped(self):
+        source = self.make_source()
+        harvest_cstruct(self.make_cstruct([u'1', u'2']), source)
+        validate = self.patch('ode.harvesting.EventCstruct.validate',
+                              autospec=True,
+                              side_effect=lambda self: EventSchema(
+                              ).deserialize(self.cstruct['data']))
+        cstruct = self.make_cstruct([u'1', u'2'])
+        cstruct['items'][1]['data']['title'] = u'Updated'
+        harvest_cstruct(cstruct, source)
+        self.assertEqual(validate.call_count, 1)
+        self.assertTitleEqual(u'1@example.com', u'Event 1')
+        self.assertTitleEqual(u'2@example.com', u'Updated')
+
+    def reharvest_query_count(self, count):
+        source = self.make_source(url=u'http://example.com/%s' % count)
+        cstruct = self.make_cstruct(
+            [u'%s-%s' % (count, i) for i in range(count)])
+        for item in cstruct['items']:
+            item['data'].update(
+                tags=[u'tag'], location_name=u'Lieu',
+                images=[{'url': u'http://example.com/a.png',
+                         'license': u'CC BY'}])
+        harvest_cstruct(cstruct, source)
+        for item in cstruct['items']:
+            item['data']['title'] = u'Updated'
+        with QueryCounter() as counter:
+            stats = harvest_cstruct(cstruct, source)
+        self.assertEqual(stats.updated, count)
+        return counter.count
+
+    def test_reharvest_query_count(self):
+        # Updated events and their relations are loaded with a few queries
+        # per chunk, only the inserts of their new images add up
+        self.assertLessEqual(self.reharvest_query_count(40),
+                             self.reharvest_query_count(10) + 30)
+
+    def test_harvest_cstruct_stats(self):
+        source = self.make_source()
+        harvest_cstruct(self.make_cstruct([u'1', u'2']), source)
+        cstruct = self.make_cstruct([u'1', u'2', u'3', u'4'])
+        cstruct['items'][1]['data']['title'] = u'Updated'
+        del cstruct['items'][3]['data']['start_time']
+        stats = harvest_cstruct(cstruct, source)
+        self.assertEqual(stats.skipped, 1)
+        self.assertEqual(stats.updated, 1)
+        self.assertEqual(stats.inserted, 1)
+        self.assertEqual(stats.invalid, 1)
+        self.assertEqual(stats.seen_uids, set([
+            u'1@example.com', u'2@example.com', u'3@example.com',
+            u'4@example.com']))
+
+    def test_harvest_cstruct_parallel_validation(self):
+        parallel.configure({'ode.validation.processes': '2',
+                            'ode.validation.parallel_threshold': '2'})
+        self.addCleanup(parallel.close)
+        source = self.make_source()
+        cstruct = self.make_cstruct([u'1', u'2', u'3', u'4'])
+        del cstruct['items'][3]['data']['start_time']
+        stats = harvest_cstruct(cstruct, source, chunk_size=2)
+        self.assertEqual(stats.inserted, 3)
+        self.assertEqual(stats.invalid, 1)
+        self.assertTitleEqual(u'3@example.com', u'Event 3')
+
+    def test_harvest_metrics(self):
+        self.patch('ode.harvesting.log')
+        self.setup_requests_mock()
+        self.make_source()
+        stats, = harvest()
+        self.assertEqual(stats.status, HarvestStats.HARVESTED)
+        self.assertEqual(stats.bytes, len(valid_icalendar.encode('utf-8')))
+        self.assertEqual(stats.parsed, 1)
+        self.assertEqual(stats.inserted, 1)
+        self.assertEqual(list(stats.timings), list(HarvestStats.STAGES))
+        self.assertTrue(all(seconds > 0
+                            for seconds in stats.timings.values()))
+        data = json.loads(stats.to_json())
+        self.assertEqual(data['url'], stats.url)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(set(data['seconds']), set(HarvestStats.STAGES))
+
+    def test_failed_fetch_metrics_are_logged(self):
+        log_mock = self.patch('ode.harvesting.log')
+        self.setup_requests_mock()
+        self.mock_requests.get.side_effect = IOError("Connection refused")
+        self.make_source()
+        harvest()
+        data = json.loads(log_mock.info.call_args[0][0])
+        self.assertEqual(data['status'], HarvestStats.FAILED)
+
+    def test_harvested_events_are_expunged(self):
+        source = self.make_source()
+        harvest_cstruct(self.make_cstruct([u'1', u'2', u'3']), source,
+                        chunk_size=2)
+        self.assertFalse([obj for obj in DBSession.identity_map.values()
+                          if isinstance(obj, Event)])
+        self.assertIn(source, DBSession)
+        self.assertEqual(DBSession.query(Event).count(), 3)
+
+    def test_failing_source_is_rolled_back_alone(self):
+        self.patch('ode.harvesting.log')
+        failing_url = u"http://example.com/a"
+        self.make_source(url=failing_url)
+        self.make_source(url=u"http://example.org/b")
+        self.setup_requests_mock()
+        valid_response = self.mock_requests.get.return_value
+        failing_response = mock_response(
+            valid_icalendar.replace(u'1234@', u'5678@'))
+
+        def get(url, **kwargs):
+            if url == failing_url:
+                return failing_response
+            return valid_response
+
+        def fail_after_writes(source, response, *args):
+            errors = harvest_response(source, response, *args)
+            if response is failing_response:
+                raise ValueError("Harvest failure")
+            return errors
+
+        self.mock_requests.get.side_effect = get
+        self.patch('ode.harvesting.harvest_response',
+                   wraps=fail_after_writes)
+        all_stats = harvest()
+        statuses = dict((stats.url, stats.status) for stats in all_stats)
+        self.assertEqual(statuses[failing_url], HarvestStats.FAILED)
+        self.assertEqual(statuses[u"http://example.org/b"],
+                         HarvestStats.HARVESTED)
+        self.assertEqual(DBSession.query(Event).one().id, u'1234@example.com')
+        failing = DBSession.query(Source).filter_by(url=failing_url).one()
+        self.assertIsNone(failing.content_hash)
+
+    def test_missing_events_are_deleted(self):
+        source = self.make_source()
+        harvest_cstruct(self.make_cstruct([u'1', u'2', u'3']), source)
+        stats = harvest_cstruct(self.make_cstruct([u'1', u'3']), source)
+        self.assertEqual(delete_missing_events(source, stats.seen_uids), 1)
+        DBSession.expire_all()
+        deleted = DBSession.query(Event).filter_by(deleted=True).one()
+        self.assertEqual(deleted.id, u'2@example.com')
+        response = self.app.get_json('/v1/events', headers={
+            'Accept': 'application/vnd.collection+json'})
+        self.assertEqual(response['collection']['total_count'], 2)
+        self.app.get('/v1/events/2@example.com', status=404)
+
+        stats = harvest_cstruct(self.make_cstruct([u'1', u'2']), source)
+        self.assertEqual(delete_missing_events(source, stats.seen_uids), 1)
+        DBSession.expire_all()
+        deleted = DBSession.query(Event).filter_by(deleted=True).one()
+        self.assertEqual(deleted.id, u'3@example.com')
+
+    def test_events_of_other_sources_are_not_deleted(self):
+        source1 = self.make_source(url=u'http://example.com/a')
+        source2 = self.make_source(url=u'http://example.com/b')
+        self.create_event(title=u'Posted event', id=u'posted@example.com')
+        harvest_cstruct(self.make_cstruct([u'1']), source1)
+        harvest_cstruct(self.make_cstruct([u'2']), source2)
+        self.assertEqual(delete_missing_events(source1, set()), 1)
+        DBSession.expire_all()
+        self.assertEqual(
+            DBSession.query(Event).filter_by(deleted=False).count(), 2)
+
+    def test_empty_feed_deletes_events(self):
+        log_mock = self.patch('ode.harvesting.log')
+        self.setup_requests_mock(content_type='application/json',
+                                 body_text=valid_json)
+        self.make_source()
+        harvest()
+        self.mock_requests.get.return_value = mock_response(
+            u'{"collection": {"version": "1.0", "items": []}}')
+        harvest()
+        self.assertFalse(log_mock.warning.called)
+        DBSession.expire_all()
+        self.assertTrue(DBSession.query(Event).one().deleted)
+
+    def test_invalid_feed_does_not_delete_events(self):
+        self.setup_requests_mock()
+        source = self.make_source()
+        harvest()
+        source.reset_validators()
+        self.mock_requests.get.return_value = mock_response(
+            u'BEGIN:VCALENDAR')
+        harvest()
+        DBSession.expire_all()
+        self.assertFalse(DBSession.query(Event).one().deleted)
+
+    def make_scheduler(self, now):
+        scheduler = HarvestScheduler(default_interval=600)
+        scheduler.now = lambda: now
+        return scheduler
+
+    def test_scheduler_commits_each_source(self):
+        self.patch('ode.harvesting.log')
+        now = datetime.datetime(2014, 1, 25, 15)
+        failing_url = u"http://example.com/a"
+        self.make_source(url=failing_url)
+        self.make_source(url=u"http://example.org/b")
+        self.setup_requests_mock()
+        valid_response = self.mock_requests.get.return_value
+        harvest_response = self.patch('ode.harvesting.harvest_response',
+                                      wraps=harvest_response_or_fail)
+
+        def get(url, **kwargs):
+            if url == failing_url:
+                return mock_response(u'fail')
+            return valid_response
+
+        self.mock_requests.get.side_effect = get
+        # The scheduler begins transactions of its own
+        transaction.commit()
+        scheduler = self.make_scheduler(now)
+        self.assertEqual(len(scheduler.harvest_due_sources()), 2)
+        self.assertEqual(harvest_response.call_count, 2)
+
+        self.assertEqual(DBSession.query(Event).count(), 1)
+        failing = DBSession.query(Source).filter_by(url=failing_url).one()
+        self.assertEqual(failing.failure_count, 1)
+        self.assertEqual(failing.next_run,
+                         now + datetime.timedelta(seconds=600))
+        harvested = DBSession.query(Source).filter(
+            Source.url != failing_url).one()
+        self.assertEqual(harvested.failure_count, 0)
+        self.assertEqual(harvested.next_run,
+                         now + datetime.timedelta(seconds=600))
+
+        # The first failure waits for the usual interval
+        self.assertEqual(scheduler.harvest_due_sources(), [])
+        self.assertEqual(scheduler.seconds_until_next_run(), 60)
+        later = now + datetime.timedelta(seconds=600)
+        scheduler.now = lambda: later
+        self.assertEqual(len(scheduler.harvest_due_sources()), 2)
+        # The next one doubles it
+        DBSession.expire_all()
+        failing = DBSession.query(Source).filter_by(url=failing_url).one()
+        self.assertEqual(failing.failure_count, 2)
+        self.assertEqual(failing.next_run,
+                         later + datetime.timedelta(seconds=1200))
+
+    def test_fetch_error_is_backed_off(self):
+        self.patch('ode.harvesting.log')
+        self.setup_requests_mock()
+        self.mock_requests.get.side_effect = IOError("Connection refused")
+        self.make_source()
+        transaction.commit()
+        now = datetime.datetime(2014, 1, 25, 15)
+        self.make_scheduler(now).harvest_due_sources()
+        source = DBSession.query(Source).one()
+        self.assertEqual(source.failure_count, 1)
+        self.assertEqual(source.next_run,
+                         now + datetime.timedelta(seconds=600))
+
+    def test_scheduler_metrics_skip_deleted_sources(self):
+        self.patch('ode.harvesting.log')
+        write_metrics_file = self.patch('ode.harvesting.write_metrics_file')
+        self.setup_requests_mock()
+        self.make_source(url=u"http://example.com/a")
+        self.make_source(url=u"http://example.org/b")
+        transaction.commit()
+        scheduler = HarvestScheduler(metrics_file='harvest.prom')
+        before = time.time()
+        scheduler.run_once()
+        all_stats = list(write_metrics_file.call_args[0][0])
+        self.assertEqual(len(all_stats), 2)
+        for stats in all_stats:
+            self.assertTrue(before <= stats.finished <= time.time())
+
+        DBSession.query(Source).filter_by(
+            url=u"http://example.com/a").delete()
+        DBSession.query(Source).update({'next_run': None})
+        transaction.commit()
+        scheduler.run_once()
+        all_stats = list(write_metrics_file.call_args[0][0])
+        self.assertEqual([stats.url for stats in all_stats],
+                         [u"http://example.org/b"])
+
+    def test_scheduler_survives_failing_rounds(self):
+        log_mock = self.patch('ode.harvesting.log')
+        scheduler = HarvestScheduler(poll_interval=30)
+        scheduler.due_sources = Mock(
+            side_effect=[IOError("Database unreachable"), [], []])
+        scheduler.seconds_until_next_run = Mock(return_value=10)
+        sleep = self.patch('ode.harvesting.time.sleep',
+                           side_effect=[None, None, StopIteration])
+        with self.assertRaises(StopIteration):
+            scheduler.run()
+        self.assertEqual(scheduler.due_sources.call_count, 3)
+        self.assertEqual([call[0][0] for call in sleep.call_args_list],
+                         [30, 10, 10])
+        self.assertEqual(log_mock.error.call_args[1],
+                         {'exc_info': True})
+
+    def test_backoff_is_bounded(self):
+        source = Source(url=u'http://example.com', harvest_interval=3600)
+        now = datetime.datetime(2014, 1, 25, 15)
+        for _ in range(10):
+            source.schedule_failure(now)
+        self.assertEqual(source.next_run,
+                         now + datetime.timedelta(seconds=MAX_HARVEST_BACKOFF))
+        source.schedule_success(now)
+        self.assertEqual(source.failure_count, 0)
+        self.assertEqual(source.next_run, now + datetime.timedelta(hours=1))
+
+
+def harvest_response_or_fail(source, response, *args):
+    if u''.join(response.body.iter_text()) == u'fail':
+        raise ValueError("Harvest failure")
+    return harvest_response(source, response, *args)
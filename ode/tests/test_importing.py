@@ -0,0 +1,194 @@
+# -*- encoding: utf-8 -*-
+import io
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import transaction
+
+from ode.importing import EventImporter, iter_file_items
+from ode.models import DBSession, Event
+from ode.tests import BaseTestMixin
+from ode.tests.support import QueryCounter
+from ode.validation.parallel import ParallelValidator
+from ode.validation.schema import EventSchema
+
+
+icalendar_feed = u"""BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//ODE//Tests//EN
+BEGIN:VEVENT
+UID:ical@example.com
+DTSTART:20140125T150000
+DTEND:20140125T170000
+SUMMARY:Événement iCalendar
+END:VEVENT
+END:VCALENDAR
+"""
+
+csv_feed = u"""id,title,start_time,tags
+csv@example.com,Événement CSV,2014-01-25T15:00:00,"tag1, tag2"
+"""
+
+
+def json_feed(uids):
+    return json.dumps({'collection': {'items': [
+        {'data': [
+            {'name': 'id', 'value': uid},
+            {'name': 'title', 'value': u'Event %s' % uid},
+            {'name': 'start_time', 'value': u'2014-01-25T15:00:00'},
+        ]}
+        for uid in uids
+    ]}})
+
+
+class TestImport(BaseTestMixin, TestCase):
+
+    def setUp(self):
+        super(TestImport, self).setUp()
+        self.log = self.patch('ode.importing.log')
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write_file(self, name, content):
+        path = os.path.join(self.directory, name)
+        with io.open(path, 'w', encoding='utf-8') as import_file:
+            import_file.write(content)
+        return path
+
+    def import_events(self, paths=None, **kwargs):
+        kwargs.setdefault('processes', 1)
+        importer = EventImporter(u'123', **kwargs)
+        return importer.run(paths or [self.directory])
+
+    def event_ids(self):
+        return sorted(event.id for event in DBSession.query(Event))
+
+    def test_import_directory(self):
+        self.write_file('a.ics', icalendar_feed)
+        self.write_file('b.csv', csv_feed)
+        self.write_file('c.json', json_feed([u'1@example.com']))
+        self.write_file('README', u'Not an event file')
+        stats = self.import_events()
+        self.assertEqual(stats.inserted, 3)
+        self.assertEqual(stats.position, 3)
+        self.assertEqual(self.event_ids(), [
+            u'1@example.com', u'csv@example.com', u'ical@example.com'])
+        event = DBSession.query(Event).get(u'csv@example.com')
+        self.assertEqual(event.provider_id, u'123')
+        self.assertEqual([tag.name for tag in event.tags],
+                         [u'tag1', u'tag2'])
+
+    def test_batches_are_committed_separately(self):
+        uids = [u'%s@example.com' % i for i in range(5)]
+        self.write_file('events.json', json_feed(uids))
+        positions = []
+        self.import_events(batch_size=2, progress=lambda stats:
+                           positions.append(stats.position))
+        self.assertEqual(positions, [2, 4, 5])
+
+    def test_resume_from_offset(self):
+        uids = [u'%s@example.com' % i for i in range(5)]
+        self.write_file('events.json', json_feed(uids))
+        stats = self.import_events(offset=3)
+        self.assertEqual(stats.inserted, 2)
+        self.assertEqual(self.event_ids(), uids[3:])
+
+    def test_files_are_parsed_as_read(self):
+        uids = [u'%s@example.com' % i for i in range(5000)]
+        path = self.write_file('events.json', json_feed(uids))
+        opened = []
+        real_open = io.open
+
+        def open_file(*args, **kwargs):
+            import_file = real_open(*args, **kwargs)
+            opened.append(import_file)
+            return import_file
+
+        self.patch('ode.importing.io.open', side_effect=open_file)
+        items = iter_file_items(path)
+        self.assertEqual(next(items)['id'], uids[0])
+        self.assertLess(opened[0].tell(), os.path.getsize(path))
+        items.close()
+        self.assertTrue(opened[0].closed)
+
+    def test_csv_multiline_field(self):
+        path = self.write_file('events.csv', csv_feed.replace(
+            u'Événement CSV', u'"Événement\nCSV"'))
+        items = list(iter_file_items(path))
+        self.assertEqual(items[0]['title'], u'Événement\nCSV')
+        self.assertEqual(items[0]['tags'], [u'tag1', u'tag2'])
+
+    def test_invalid_events_are_counted(self):
+        feed = json.loads(json_feed([u'1@example.com', u'2@example.com']))
+        del feed['collection']['items'][0]['data'][2]
+        self.write_file('events.json', json.dumps(feed))
+        stats = self.import_events()
+        self.assertEqual(stats.invalid, 1)
+        self.assertEqual(stats.position, 2)
+        self.assertEqual(self.event_ids(), [u'2@example.com'])
+
+    def test_update_and_ownership(self):
+        self.write_file('events.json', json_feed([u'1@example.com']))
+        DBSession.add(Event(id=u'2@example.com', title=u'Other',
+                            provider_id=u'456'))
+        transaction.commit()
+        self.import_events()
+        self.write_file('more.json', json_feed([u'2@example.com']))
+        stats = self.import_events()
+        self.assertEqual(stats.updated, 1)
+        self.assertEqual(stats.rejected, 1)
+        self.assertEqual(DBSession.query(Event).get(u'2@example.com').title,
+                         u'Other')
+
+    def test_import_brings_back_deleted_event(self):
+        DBSession.add(Event(id=u'1@example.com', title=u'Harvested',
+                            provider_id=u'123', deleted=True,
+                            fingerprint=u'0' * 40))
+        transaction.commit()
+        self.write_file('events.json', json_feed([u'1@example.com']))
+        stats = self.import_events()
+        self.assertEqual(stats.updated, 1)
+        event = DBSession.query(Event).get(u'1@example.com')
+        self.assertFalse(event.deleted)
+        self.assertIsNone(event.fingerprint)
+
+    def reimport_query_count(self, count):
+        uids = [u'%s-%s@example.com' % (count, i) for i in range(count)]
+        feed = json.loads(json_feed(uids))
+        for item in feed['collection']['items']:
+            item['data'].extend([
+                {'name': 'tags', 'value': [u'tag']},
+                {'name': 'location_name', 'value': u'Lieu'},
+                {'name': 'images', 'value': [
+                    {'url': u'http://example.com/a.png',
+                     'license': u'CC BY'}]},
+            ])
+        path = self.write_file('%s.json' % count, json.dumps(feed))
+        self.import_events([path])
+        with QueryCounter() as counter:
+            stats = self.import_events([path])
+        self.assertEqual(stats.updated, count)
+        return counter.count
+
+    def test_reimport_query_count(self):
+        # Only the inserts of the new images add up with the batch size
+        self.assertLessEqual(self.reimport_query_count(40),
+                             self.reimport_query_count(10) + 30)
+
+    def test_parallel_validation(self):
+        cstructs = [{'title': u'Event %s' % i,
+                     'start_time': u'2014-01-25T15:00:00'}
+                    for i in range(7)]
+        cstructs[4]['start_time'] = u'invalid'
+        with ParallelValidator(processes=2, batch_size=2) as validator:
+            results = list(validator.validate(cstructs, EventSchema,
+                                              offset=10))
+        self.assertEqual([index for index, _, _ in results],
+                         list(range(10, 17)))
+        self.assertEqual(results[0][1]['title'], u'Event 0')
+        index, appstruct, errors = results[4]
+        self.assertIsNone(appstruct)
+        self.assertEqual([name for name, _ in errors], ['start_time'])
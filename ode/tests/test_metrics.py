@@ -0,0 +1,69 @@
+# -*- encoding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from ode.harvesting import HarvestStats
+from ode.metrics import prometheus_text, summary_table, write_metrics_file
+
+
+def make_stats():
+    stats = HarvestStats(1, u'http://example.com/"a"')
+    stats.status = HarvestStats.HARVESTED
+    stats.bytes = 1024
+    stats.parsed = 3
+    stats.inserted = 2
+    stats.invalid = 1
+    stats.timings['fetch'] = 0.5
+    stats.finished = 1000.5
+    failed = HarvestStats(2, u'http://example.org/b')
+    failed.status = HarvestStats.FAILED
+    return [stats, failed]
+
+
+class TestMetrics(TestCase):
+
+    def test_prometheus_text(self):
+        text = prometheus_text(make_stats())
+        lines = text.splitlines()
+        self.assertIn(u'# TYPE ode_harvest_bytes gauge', lines)
+        self.assertIn(
+            u'ode_harvest_bytes{source="http://example.com/\\"a\\""} 1024',
+            lines)
+        self.assertIn(
+            u'ode_harvest_events{source="http://example.org/b",'
+            u'outcome="inserted"} 0', lines)
+        self.assertIn(
+            u'ode_harvest_stage_seconds{source="http://example.com/\\"a\\"",'
+            u'stage="fetch"} 0.5', lines)
+        self.assertIn(u'ode_harvest_success{source="http://example.org/b"} 0',
+                      lines)
+        self.assertIn(u'ode_harvest_timestamp_seconds'
+                      u'{source="http://example.com/\\"a\\""} 1000.5', lines)
+        # Stats without an end time have no timestamp
+        self.assertNotIn(u'ode_harvest_timestamp_seconds'
+                         u'{source="http://example.org/b"}', text)
+        self.assertTrue(text.endswith(u'\n'))
+
+    def test_write_metrics_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'harvest.prom')
+        write_metrics_file(make_stats(), path)
+        self.assertEqual(os.listdir(directory), ['harvest.prom'])
+        with open(path, 'rb') as metrics_file:
+            self.assertIn(b'ode_harvest_events', metrics_file.read())
+
+    def test_summary_table(self):
+        lines = summary_table(make_stats()).splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[0].split(), [
+            u'source', u'status', u'bytes', u'parsed', u'inserted',
+            u'updated', u'skipped', u'invalid', u'deleted', u'fetch', u'(s)',
+            u'parse', u'(s)', u'validate', u'(s)', u'persist', u'(s)'])
+        self.assertTrue(lines[1].startswith(u'---'))
+        self.assertEqual(lines[2].split()[:5], [
+            u'http://example.com/"a"', u'harvested', u'1024', u'3', u'2'])
+        self.assertEqual(lines[3].split()[:2], [
+            u'http://example.org/b', u'failed'])
@@ -0,0 +1,71 @@
+# -*- encoding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from ode.models import DBSession
+from ode.resources.base import COLLECTION_JSON_MIMETYPE
+from ode.tests.event import TestEventMixin
+
+
+class TestProfiling(TestEventMixin, TestCase):
+
+    SETTINGS = {'ode.profiling.enabled': 'true'}
+
+    def setUp(self):
+        super(TestProfiling, self).setUp()
+        self.log = self.patch('ode.profiling.log')
+
+    def logged_profiles(self):
+        return [json.loads(call[0][1]) for call in self.log.log.call_args_list]
+
+    def get_profile(self, url, accept):
+        self.log.reset_mock()
+        self.app.get(url, headers={'Accept': accept})
+        profile, = self.logged_profiles()
+        return profile
+
+    def test_profile_is_logged(self):
+        self.create_event(title=u'Événement')
+        DBSession.flush()
+        for accept in (COLLECTION_JSON_MIMETYPE, 'text/csv',
+                       'text/calendar'):
+            profile = self.get_profile('/v1/events', accept)
+            self.assertEqual(profile['method'], 'GET')
+            self.assertEqual(profile['path'], '/v1/events')
+            self.assertEqual(profile['status'], 200)
+            self.assertGreater(profile['sql_count'], 0)
+            self.assertGreater(profile['sql_seconds'], 0)
+            self.assertGreater(profile['render_seconds'], 0)
+            self.assertGreaterEqual(profile['wall_seconds'],
+                                    profile['render_seconds'])
+
+    def test_stream_is_profiled_once_sent(self):
+        for i in range(3):
+            self.create_event(title=u'Événement %s' % i)
+        DBSession.flush()
+        profile = self.get_profile('/v1/events?stream=true', 'text/csv')
+        self.assertGreater(profile['sql_count'], 0)
+
+
+class TestSlowRequestProfiles(TestEventMixin, TestCase):
+
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+        self.SETTINGS = {
+            'ode.profiling.enabled': 'true',
+            'ode.profiling.slow_threshold': '0',
+            'ode.profiling.profile_dir': self.profile_dir,
+        }
+        super(TestSlowRequestProfiles, self).setUp()
+        self.patch('ode.profiling.log')
+
+    def test_slow_request_profile_is_dumped(self):
+        self.app.get('/v1/events',
+                     headers={'Accept': COLLECTION_JSON_MIMETYPE})
+        file_name, = os.listdir(self.profile_dir)
+        self.assertTrue(file_name.endswith('.prof'))
+        self.assertIn('-GET-v1_events-', file_name)
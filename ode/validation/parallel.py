@@ -0,0 +1,200 @@
+"""
+Validation of event data in a pool of worker processes.
+
+Deserializing events with colander is CPU bound: validating large imports,
+feeds and request bodies in several processes lets them use all cores.
+Error messages are sent back untranslated, to be translated by the calling
+process.
+"""
+import itertools
+import multiprocessing
+import threading
+
+from colander import Invalid, SchemaNode, String, interpolate
+
+
+VALIDATION_BATCH_SIZE = 200
+PARALLEL_THRESHOLD = 1000
+
+_shared = {'validator': None, 'threshold': PARALLEL_THRESHOLD}
+
+
+def invalid_messages(exc):
+    """
+    Return (field name, messages) pairs of a colander.Invalid exception,
+    like Invalid.asdict() but without interpolating the messages.
+    """
+    errors = []
+    for path in exc.paths():
+        keyparts = []
+        messages = []
+        for node_exc in path:
+            if node_exc.msg:
+                messages.extend(node_exc.messages())
+            keyname = node_exc._keyname()
+            if keyname:
+                keyparts.append(keyname)
+        errors.append(('.'.join(keyparts), messages))
+    return errors
+
+
+def format_messages(messages, translate=None):
+    if translate is not None:
+        return '; '.join(translate(message) for message in messages)
+    return '; '.join(interpolate(messages))
+
+
+def validate_batch(batch):
+    """
+    Deserialize a batch of cstructs, given as a (schema class, offset,
+    cstructs) tuple. Return a list of (index, appstruct, errors) tuples.
+    """
+    schema_class, offset, cstructs = batch
+    schema = schema_class()
+    results = []
+    for index, cstruct in enumerate(cstructs, offset):
+        try:
+            results.append((index, schema.deserialize(cstruct), None))
+        except Invalid as exc:
+            results.append((index, None, invalid_messages(exc)))
+    return results
+
+
+def iter_batches(schema_class, cstructs, size, offset=0):
+    cstructs = iter(cstructs)
+    while True:
+        batch = list(itertools.islice(cstructs, size))
+        if not batch:
+            return
+        yield schema_class, offset, batch
+        offset += len(batch)
+
+
+class ParallelValidator(object):
+    """
+    Validate cstructs by batches in a pool of worker processes. With a
+    single process, batches are validated in the calling process.
+
+    Only a few batches per process are queued at once, so that large
+    inputs can be validated as they are read.
+    """
+
+    def __init__(self, processes=None, batch_size=VALIDATION_BATCH_SIZE):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.batch_size = batch_size
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        """
+        Fork the worker processes, if not done yet. Forking while other
+        threads hold locks is unsafe: long running processes should start
+        the pool before starting threads.
+        """
+        with self.lock:
+            if self.pool is None and self.processes > 1:
+                self.pool = multiprocessing.Pool(self.processes)
+
+    def close(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def validate(self, cstructs, schema_class, offset=0):
+        """
+        Deserialize cstructs with a schema class, which must be importable
+        by the workers. Yield (index, appstruct, errors) tuples for each
+        cstruct, in order, indexes starting at offset. errors is None for
+        valid cstructs, a list of (field name, messages) pairs otherwise.
+        """
+        batches = iter_batches(schema_class, cstructs, self.batch_size,
+                               offset)
+        if self.processes > 1:
+            self.start()
+            window_size = 2 * self.processes
+            while True:
+                window = list(itertools.islice(batches, window_size))
+                if not window:
+                    return
+                for results in self.pool.imap(validate_batch, window):
+                    for result in results:
+                        yield result
+        else:
+            for batch in batches:
+                for result in validate_batch(batch):
+                    yield result
+
+    def deserialize_items(self, node, items, schema_class):
+        """
+        Deserialize the data of Collection+JSON items for a sequence node.
+        Errors are raised as the Invalid colander would have raised, so that
+        they are named after the index of their item.
+        """
+        appstructs = []
+        error = Invalid(node)
+        item_node, = node.children
+        results = self.validate([item['data'] for item in items],
+                                schema_class)
+        for index, appstruct, item_errors in results:
+            if item_errors is None:
+                appstructs.append({'data': appstruct})
+                continue
+            item_error = Invalid(item_node)
+            data_error = Invalid(item_node['data'])
+            for name, messages in item_errors:
+                if name:
+                    # Field errors keep their dotted name, eg. images.0.url
+                    data_error.add(Invalid(SchemaNode(String(), name=name),
+                                           messages))
+                else:
+                    data_error.msg = messages
+            item_error.add(data_error)
+            error.add(item_error, index)
+        if error.children:
+            raise error
+        return appstructs
+
+
+def configure(settings):
+    """
+    Validate request bodies of at least ode.validation.parallel_threshold
+    items in ode.validation.processes worker processes. Disabled unless
+    more than one process is set.
+
+    The workers are forked right away, before the server starts its
+    threads.
+    """
+    close()
+    processes = int(settings.get('ode.validation.processes', 1))
+    _shared['threshold'] = int(settings.get(
+        'ode.validation.parallel_threshold', PARALLEL_THRESHOLD))
+    if processes > 1:
+        validator = ParallelValidator(processes)
+        validator.start()
+        _shared['validator'] = validator
+
+
+def close():
+    if _shared['validator'] is not None:
+        _shared['validator'].close()
+        _shared['validator'] = None
+
+
+def shared_validator(size):
+    """
+    Return the validator of request bodies of size items, or None when
+    they are to be validated serially.
+    """
+    if size >= _shared['threshold']:
+        return _shared['validator']
+    return None
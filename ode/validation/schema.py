@@ -4,6 +4,7 @@ from colander import SequenceSchema, OneOf, drop
 import colander
 
 from ode.models import TAG_MAX_LENGTH, SAFE_MAX_LENGTH
+from ode.validation.parallel import shared_validator
 
 
 def default_schema_node():
@@ -96,10 +97,29 @@ class EventSchema(MappingSchema):
         name = SchemaNode(String(), validator=Length(1, TAG_MAX_LENGTH))
 
 
+class CollectionItemsSchema(SequenceSchema):
+    """
+    Collection+JSON items. The data of large collections are validated in
+    worker processes when ode.validation.parallel is configured to.
+    """
+
+    def deserialize(self, cstruct=colander.null):
+        validator = None
+        if isinstance(cstruct, list):
+            validator = shared_validator(len(cstruct))
+        # Malformed items are left to the serial validation to report
+        if validator is None or not all(
+                isinstance(item, dict) and isinstance(item.get('data'), dict)
+                for item in cstruct):
+            return super(CollectionItemsSchema, self).deserialize(cstruct)
+        data_schema = self.children[0]['data']
+        return validator.deserialize_items(self, cstruct, type(data_schema))
+
+
 class EventCollectionSchema(MappingSchema):
 
     @instantiate()
-    class items(SequenceSchema):
+    class items(CollectionItemsSchema):
 
         @instantiate()
         class item(MappingSchema):
@@ -128,6 +148,9 @@ class QueryStringSchema(MappingSchema):
     limit = SchemaNode(Integer(), missing=drop,
                        validator=colander.Range(0, COLLECTION_MAX_LENGTH))
     offset = SchemaNode(Integer(), missing=drop)
+    cursor = SchemaNode(String(), missing=drop)
+    total_count = SchemaNode(Boolean(), missing=True)
+    stream = SchemaNode(Boolean(), missing=False)
     sort_by = SchemaNode(String(), missing=drop)
     sort_direction = SchemaNode(String(), missing='asc',
                                 validator=OneOf(['asc', 'desc']))
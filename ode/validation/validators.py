@@ -21,3 +21,11 @@ def validate_querystring(request):
         for field, message in errors.items():
             request.errors.add('body', field, message)
         request.errors.status = 400
+
+
+def reject_stream(request):
+    if request.validated.get('stream'):
+        request.errors.add('body', 'stream',
+                           "Streaming is only available for the text/csv "
+                           "and text/calendar formats")
+        request.errors.status = 400
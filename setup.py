@@ -33,6 +33,7 @@ setup(name='ode',
       [console_scripts]
       initialize_ode_db = ode.scripts.initializedb:main
       harvest = ode.scripts.harvest:main
+      ode_import = ode.scripts.import_events:main
       """,
       message_extractors = { '.': [
           ('**.py',   'lingua_python', None ),